@@ -0,0 +1,4 @@
+"""
+Benchmarks for the Streeplijst2 application. Every benchmark is a script which can be run from the repository root, e.g.
+``python -m benchmarks.bench_api_client``.
+"""
@@ -0,0 +1,83 @@
+"""
+Benchmark the latency of one connection per API call against the pooled CongressusClient.
+
+A small keep-alive HTTP server is started on localhost which answers every request with a fixed JSON body. Note that
+this server does not use TLS, so the measured difference only contains the TCP handshake. Against api.congressus.nl
+the difference is larger, since every new connection also needs a TLS handshake.
+
+Usage: python -m benchmarks.bench_api_client [-n REQUESTS]
+"""
+import json
+import statistics
+import threading
+import time
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from streeplijst2.api import CongressusClient
+
+BODY = json.dumps([{'id': 1, 'name': 'Testproduct', 'price': '0', 'published': True, 'folder_id': 1998,
+                    'folder': 'Speciaal', 'media': []}]).encode()
+
+
+class _KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # HTTP/1.1 keeps the connection open between requests
+    disable_nagle_algorithm = True  # Headers and body are written separately, do not let them wait for an ACK
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    def log_message(self, format, *args):
+        pass  # Do not print every request
+
+
+def _measure(call, n: int) -> list:
+    """
+    Call a function n times and return the latency of every call in milliseconds.
+    """
+    latencies = []
+    for _ in range(n):
+        start = time.perf_counter()
+        call()
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def _report(name: str, latencies: list) -> None:
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print('%-24s mean %7.3f ms   median %7.3f ms   p95 %7.3f ms' % (
+        name, statistics.mean(latencies), statistics.median(latencies), p95))
+
+
+def main(n: int) -> None:
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _KeepAliveHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = 'http://127.0.0.1:%d' % server.server_port
+
+    try:
+        # One new connection per call, which is how the API functions worked before the pooled client
+        per_call = _measure(lambda: requests.get(base_url + '/products', params={'folder_id': 1998}, timeout=5), n)
+
+        client = CongressusClient(base_url=base_url, headers={})
+        pooled = _measure(lambda: client.get('products', '/products', params={'folder_id': 1998}), n)
+        client.close()
+    finally:
+        server.shutdown()
+
+    print('%d GET /products requests against %s' % (n, base_url))
+    _report('connection per call', per_call)
+    _report('pooled client', pooled)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark per-call connections against the pooled CongressusClient.')
+    parser.add_argument('-n', '--requests', type=int, default=500, help='number of requests per variant')
+    args = parser.parse_args()
+    main(args.requests)
@@ -0,0 +1,66 @@
+"""
+Benchmark storing the items of a folder sync: ItemDB.create per item against ItemDB.bulk_upsert.
+
+Every size is measured for a first sync (all items are new) and a resync in which 10% of the items changed. The database
+is a temporary SQLite file, so commits are written to disk like in production.
+
+Usage: python -m benchmarks.bench_bulk_upsert [--sizes 10 100 1000 10000] [--max-per-item 1000]
+"""
+import os
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from streeplijst2 import create_app
+from streeplijst2.extensions import db
+from streeplijst2.streeplijst.database import ItemDB
+
+
+def _items(n: int, price: int = 100) -> list:
+    return [dict(id=item_id, name='Item %d' % item_id, price=price if item_id % 10 == 0 else 100, published=True,
+                 media='', folder_id=1, folder_name='Folder') for item_id in range(1, n + 1)]
+
+
+def _per_item(items: list) -> None:
+    for item_dict in items:
+        ItemDB.create(**item_dict)
+
+
+def _timed(func, items: list) -> float:
+    start = time.perf_counter()
+    func(items)
+    return (time.perf_counter() - start) * 1000
+
+
+def _run(store, n: int) -> tuple:
+    """
+    Store n items in an empty database, then store them again with 10% changed items.
+
+    :return: A tuple with the first sync and resync time in milliseconds.
+    """
+    db_file = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    app = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + db_file})
+    with app.app_context():
+        first = _timed(store, _items(n))
+        resync = _timed(store, _items(n, price=200))
+        db.session.remove()
+        db.engine.dispose()
+    os.remove(db_file)
+    return first, resync
+
+
+def main(sizes: list, max_per_item: int) -> None:
+    print('%8s  %-12s %14s %14s' % ('items', 'method', 'first sync ms', 'resync ms'))
+    for n in sizes:
+        if n <= max_per_item:  # Storing every item in its own transaction takes very long for large folders
+            print('%8d  %-12s %14.1f %14.1f' % ((n, 'per item') + _run(_per_item, n)))
+        print('%8d  %-12s %14.1f %14.1f' % ((n, 'bulk upsert') + _run(ItemDB.bulk_upsert, n)))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark per item inserts against ItemDB.bulk_upsert.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000], help='folder sizes')
+    parser.add_argument('--max-per-item', type=int, default=1000,
+                        help='largest folder size which is also measured with ItemDB.create per item')
+    args = parser.parse_args()
+    main(args.sizes, args.max_per_item)
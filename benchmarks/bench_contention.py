@@ -0,0 +1,163 @@
+"""
+Contention benchmark: the latency of reads and checkouts while a large folder is synchronized at the same time.
+
+A writer thread synchronizes one large folder over and over, and every synchronization changes the price of all its
+items, so every run writes the whole folder in a single transaction. Meanwhile, reader threads load the items of the
+other folders (like GET /streeplijst/folder/<id>) and checkout threads store quick sales (like POST /streeplijst/sale).
+
+This is measured for two SQLite profiles on a temporary database file:
+- default: what create_app used before, the SQLite defaults (rollback journal, synchronous=FULL) and a new connection
+  for every session.
+- tuned: the SQLITE_PRAGMAS, SQLITE_POOL_SIZE and SQLITE_MAX_OVERFLOW of config.yaml.
+
+Usage: python -m benchmarks.bench_contention [--duration 10] [--sync-items 20000] [--readers 4] [--checkouts 2]
+                                             [--profiles default tuned]
+"""
+import os
+import random
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+from datetime import datetime
+
+from sqlalchemy.exc import OperationalError
+
+from streeplijst2 import create_app
+from streeplijst2.config import FOLDERS, SQLITE_PRAGMAS, SQLITE_POOL_SIZE, SQLITE_MAX_OVERFLOW
+from streeplijst2.extensions import db
+from streeplijst2.models import User
+from streeplijst2.streeplijst.database import FolderDB, ItemDB, SaleDB
+from streeplijst2.streeplijst.models import Folder, Item
+import streeplijst2.api as api
+
+from benchmarks.loadtest import percentile
+
+PROFILES = {
+    'default': dict(SQLITE_PRAGMAS=dict(), SQLITE_POOL_SIZE=0),
+    'tuned': dict(SQLITE_PRAGMAS=SQLITE_PRAGMAS, SQLITE_POOL_SIZE=SQLITE_POOL_SIZE,
+                  SQLITE_MAX_OVERFLOW=SQLITE_MAX_OVERFLOW),
+}
+
+N_USERS = 100
+ITEMS_PER_FOLDER = 50  # Nr of items in every folder except the synchronized one
+
+
+def _seed(sync_folder_id: int, sync_items: int) -> None:
+    """
+    Fill an empty database with Core executemany INSERTs.
+    """
+    now = datetime.now()
+    db.session.execute(Folder.__table__.insert(), [
+        dict(id=id, name=folder['name'], media=folder['media'], synchronized=now, created=now, updated=now)
+        for (id, folder) in FOLDERS.items()])
+    db.session.execute(User.__table__.insert(), [
+        dict(id=id, s_number='s%d' % id, first_name='User', last_name=str(id), date_of_birth=datetime(2000, 1, 1),
+             has_sdd_mandate=True, created=now, updated=now) for id in range(1, N_USERS + 1)])
+    items = []
+    for folder_id in FOLDERS.keys():
+        n = sync_items if folder_id == sync_folder_id else ITEMS_PER_FOLDER
+        first_id = folder_id * 100000
+        items.extend(dict(id=id, name='Item %d' % id, price=50, published=True, media='', folder_id=folder_id,
+                          folder_name=FOLDERS[folder_id]['name'], created=now, updated=now)
+                     for id in range(first_id, first_id + n))
+    db.session.execute(Item.__table__.insert(), items)
+    db.session.commit()
+
+
+def _changing_folder(sync_items: int):
+    """
+    Return a replacement of api.get_products_in_folder which returns all items of the folder with a new price on every
+    call.
+    """
+    calls = iter(range(10 ** 9))
+
+    def get_products_in_folder(folder_id: int, timeout: float = None, synchronized: datetime = None) -> list:
+        price = 51 + next(calls) % 2
+        first_id = folder_id * 100000
+        return [dict(id=id, name='Item %d' % id, price=price, published=True, media='', folder_id=folder_id,
+                     folder_name=FOLDERS[folder_id]['name']) for id in range(first_id, first_id + sync_items)]
+
+    return get_products_in_folder
+
+
+def _worker(app, name: str, func, deadline: float, latencies: dict, errors: dict, lock: threading.Lock) -> None:
+    """
+    Call func until the deadline and record the latency of every call in ms.
+    """
+    with app.app_context():
+        while time.time() < deadline:
+            start = time.perf_counter()
+            try:
+                func()
+                failed = False
+            except OperationalError:  # E.g. 'database is locked' after the busy timeout
+                db.session.rollback()
+                failed = True
+            latency = (time.perf_counter() - start) * 1000
+            db.session.remove()  # Like the end of a request
+            with lock:
+                latencies[name].append(latency)
+                errors[name] += failed
+
+
+def run(profile: str, args) -> None:
+    folder = tempfile.mkdtemp()
+    config = dict(PROFILES[profile], TESTING=True,
+                  SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(folder, 'contention.db'))
+    app = create_app(config)
+    folder_ids = list(FOLDERS.keys())
+    sync_folder_id = folder_ids[0]
+    read_folder_ids = folder_ids[1:] or folder_ids
+    api.get_products_in_folder = _changing_folder(args.sync_items)
+
+    with app.app_context():
+        _seed(sync_folder_id, args.sync_items)
+        item_ids = [id for (id,) in db.session.query(Item.id).filter(Item.folder_id.in_(read_folder_ids))]
+        db.session.remove()
+
+    rng = random.Random(1)
+    names = ('sync', 'read', 'checkout')
+    latencies = dict((name, []) for name in names)
+    errors = dict((name, 0) for name in names)
+    lock = threading.Lock()
+    deadline = time.time() + args.duration
+
+    def read():
+        FolderDB.get(rng.choice(read_folder_ids))
+        ItemDB.get_by_folder_id(rng.choice(read_folder_ids))
+
+    def checkout():
+        SaleDB.create_quick(1, rng.choice(item_ids), rng.randint(1, N_USERS))
+
+    workers = [('sync', lambda: FolderDB.sync_folder(sync_folder_id))]
+    workers += [('read', read)] * args.readers + [('checkout', checkout)] * args.checkouts
+    threads = [threading.Thread(target=_worker, args=(app, name, func, deadline, latencies, errors, lock))
+               for (name, func) in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print('\n%s profile: %s' % (profile, PROFILES[profile]))
+    print('%-10s %8s %7s %9s %9s %9s %9s' % ('operation', 'calls', 'errors', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+    for name in names:
+        values = sorted(latencies[name])
+        print('%-10s %8d %7d %9.2f %9.2f %9.2f %9.2f' % (name, len(values), errors[name], percentile(values, 50),
+                                                         percentile(values, 95), percentile(values, 99),
+                                                         values[-1] if values else 0))
+
+    with app.app_context():
+        db.engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark reads and checkouts during a concurrent folder synchronization.')
+    parser.add_argument('--duration', type=float, default=10, help='number of seconds to run every profile')
+    parser.add_argument('--sync-items', type=int, default=20000, help='number of items in the synchronized folder')
+    parser.add_argument('--readers', type=int, default=4, help='number of threads which load folders')
+    parser.add_argument('--checkouts', type=int, default=2, help='number of threads which store sales')
+    parser.add_argument('--profiles', nargs='+', default=list(PROFILES.keys()), choices=list(PROFILES.keys()))
+    args = parser.parse_args()
+    for profile in args.profiles:
+        run(profile, args)
@@ -0,0 +1,175 @@
+"""
+Micro-benchmarks of the database layer: UserDB, ItemDB, FolderDB and SaleDB.
+
+The database is seeded with users, items (spread over the folders in streeplijst_config.yaml) and sales with a few bulk
+INSERTs, after which every operation is called a number of times through the *DB classes. Every operation is measured
+twice: once for its speed, and once with tracemalloc for the memory it allocates at its peak. Measuring allocations
+slows Python down, so the two are never measured in the same run.
+
+The benchmark runs against a temporary SQLite file (fsync on every commit, like in production) and against an in-memory
+SQLite database, to separate the cost of writing to disk from the cost of SQLAlchemy itself. FolderDB.load_folder gets
+its items from a function which replaces the API call, so only the synchronization in the database is measured.
+
+Usage: python -m benchmarks.bench_database [--users 2000] [--items 1000] [--sales 200000] [--ops 200] [--list-ops 3]
+                                           [--backends file memory] [--only NAME [NAME ...]]
+"""
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from datetime import datetime
+
+from streeplijst2 import create_app
+from streeplijst2.config import FOLDERS
+from streeplijst2.database import UserDB
+from streeplijst2.extensions import db
+from streeplijst2.models import User
+from streeplijst2.streeplijst.database import FolderDB, ItemDB, SaleDB
+from streeplijst2.streeplijst.models import Folder, Item, Sale
+import streeplijst2.api as api
+
+ALLOCATION_OPS = 20  # Nr of calls of every operation while tracing allocations
+
+
+def _seed(n_users: int, n_items: int, n_sales: int, rng: random.Random) -> None:
+    """
+    Fill an empty database with Core executemany INSERTs, which is much faster than the *DB classes.
+    """
+    now = datetime.now()
+    folder_ids = list(FOLDERS.keys())
+    db.session.execute(Folder.__table__.insert(), [
+        dict(id=id, name=folder['name'], media=folder['media'], synchronized=now, created=now, updated=now)
+        for (id, folder) in FOLDERS.items()])
+    db.session.execute(User.__table__.insert(), [
+        dict(id=id, s_number='s%d' % id, first_name='User', last_name=str(id), date_of_birth=datetime(2000, 1, 1),
+             has_sdd_mandate=True, created=now, updated=now) for id in range(1, n_users + 1)])
+    db.session.execute(Item.__table__.insert(), [
+        dict(id=id, name='Item %d' % id, price=50, published=True, media='', folder_id=folder_ids[id % len(folder_ids)],
+             folder_name=FOLDERS[folder_ids[id % len(folder_ids)]]['name'], created=now, updated=now)
+        for id in range(1, n_items + 1)])
+
+    batch = 10000
+    for start in range(0, n_sales, batch):
+        sales = []
+        for _ in range(start, min(start + batch, n_sales)):
+            (user_id, item_id) = (rng.randint(1, n_users), rng.randint(1, n_items))
+            sales.append(dict(quantity=1, total_price=50, item_id=item_id, item_name='Item %d' % item_id,
+                              user_id=user_id, user_s_number='s%d' % user_id, status=Sale.STATUS_OK, attempts=1,
+                              created=now, last_updated=now))
+        db.session.execute(Sale.__table__.insert(), sales)
+    db.session.commit()
+
+
+def _items_in_folder(folder_id: int, timeout: float = None, synchronized: datetime = None) -> list:
+    """
+    Replacement of api.get_products_in_folder which returns the stored items of a folder with a new price for 10%.
+    """
+    query = db.session.query(Item.id, Item.name, Item.price).filter(Item.folder_id == folder_id)
+    return [dict(id=id, name=name, price=price + (1 if id % 10 == 0 else 0), published=True, media='',
+                 folder_id=folder_id, folder_name=FOLDERS[folder_id]['name']) for (id, name, price) in query]
+
+
+def _operations(n_users: int, n_items: int, rng: random.Random) -> list:
+    """
+    Return the operations to benchmark as (name, function, is_listing) tuples. Every function performs one operation.
+    """
+    new_ids = iter(range(10 ** 7, 2 * 10 ** 7))  # IDs for new users and items which do not exist yet
+    folder_ids = list(FOLDERS.keys())
+    sale_ids = [id for (id,) in db.session.query(Sale.id).order_by(Sale.id).limit(10000)]
+
+    def user_create():
+        id = next(new_ids)
+        UserDB.create(id=id, s_number='s%d' % id, first_name='New', last_name='User',
+                      date_of_birth=datetime(2000, 1, 1))
+
+    def item_create():
+        id = next(new_ids)
+        ItemDB.create(id=id, name='New item %d' % id, price=50, published=True, folder_id=folder_ids[0],
+                      folder_name=FOLDERS[folder_ids[0]]['name'])
+
+    return [
+        ('UserDB.create', user_create, False),
+        ('UserDB.update', lambda: UserDB.update(rng.randint(1, n_users), first_name='Updated'), False),
+        ('UserDB.get', lambda: UserDB.get(rng.randint(1, n_users)), False),
+        ('UserDB.list_all', UserDB.list_all, True),
+        ('ItemDB.create', item_create, False),
+        ('ItemDB.update', lambda: ItemDB.update(rng.randint(1, n_items), price=rng.randint(1, 100)), False),
+        ('ItemDB.list_all', ItemDB.list_all, True),
+        ('ItemDB.get_by_folder_id', lambda: ItemDB.get_by_folder_id(rng.choice(folder_ids)), False),
+        ('FolderDB.load_folder (sync)', lambda: FolderDB.load_folder(rng.choice(folder_ids), force_sync=True), False),
+        ('FolderDB.load_folder (no sync)', lambda: FolderDB.load_folder(rng.choice(folder_ids)), False),
+        ('SaleDB.create_quick', lambda: SaleDB.create_quick(1, rng.randint(1, n_items), rng.randint(1, n_users)),
+         False),
+        ('SaleDB.update', lambda: SaleDB.update(rng.choice(sale_ids), status=Sale.STATUS_OK), False),
+        ('SaleDB.get_by_user_id', lambda: SaleDB.get_by_user_id(rng.randint(1, n_users)), False),
+        ('SaleDB.get_by_item_id', lambda: SaleDB.get_by_item_id(rng.randint(1, n_items)), False),
+        ('SaleDB.list_all', SaleDB.list_all, True),
+    ]
+
+
+def _measure(func, n: int) -> tuple:
+    """
+    Call a function n times.
+
+    :return: A tuple of the nr of operations per second and the mean peak allocation per operation in KiB.
+    """
+    start = time.perf_counter()
+    for _ in range(n):
+        func()
+        db.session.expire_all()  # Do not let the identity map of earlier operations speed up the next ones
+    ops_per_sec = n / (time.perf_counter() - start)
+
+    peaks = []
+    tracemalloc.start()
+    try:
+        for _ in range(min(n, ALLOCATION_OPS)):
+            tracemalloc.reset_peak()
+            (before, _) = tracemalloc.get_traced_memory()
+            func()
+            (_, peak) = tracemalloc.get_traced_memory()
+            peaks.append(peak - before)
+            db.session.expire_all()
+    finally:
+        tracemalloc.stop()
+    return ops_per_sec, sum(peaks) / len(peaks) / 1024
+
+
+def run(backend: str, args) -> None:
+    rng = random.Random(1)
+    folder = tempfile.mkdtemp()
+    uri = 'sqlite:///' + os.path.join(folder, 'bench.db') if backend == 'file' else 'sqlite://'
+    app = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': uri})
+    api.get_products_in_folder = _items_in_folder
+
+    with app.app_context():
+        start = time.perf_counter()
+        _seed(args.users, args.items, args.sales, rng)
+        print('\n%s database: seeded %d users, %d items and %d sales in %.1f s' % (
+            backend, args.users, args.items, args.sales, time.perf_counter() - start))
+        print('%-32s %8s %12s %16s' % ('operation', 'calls', 'ops/sec', 'peak KiB/op'))
+
+        for (name, func, is_listing) in _operations(args.users, args.items, rng):
+            if args.only and not any(only in name for only in args.only):
+                continue
+            n = args.list_ops if is_listing else args.ops
+            (ops_per_sec, peak) = _measure(func, n)
+            print('%-32s %8d %12.1f %16.1f' % (name, n, ops_per_sec, peak))
+
+        db.session.remove()
+        db.engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark the *DB classes against file-backed and in-memory SQLite.')
+    parser.add_argument('--users', type=int, default=2000, help='number of users in the database')
+    parser.add_argument('--items', type=int, default=1000, help='number of items in the database')
+    parser.add_argument('--sales', type=int, default=200000, help='number of sales in the database')
+    parser.add_argument('--ops', type=int, default=200, help='number of calls of every operation')
+    parser.add_argument('--list-ops', type=int, default=3, help='number of calls of the list_all operations')
+    parser.add_argument('--backends', nargs='+', default=['file', 'memory'], choices=['file', 'memory'])
+    parser.add_argument('--only', nargs='+', default=None, help='only run the operations containing these names')
+    args = parser.parse_args()
+    for backend in args.backends:
+        run(backend, args)
@@ -0,0 +1,110 @@
+"""
+Benchmark of the folder page hot path: loading the items of a folder as Item instances through the ORM, compared with
+loading them as read-only ItemRows with a Core SELECT (ItemDB.get_rows_by_folder_id).
+
+Both paths are measured with and without rendering folder.jinja2, since the template is rendered for every request.
+Every request starts with a new session, like a request of the app. The CPU time is measured with time.process_time(),
+and the peak allocation with tracemalloc in a separate run, since tracing allocations slows Python down.
+
+Usage: python -m benchmarks.bench_folder_page [--items 50 200 1000] [--requests 200]
+"""
+import os
+import tempfile
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from datetime import datetime
+
+from flask import render_template, session
+
+from streeplijst2 import create_app
+from streeplijst2.config import FOLDERS, TEST_USER
+from streeplijst2.extensions import db
+from streeplijst2.streeplijst.database import FolderDB, ItemDB
+from streeplijst2.streeplijst.models import Folder, Item
+
+ALLOCATION_REQUESTS = 20  # Nr of requests while tracing allocations
+
+
+def _seed(folder_id: int, n_items: int) -> None:
+    now = datetime.now()
+    db.session.execute(Folder.__table__.insert(), [dict(id=folder_id, name=FOLDERS[folder_id]['name'], media='',
+                                                        synchronized=now, created=now, updated=now)])
+    db.session.execute(Item.__table__.insert(), [
+        dict(id=id, name='Item %d' % id, price=50, published=True, media='https://example.com/%d.png' % id,
+             folder_id=folder_id, folder_name=FOLDERS[folder_id]['name'], created=now, updated=now)
+        for id in range(1, n_items + 1)])
+    db.session.commit()
+
+
+def _paths(folder_id: int) -> list:
+    """
+    Return the paths to benchmark as (name, function) tuples. Every function handles one request.
+    """
+
+    def render(items):
+        return render_template('folder.jinja2', meta_folders=FOLDERS, folder=FolderDB.get(folder_id), items=items,
+                               cart_size=0)
+
+    return [
+        ('ORM Items', lambda: ItemDB.get_by_folder_id(folder_id)),
+        ('ItemRows', lambda: ItemDB.get_rows_by_folder_id(folder_id)),
+        ('ORM Items + render', lambda: render(ItemDB.get_by_folder_id(folder_id))),
+        ('ItemRows + render', lambda: render(ItemDB.get_rows_by_folder_id(folder_id))),
+    ]
+
+
+def _measure(func, n: int) -> tuple:
+    """
+    Handle n requests.
+
+    :return: A tuple of the mean CPU time per request in ms and the mean peak allocation per request in KiB.
+    """
+    start = time.process_time()
+    for _ in range(n):
+        func()
+        db.session.remove()  # Every request has a new session
+    cpu = (time.process_time() - start) / n * 1000
+
+    peaks = []
+    tracemalloc.start()
+    try:
+        for _ in range(min(n, ALLOCATION_REQUESTS)):
+            tracemalloc.reset_peak()
+            (before, _) = tracemalloc.get_traced_memory()
+            func()
+            (_, peak) = tracemalloc.get_traced_memory()
+            peaks.append(peak - before)
+            db.session.remove()
+    finally:
+        tracemalloc.stop()
+    return cpu, sum(peaks) / len(peaks) / 1024
+
+
+def run(n_items: int, n_requests: int) -> None:
+    folder = tempfile.mkdtemp()
+    app = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(folder, 'folder.db')})
+    folder_id = list(FOLDERS.keys())[0]
+
+    with app.app_context():
+        _seed(folder_id, n_items)
+        with app.test_request_context('/streeplijst/folder/%d' % folder_id):
+            session['user_id'] = TEST_USER['id']  # The template shows the logged in user
+            session['user_first_name'] = TEST_USER['first_name']
+            print('\nfolder with %d items, %d requests per path' % (n_items, n_requests))
+            print('%-22s %14s %16s' % ('path', 'CPU ms/request', 'peak KiB/request'))
+            for (name, func) in _paths(folder_id):
+                func()  # Warm up, e.g. compile the template
+                (cpu, peak) = _measure(func, n_requests)
+                print('%-22s %14.3f %16.1f' % (name, cpu, peak))
+        db.session.remove()
+        db.engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark ORM Items against ItemRows on the folder page.')
+    parser.add_argument('--items', type=int, nargs='+', default=[50, 200, 1000], help='number of items in the folder')
+    parser.add_argument('--requests', type=int, default=200, help='number of requests per path')
+    args = parser.parse_args()
+    for n_items in args.items:
+        run(n_items, args.requests)
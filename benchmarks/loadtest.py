@@ -0,0 +1,229 @@
+"""
+End-to-end load test: simulated kiosks run sessions against the app and the latency of every route is measured.
+
+Every session logs in a member, browses one to three folders, buys an item, and logs out, with a random think time
+between the steps. Note that POST /streeplijst/sale still buys the test item for the test user, whoever is logged in.
+Unless --url is given, the app is started in this process on a temporary database, and its API client is pointed at the
+Congressus stand-in (streeplijst2.congressus_stub), so no real sales are posted.
+
+The results are printed per route (throughput and p50/p95/p99 latency) and can be saved as JSON. Pass a saved result
+with --compare to print the p95 change per route against that run.
+
+Usage: python -m benchmarks.loadtest [--kiosks 4] [--duration 30] [--think-time 0.5] [--stub-latency 0.05]
+                                     [--stub-error-rate 0] [--members 100] [--url URL] [--output FILE]
+                                     [--compare FILE]
+"""
+import json
+import os
+import random
+import subprocess
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+from datetime import datetime
+
+import requests
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+from streeplijst2.config import FOLDERS, TEST_USER
+
+ROUTES = ('POST /login', 'GET /streeplijst/folder/<id>', 'POST /streeplijst/sale', 'GET /logout')
+
+
+def percentile(values: list, p: float) -> float:
+    """
+    Return the p-th percentile of a sorted list with the nearest-rank method.
+    """
+    if not values:
+        return 0
+    return values[max(0, min(len(values) - 1, int(round(p / 100 * len(values))) - 1))]
+
+
+class _QuietRequestHandler(WSGIRequestHandler):
+    def log(self, type, message, *args):
+        pass  # Do not log every request
+
+
+class Recorder:
+    """
+    Collects the latency and errors per route from all kiosk threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = dict((route, []) for route in ROUTES)
+        self.errors = dict((route, 0) for route in ROUTES)
+        self.sessions = 0
+
+    def request(self, session: requests.Session, route: str, method: str, url: str, **kwargs) -> None:
+        start = time.perf_counter()
+        try:
+            res = session.request(method, url, allow_redirects=False, timeout=30, **kwargs)
+            failed = res.status_code >= 400
+        except requests.RequestException:
+            failed = True
+        latency = (time.perf_counter() - start) * 1000
+        with self._lock:
+            self.latencies[route].append(latency)
+            if failed:
+                self.errors[route] += 1
+
+    def session_done(self) -> None:
+        with self._lock:
+            self.sessions += 1
+
+
+def _kiosk(base_url: str, s_numbers: list, folder_ids: list, think_time: float, deadline: float, recorder: Recorder,
+           seed: int) -> None:
+    """
+    Run sessions until the deadline. Every kiosk has its own cookies, like a browser.
+    """
+    rng = random.Random(seed)
+
+    def think():
+        if think_time > 0:
+            time.sleep(rng.expovariate(1 / think_time))
+
+    with requests.Session() as session:
+        while time.time() < deadline:
+            recorder.request(session, 'POST /login', 'POST', base_url + '/login',
+                             data={'s-number': rng.choice(s_numbers)})
+            for _ in range(rng.randint(1, 3)):
+                think()
+                recorder.request(session, 'GET /streeplijst/folder/<id>', 'GET',
+                                 base_url + '/streeplijst/folder/%d' % rng.choice(folder_ids))
+            think()
+            recorder.request(session, 'POST /streeplijst/sale', 'POST', base_url + '/streeplijst/sale')
+            think()
+            recorder.request(session, 'GET /logout', 'GET', base_url + '/logout')
+            recorder.session_done()
+
+
+def _start_app(stub_latency: float, stub_error_rate: float, members: int) -> tuple:
+    """
+    Start the Congressus stand-in and the app in this process.
+
+    :return: A tuple of the base URL of the app, the student numbers which can log in, and a function to stop both.
+    """
+    from streeplijst2 import create_app
+    from streeplijst2.congressus_stub import CongressusStub
+    import streeplijst2.api as api
+
+    folder = tempfile.mkdtemp()
+    stub = CongressusStub(latency=stub_latency, error_rate=stub_error_rate)
+    s_numbers = stub.add_members(members)
+    api.client = api.CongressusClient(base_url=stub.start(), cache=api.ResponseCache(os.path.join(folder, 'cache')))
+
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(folder, 'loadtest.sqlite')})
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=_QuietRequestHandler)
+    threading.Thread(target=server.serve_forever, name='loadtest-app', daemon=True).start()
+
+    def stop():
+        server.shutdown()
+        if 'sale_outbox' in app.extensions:
+            app.extensions['sale_outbox'].stop(timeout=5)
+        stub.stop()
+
+    return 'http://127.0.0.1:%d' % server.server_port, s_numbers, stop
+
+
+def _git_revision() -> str:
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL)
+        return revision.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summarize(recorder: Recorder, duration: float) -> dict:
+    """
+    Compute the throughput and latency percentiles per route.
+
+    :return: A dict with the results per route and in total.
+    """
+    routes = dict()
+    for route in ROUTES:
+        latencies = sorted(recorder.latencies[route])
+        routes[route] = dict(requests=len(latencies), errors=recorder.errors[route],
+                             throughput=len(latencies) / duration,
+                             mean=sum(latencies) / len(latencies) if latencies else 0,
+                             p50=percentile(latencies, 50), p95=percentile(latencies, 95),
+                             p99=percentile(latencies, 99))
+    total = sum(route['requests'] for route in routes.values())
+    return dict(routes=routes, requests=total, throughput=total / duration, sessions=recorder.sessions,
+                sessions_per_minute=recorder.sessions / duration * 60,
+                errors=sum(route['errors'] for route in routes.values()))
+
+
+def report(result: dict, baseline: dict = None) -> None:
+    print('%-30s %8s %7s %8s %9s %9s %9s %9s' % ('route', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms',
+                                                 'p95 diff'))
+    for (route, stats) in result['routes'].items():
+        diff = ''
+        if baseline is not None and baseline['routes'].get(route, dict()).get('p95'):
+            diff = '%+8.1f%%' % ((stats['p95'] / baseline['routes'][route]['p95'] - 1) * 100)
+        print('%-30s %8d %7d %8.2f %9.2f %9.2f %9.2f %9s' % (route, stats['requests'], stats['errors'],
+                                                             stats['throughput'], stats['p50'], stats['p95'],
+                                                             stats['p99'], diff))
+    print('%d sessions (%.1f per minute), %d requests (%.2f per second), %d errors' % (
+        result['sessions'], result['sessions_per_minute'], result['requests'], result['throughput'], result['errors']))
+
+
+def main(args) -> None:
+    stop = None
+    if args.url is None:
+        base_url, s_numbers, stop = _start_app(args.stub_latency, args.stub_error_rate, args.members)
+    else:
+        base_url, s_numbers = args.url.rstrip('/'), args.s_numbers
+
+    with requests.Session() as session:  # POST /streeplijst/sale still buys for the test user, so it must be stored
+        session.post(base_url + '/login', data={'s-number': TEST_USER['s_number']}, timeout=30)
+
+    recorder = Recorder()
+    start = time.time()
+    deadline = start + args.duration
+    kiosks = [threading.Thread(target=_kiosk, args=(base_url, s_numbers, list(FOLDERS.keys()), args.think_time,
+                                                    deadline, recorder, seed))
+              for seed in range(args.kiosks)]
+    try:
+        for kiosk in kiosks:
+            kiosk.start()
+        for kiosk in kiosks:
+            kiosk.join()
+    finally:
+        if stop is not None:
+            stop()
+    duration = time.time() - start
+
+    result = summarize(recorder, duration)
+    result['meta'] = dict(timestamp=datetime.now().isoformat(), revision=_git_revision(), url=args.url,
+                          kiosks=args.kiosks, duration=duration, think_time=args.think_time,
+                          stub_latency=args.stub_latency, stub_error_rate=args.stub_error_rate)
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        print('Compared with %s (revision %s)' % (args.compare, baseline['meta'].get('revision')))
+    report(result, baseline)
+
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump(result, file, indent=2)
+        print('Saved the results to %s' % args.output)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Load test the streeplijst with simulated kiosks.')
+    parser.add_argument('--kiosks', type=int, default=4, help='number of kiosks running sessions at the same time')
+    parser.add_argument('--duration', type=float, default=30, help='number of seconds to run')
+    parser.add_argument('--think-time', type=float, default=0.5, help='mean number of seconds between two steps')
+    parser.add_argument('--stub-latency', type=float, default=0.05, help='latency of the Congressus stand-in')
+    parser.add_argument('--stub-error-rate', type=float, default=0, help='fraction of stand-in requests which fail')
+    parser.add_argument('--members', type=int, default=100, help='number of different members which log in')
+    parser.add_argument('--url', default=None, help='load test a running app instead of starting one')
+    parser.add_argument('--s-numbers', nargs='+', default=['s9999999'], help='members to log in with --url')
+    parser.add_argument('--output', default=None, help='save the results as JSON to this file')
+    parser.add_argument('--compare', default=None, help='results of an earlier run to compare with')
+    main(parser.parse_args())
@@ -4,7 +4,8 @@ Contains all Flask logic to connect this Python backend to the HTML frontend.
 import os
 from flask import Flask
 
-from streeplijst2.config import INSTANCE_FOLDER, DEV_KEY
+from streeplijst2.config import INSTANCE_FOLDER, DEV_KEY, SALE_OUTBOX, SQLITE_PRAGMAS, SQLITE_POOL_SIZE, \
+    SQLITE_MAX_OVERFLOW, CATALOG_CACHE, ROSTER_SYNC, QUERY_STATS
 
 
 def create_app(config: dict = None):
@@ -26,7 +27,14 @@ def create_app(config: dict = None):
     app.config.from_mapping(
         SECRET_KEY=DEV_KEY,  # Load the dev key as a default configuration
         SQLALCHEMY_DATABASE_URI='sqlite:///' + app.instance_path + '/database.sqlite',  # Database in instance folder
-        SQLALCHEMY_TRACK_MODIFICATIONS=False  # Reduces the overhead of track_modifications
+        SQLALCHEMY_TRACK_MODIFICATIONS=False,  # Reduces the overhead of track_modifications
+        SQLITE_PRAGMAS=SQLITE_PRAGMAS,  # Pragmas which are set on every new SQLite connection
+        SQLITE_POOL_SIZE=SQLITE_POOL_SIZE,  # Nr of SQLite connections which are kept open
+        SQLITE_MAX_OVERFLOW=SQLITE_MAX_OVERFLOW,  # Nr of extra SQLite connections when all pooled ones are in use
+        CATALOG_CACHE=CATALOG_CACHE,  # Serve the folder pages from an in-memory cache
+        ROSTER_SYNC=ROSTER_SYNC,  # Store all members in the database, so logins need no API request
+        QUERY_STATS=QUERY_STATS,  # Record the queries and database time of every request
+        SALE_OUTBOX=SALE_OUTBOX  # Post sales from a background worker instead of during checkout
     )
 
     # Load configuration
@@ -34,19 +42,41 @@ def create_app(config: dict = None):
         app.config.from_mapping(config)
 
     # Set up the database
-    from streeplijst2.extensions import db  # Import the database module
+    from streeplijst2.extensions import db, sqlite_engine_options, set_sqlite_pragmas  # Import the database module
+    engine_options = sqlite_engine_options(app.config['SQLALCHEMY_DATABASE_URI'], app.config['SQLITE_POOL_SIZE'],
+                                           app.config['SQLITE_MAX_OVERFLOW'])
+    engine_options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS', dict()))  # Explicit engine options take priority
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options
     db.init_app(app)  # Intialize the Flask_SQLAlchemy database
 
     import streeplijst2.models  # Import all models (needed to create SQL tables)
     import streeplijst2.streeplijst.models  # Import all models (needed to create SQL tables)
+    from streeplijst2.migrations import migrate
     with app.app_context():
+        set_sqlite_pragmas(db.engine, app.config['SQLITE_PRAGMAS'])  # Before the engine opens its first connection
         db.create_all()  # Create tables in this app from all models imported before
+        migrate(db.engine)  # Add the columns and indexes which create_all() does not add to existing tables
+
+    if app.config['QUERY_STATS'] is True:
+        from streeplijst2.instrumentation import QueryStats
+        app.extensions['query_stats'] = QueryStats(app)  # Record the queries of every request
 
     if app.testing is not True:  # Only load the folders if we are not testing
         from streeplijst2.streeplijst.database import init_database
         with app.app_context():
             init_database()  # Load all folders into the database if needed
 
+    if app.testing is not True and app.config['ROSTER_SYNC'] is True:  # Only load the roster if we are not testing
+        from streeplijst2.database import UserDB
+        with app.app_context():
+            UserDB.schedule_roster_sync()  # Load all members in the background if the roster is outdated
+
+    from streeplijst2.database import NegativeCache
+    app.extensions['users_not_found'] = NegativeCache()  # Student numbers which the API did not find, see UserDB.login
+
+    from streeplijst2.streeplijst.catalog import CatalogCache
+    app.extensions['catalog'] = CatalogCache()  # Every app has its own cache, since it may use another database
+
     # Register all routes
     from streeplijst2.routes import bp_home
     app.register_blueprint(bp_home)
@@ -54,4 +84,9 @@ def create_app(config: dict = None):
     from streeplijst2.streeplijst.routes import bp_streeplijst
     app.register_blueprint(bp_streeplijst)
 
+    if app.testing is not True and app.config['SALE_OUTBOX'] is True:  # Only start the outbox if we are not testing
+        from streeplijst2.streeplijst.outbox import OutboxWorker
+        app.extensions['sale_outbox'] = OutboxWorker(app)
+        app.extensions['sale_outbox'].start()  # Post pending sales in the background
+
     return app
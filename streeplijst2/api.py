@@ -1,12 +1,377 @@
 import requests  # library used for making calls to Congressus API
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.exceptions import MaxRetryError, NewConnectionError, ConnectTimeoutError
 import json
+import os
+import hashlib
+import tempfile
+import threading
+import time
+from pathlib import Path
 from datetime import datetime
 
-from streeplijst2.config import BASE_URL, BASE_HEADER, TIMEOUT
+from streeplijst2.config import BASE_URL, BASE_HEADER, TIMEOUT, POOL_SIZE, RETRIES, BACKOFF_FACTOR, ENDPOINT_TIMEOUTS, \
+    API_CACHE, API_CACHE_TTL, API_CACHE_MAX_SIZE, API_CACHE_FOLDER, ROSTER_PAGE_SIZE
+from streeplijst2.singleflight import coalesce
+import streeplijst2.metrics as metrics
 from streeplijst2.exceptions import ItemNotFoundException, FolderNotFoundException, UserNotFoundException, \
     UserNotSignedException
 
 
+class CachedResponse:
+    """
+    A response body which is stored in a ResponseCache, together with the headers needed to revalidate it.
+    """
+
+    def __init__(self, url: str, text: str, etag: str = None, last_modified: str = None, stored: float = None,
+                 changed: float = None):
+        """
+        Instantiates a CachedResponse object.
+
+        :param url: The full URL of the request, including the query string.
+        :param text: The response body.
+        :param etag: (optional) The ETag header of the response.
+        :param last_modified: (optional) The Last-Modified header of the response.
+        :param stored: (optional) Timestamp of the last time the response was downloaded. Defaults to now.
+        :param changed: (optional) Timestamp of the last time the response body changed. Defaults to stored.
+        """
+        self.url = url
+        self.text = text
+        self.etag = etag
+        self.last_modified = last_modified
+        self.stored = time.time() if stored is None else stored
+        self.changed = self.stored if changed is None else changed
+
+    def is_fresh(self, ttl: float) -> bool:
+        """
+        Check if the response may be used without asking the API. Responses with an ETag or Last-Modified header are
+        always revalidated, since that is cheap. Other responses are used for ttl seconds after they were downloaded.
+
+        :param ttl: Nr of seconds a response without validators may be used.
+        :return: True if no request is needed.
+        """
+        if self.etag is not None or self.last_modified is not None:
+            return False
+        return time.time() - self.stored < ttl
+
+    def validators(self) -> dict:
+        """
+        Return the headers for a conditional request, so the API responds with a 304 if the response did not change.
+
+        :return: A dict with the If-None-Match and/or If-Modified-Since headers.
+        """
+        headers = dict()
+        if self.etag is not None:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified is not None:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+    def to_response(self) -> requests.Response:
+        """
+        Build a response from the cached body, so callers can handle it like a response from the API.
+
+        :return: A requests.Response with status code 200.
+        """
+        res = requests.Response()
+        res.status_code = 200
+        res.reason = 'OK'
+        res.url = self.url
+        res.encoding = 'utf-8'
+        res._content = self.text.encode('utf-8')
+        return res
+
+
+class ResponseCache:
+    """
+    On-disk cache of API responses, keyed by URL. Responses with an ETag or Last-Modified header are revalidated with a
+    conditional request, so an unchanged response costs a 304 without a body. Responses without these headers are used
+    without a request for ttl seconds. When the cache grows over max_size bytes, the least recently used responses are
+    removed. A single cache may be shared between threads.
+    """
+
+    def __init__(self, folder: Path = API_CACHE_FOLDER, ttl: float = API_CACHE_TTL, max_size: int = API_CACHE_MAX_SIZE):
+        """
+        Create a new cache.
+
+        :param folder: Folder in which the responses are stored. Defaults to config.py API_CACHE_FOLDER.
+        :param ttl: Nr of seconds a response without validators is used. Defaults to config.py API_CACHE_TTL.
+        :param max_size: Max nr of bytes of all cached responses. Defaults to config.py API_CACHE_MAX_SIZE.
+        """
+        self.folder = Path(folder)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0  # Responses which were used without a request
+        self.revalidated = 0  # Requests which were answered with a 304 (Not Modified)
+        self.misses = 0  # Responses which were downloaded
+        self._lock = threading.Lock()
+        os.makedirs(self.folder, exist_ok=True)
+
+    def _path(self, url: str) -> Path:
+        return self.folder / (hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self, url: str) -> CachedResponse:
+        """
+        Return the cached response for a URL.
+
+        :param url: The full URL of the request, including the query string.
+        :return: The CachedResponse, or None if the URL is not cached.
+        """
+        path = self._path(url)
+        try:
+            with open(path, encoding='utf-8') as file:
+                meta = json.loads(file.readline())  # The first line holds the headers, the rest of the file is the body
+                text = file.read()
+            os.utime(path)  # Mark the response as recently used, so it is evicted last
+        except (OSError, ValueError):  # The response is not cached or the file is damaged
+            return None
+        return CachedResponse(url, text, etag=meta['etag'], last_modified=meta['last_modified'],
+                              stored=meta['stored'], changed=meta['changed'])
+
+    def put(self, url: str, res: requests.Response, previous: CachedResponse = None) -> CachedResponse:
+        """
+        Store a response and evict the least recently used responses if the cache is too large.
+
+        :param url: The full URL of the request, including the query string.
+        :param res: The response to store.
+        :param previous: (optional) The response which was cached before, used to check if the body changed.
+        :return: The CachedResponse.
+        """
+        cached = CachedResponse(url, res.text, etag=res.headers.get('ETag'),
+                                last_modified=res.headers.get('Last-Modified'))
+        if previous is not None and previous.text == cached.text:  # Downloaded again, but nothing changed
+            cached.changed = previous.changed
+
+        meta = dict(url=url, etag=cached.etag, last_modified=cached.last_modified, stored=cached.stored,
+                    changed=cached.changed)
+        path = self._path(url)
+        # A unique temporary file, since other threads and processes (e.g. WSGI workers) may write the same URL
+        (fd, tmp_path) = tempfile.mkstemp(dir=self.folder, prefix=path.name + '.', suffix='.tmp')
+        try:
+            with open(fd, 'w', encoding='utf-8') as file:
+                file.write(json.dumps(meta) + '\n' + cached.text)
+            os.replace(tmp_path, path)  # Readers never see a partially written file
+        except OSError:
+            os.unlink(tmp_path)
+            raise
+
+        self.evict()
+        return cached
+
+    def evict(self) -> int:
+        """
+        Remove the least recently used responses until the cache is not larger than max_size.
+
+        :return: The nr of removed responses.
+        """
+        files = []
+        for path in self.folder.glob('*.json'):
+            try:
+                stat = path.stat()
+            except OSError:  # Removed by another thread
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+
+        size = sum(file_size for (_, file_size, _) in files)
+        removed = 0
+        for (_, file_size, path) in sorted(files):  # Oldest first
+            if size <= self.max_size:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                pass
+            size -= file_size
+            removed += 1
+        return removed
+
+    def count(self, counter: str) -> None:
+        """
+        Increment a hit/miss counter.
+
+        :param counter: 'hits', 'revalidated' or 'misses'.
+        """
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def stats(self) -> dict:
+        """
+        Return the hit/miss counters.
+
+        :return: A dict with the nr of hits, revalidated responses and misses.
+        """
+        with self._lock:
+            return dict(hits=self.hits, revalidated=self.revalidated, misses=self.misses)
+
+    def clear(self) -> None:
+        """
+        Remove all cached responses and reset the counters.
+        """
+        for path in self.folder.glob('*.json'):
+            try:
+                path.unlink()
+            except OSError:  # Removed by another thread or process
+                pass
+        with self._lock:
+            self.hits = self.revalidated = self.misses = 0
+
+
+class CongressusClient:
+    """
+    Client for the Congressus API. The client owns a pool of keep-alive connections, so consecutive requests reuse an
+    open connection instead of doing a new TCP and TLS handshake for every call. A single client may be shared between
+    threads.
+    """
+
+    def __init__(self, base_url: str = BASE_URL, headers: dict = None, pool_size: int = POOL_SIZE,
+                 retries: int = RETRIES, backoff_factor: float = BACKOFF_FACTOR, timeouts: dict = None,
+                 default_timeout: float = TIMEOUT, cache: ResponseCache = None):
+        """
+        Create a new client.
+
+        :param base_url: Base URL of the API. Defaults to config.py BASE_URL.
+        :param headers: Headers sent with every request. Defaults to config.py BASE_HEADER.
+        :param pool_size: Max nr of connections kept open in the pool. Defaults to config.py POOL_SIZE.
+        :param retries: Nr of retries on connection errors and 502, 503 and 504 responses. Defaults to config.py
+        RETRIES.
+        :param backoff_factor: Backoff factor between retries in seconds. Defaults to config.py BACKOFF_FACTOR.
+        :param timeouts: Dict with a timeout per endpoint. Defaults to config.py ENDPOINT_TIMEOUTS.
+        :param default_timeout: Timeout for endpoints which are not in timeouts. Defaults to config.py TIMEOUT.
+        :param cache: (optional) ResponseCache used by get_cached(). If None, get_cached() always downloads.
+        """
+        self.base_url = base_url
+        self.cache = cache
+        self.timeouts = dict(ENDPOINT_TIMEOUTS if timeouts is None else timeouts)
+        self.default_timeout = default_timeout
+
+        # Only connection errors and responses of idempotent requests are retried. Read errors are never retried, since
+        # the request may already have been processed (e.g. a sale which is posted twice). This also makes sure a read
+        # timeout is raised as a requests.Timeout instead of a generic ConnectionError.
+        retry = Retry(total=retries, connect=retries, read=False, status=retries, backoff_factor=backoff_factor,
+                      status_forcelist=(502, 503, 504), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.headers.update(BASE_HEADER if headers is None else headers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def timeout(self, endpoint: str, timeout: float = None) -> float:
+        """
+        Return the timeout to use for a request.
+
+        :param endpoint: Endpoint name (e.g. 'products', 'product', 'members' or 'sales').
+        :param timeout: Timeout passed by the caller. If it is not None it is always used.
+        :return: The timeout in seconds.
+        """
+        if timeout is not None:
+            return timeout
+        return self.timeouts.get(endpoint, self.default_timeout)
+
+    def get(self, endpoint: str, path: str, params: dict = None, timeout: float = None) -> requests.Response:
+        """
+        Send a GET request to the API.
+
+        :param endpoint: Endpoint name, used to select the timeout and to label the metrics.
+        :param path: Path relative to the base URL (e.g. '/products').
+        :param params: (optional) Query string parameters.
+        :param timeout: (optional) Timeout for the request. Defaults to the endpoint timeout.
+        :return: The server response.
+        """
+        return self._send(endpoint, self.session.get, url=self.base_url + path, params=params,
+                          timeout=self.timeout(endpoint, timeout))
+
+    def get_cached(self, endpoint: str, path: str, params: dict = None, timeout: float = None) -> tuple:
+        """
+        Send a GET request to the API through the response cache. A cached response is used without a request while it
+        is fresh, or after the API answered a conditional request with a 304. Only 200 responses are cached.
+
+        :param endpoint: Endpoint name, used to select the timeout and to label the metrics.
+        :param path: Path relative to the base URL (e.g. '/products').
+        :param params: (optional) Query string parameters.
+        :param timeout: (optional) Timeout for the request. Defaults to the endpoint timeout.
+        :return: A tuple of the response and the datetime at which its body last changed, or None if it is not cached.
+        """
+        if self.cache is None:
+            return self.get(endpoint, path, params=params, timeout=timeout), None
+
+        url = requests.Request('GET', self.base_url + path, params=params).prepare().url  # Cache key with query string
+        cached = self.cache.get(url)
+        if cached is not None and cached.is_fresh(self.cache.ttl):
+            self.cache.count('hits')
+            return cached.to_response(), datetime.fromtimestamp(cached.changed)
+
+        headers = cached.validators() if cached is not None else None
+        res = self._send(endpoint, self.session.get, url=url, headers=headers, timeout=self.timeout(endpoint, timeout))
+        if res.status_code == 304 and cached is not None:  # Not Modified, the cached body is still valid
+            self.cache.count('revalidated')
+            return cached.to_response(), datetime.fromtimestamp(cached.changed)
+
+        self.cache.count('misses')
+        if res.status_code != 200:
+            return res, None
+        cached = self.cache.put(url, res, previous=cached)
+        return res, datetime.fromtimestamp(cached.changed)
+
+    def post(self, endpoint: str, path: str, json: dict = None, timeout: float = None) -> requests.Response:
+        """
+        Send a POST request to the API.
+
+        :param endpoint: Endpoint name, used to select the timeout and to label the metrics.
+        :param path: Path relative to the base URL (e.g. '/sales').
+        :param json: (optional) Payload which is sent as JSON.
+        :param timeout: (optional) Timeout for the request. Defaults to the endpoint timeout.
+        :return: The server response.
+        """
+        return self._send(endpoint, self.session.post, url=self.base_url + path, json=json,
+                          timeout=self.timeout(endpoint, timeout))
+
+    @staticmethod
+    def _send(endpoint: str, send, **kwargs) -> requests.Response:
+        """
+        Send a request and record its duration and status code, or the kind of error if there was no response.
+        """
+        start = time.perf_counter()
+        try:
+            res = send(**kwargs)
+        except requests.Timeout:  # Checked first, a ConnectTimeout is also a ConnectionError
+            metrics.registry.observe_api_request(endpoint, time.perf_counter() - start, error='timeout')
+            raise
+        except requests.ConnectionError:
+            metrics.registry.observe_api_request(endpoint, time.perf_counter() - start, error='connection')
+            raise
+        except requests.RequestException:
+            metrics.registry.observe_api_request(endpoint, time.perf_counter() - start, error='other')
+            raise
+        metrics.registry.observe_api_request(endpoint, time.perf_counter() - start, status_code=res.status_code)
+        return res
+
+    def close(self) -> None:
+        """
+        Close all pooled connections.
+        """
+        self.session.close()
+
+
+client = CongressusClient(cache=ResponseCache() if API_CACHE else None)  # Shared client used by all API functions
+
+
+def request_not_sent(err: Exception) -> bool:
+    """
+    Check if a request failed before it was sent to the API. Only such requests can safely be sent again: after a read
+    timeout or a dropped connection the API may already have processed the request (e.g. booked a sale).
+
+    :param err: The error raised by a request of the client.
+    :return: True if the connection to the API could not be made, so the request was never sent.
+    """
+    if isinstance(err, requests.ConnectTimeout):
+        return True
+    if isinstance(err, requests.ConnectionError) and err.args and isinstance(err.args[0], MaxRetryError):
+        return isinstance(err.args[0].reason, (NewConnectionError, ConnectTimeoutError))  # Failed to connect
+    return False  # E.g. a ReadTimeout, or a ConnectionError which wraps a ProtocolError after the request was sent
+
+
 def _normalize_media(item_dict):
     """
     Flatten the JSON dict for the media url, if the item has any.
@@ -31,23 +396,38 @@ def _normalize_profile_picture(user_dict):
         user_dict['profile_picture'] = ''
 
 
-def get_product(item_id: int, timeout: float = TIMEOUT):
+def _normalize_member(user_dict):
+    """
+    Rename and convert the fields of a member as sent by Congressus to the fields of a User.
+    :param user_dict: JSON dict to normalize.
+    """
+    user_dict['date_of_birth'] = datetime.fromisoformat(user_dict['date_of_birth'])
+    user_dict['s_number'] = user_dict.pop('username', None)  # Rename the username field to s_number
+    user_dict['last_name'] = user_dict.pop('primary_last_name_main', None)  # Rename to last_name
+    user_dict['last_name_prefix'] = user_dict.pop('primary_last_name_prefix', None)  # Rename to last_name_prefix
+    _normalize_profile_picture(user_dict)
+
+
+@coalesce  # Concurrent identical requests share one API call
+def get_product(item_id: int, timeout: float = None, synchronized: datetime = None):
     """
     GET a single item from Congressus API.
 
     :param item_id: Item id to retrieve.
-    :param timeout: Timeout for the request. Defaults to config.py TIMEOUT.
-    :return: A dict containing the server response converted from a JSON string.
+    :param timeout: Timeout for the request. Defaults to config.py ENDPOINT_TIMEOUTS['product'].
+    :param synchronized: (optional) When the caller last stored this item. If the response did not change since then,
+    None is returned without decoding the response.
+    :return: A dict containing the server response converted from a JSON string, or None if it did not change.
     """
-    url = BASE_URL + '/products/' + str(item_id)
-    headers = BASE_HEADER
-    res = requests.get(url=url, headers=headers, timeout=timeout)
+    res, changed = client.get_cached('product', '/products/' + str(item_id), timeout=timeout)
 
     if res.status_code == 404:
         error_msg = u'%s Client Error: Item %s is not found for URL %s' % (res.status_code, item_id, res.url)
         raise ItemNotFoundException(error_msg, response=res)  # Raise an HTTP error
 
     res.raise_for_status()  # Raise any other response errors
+    if synchronized is not None and changed is not None and changed <= synchronized:  # The caller is up to date
+        return None
     result = json.loads(res.text)  # Select the relevant data and convert to a list of dicts
     _normalize_media(result)
     result['folder_name'] = result.pop('folder', None)  # Rename the folder field to folder_name
@@ -55,25 +435,30 @@ def get_product(item_id: int, timeout: float = TIMEOUT):
     return result
 
 
-def get_products_in_folder(folder_id: int, timeout: float = TIMEOUT) -> list:
+@coalesce  # Concurrent identical requests share one API call
+def get_products_in_folder(folder_id: int, timeout: float = None, synchronized: datetime = None) -> list:
     """
     GET all products inside a single folder from Congressus API. This is a blocking call.
 
     :param folder_id: Folder id to retrieve items for.
-    :param timeout: Timeout for the request. Defaults to config.py TIMEOUT.
-    :return: A list of dicts containing the server response converted from a JSON string.
+    :param timeout: Timeout for the request. Defaults to config.py ENDPOINT_TIMEOUTS['products'].
+    :param synchronized: (optional) When the caller last stored the items of this folder. If the response did not
+    change since then, None is returned without decoding the response.
+    :return: A list of dicts containing the server response converted from a JSON string, or None if it did not change.
     """
-    url = BASE_URL + "/products?folder_id=" + str(folder_id)  # Set the URL to connect to the API
-    headers = BASE_HEADER  # Create the base header which contains the secret API token
-    res = requests.get(url=url, headers=headers, timeout=timeout)  # Send the request with the default timeout
+    res, changed = client.get_cached('products', '/products', params={'folder_id': folder_id},
+                                     timeout=timeout)  # Send the request
 
     res.raise_for_status()  # Raise any HTTP errors which occurred when making the request
-    if not res.json():  # The server sent an empty response
+    if synchronized is not None and changed is not None and changed <= synchronized:  # The caller is up to date
+        return None
+
+    result = json.loads(res.text)  # Select the relevant data and convert to a list of dicts
+    if not result:  # The server sent an empty response
         res.status_code = 404
         error_msg = u'%s Client Error: folder_id %s is not found for URL %s' % (res.status_code, folder_id, res.url)
         raise FolderNotFoundException(error_msg, response=res)  # Raise an HTTP error
 
-    result = json.loads(res.text)  # Select the relevant data and convert to a list of dicts
     for item in result:
         _normalize_media(item)
         # Normalise the field results
@@ -83,17 +468,16 @@ def get_products_in_folder(folder_id: int, timeout: float = TIMEOUT) -> list:
     return result
 
 
-def get_user(s_number: str, timeout: float = TIMEOUT):
+@coalesce  # Concurrent identical requests share one API call
+def get_user(s_number: str, timeout: float = None):
     """
     GET a single user from Congressus API. This is a blocking call.
 
     :param s_number: Student number to retrieve the user for.
-    :param timeout: Timeout for the request. Defaults to config.py TIMEOUT.
+    :param timeout: Timeout for the request. Defaults to config.py ENDPOINT_TIMEOUTS['members'].
     :return: A dict containing the server response converted from a JSON string.
     """
-    url = BASE_URL + "/members?username=" + s_number  # Set the URL to connect to the API
-    headers = BASE_HEADER  # Create the base header which contains the secret API token
-    res = requests.get(url=url, headers=headers, timeout=timeout)  # Send the request with the default timeout
+    res = client.get('members', '/members', params={'username': s_number}, timeout=timeout)  # Send the request
 
     res.raise_for_status()  # Raise any HTTP errors which occurred when making the request
     if not res.json():  # The server sent an empty response
@@ -103,18 +487,33 @@ def get_user(s_number: str, timeout: float = TIMEOUT):
 
     user_list = json.loads(res.text)  # Convert response to a list of dicts. Congressus always sends a list of objects
     result = user_list[0]  # There will only be one user in this list, so we select the first user
+    _normalize_member(result)
+
+    return result
 
-    # Normalize the result fields
-    result['date_of_birth'] = datetime.fromisoformat(result['date_of_birth'])
-    result['s_number'] = result.pop('username', None)  # Rename the username field to s_number
-    result['last_name'] = result.pop('primary_last_name_main', None)  # Rename to last_name
-    result['last_name_prefix'] = result.pop('primary_last_name_prefix', None)  # Rename to last_name_prefix
-    _normalize_profile_picture(result)
+
+def get_members(page: int = 1, page_size: int = ROSTER_PAGE_SIZE, timeout: float = None) -> list:
+    """
+    GET a single page of the members from Congressus API, sorted by id. This is a blocking call. The page is requested
+    through the response cache, so a page which did not change since the previous request costs a 304 without a body.
+
+    :param page: Nr of the page to retrieve, starting at 1.
+    :param page_size: Nr of members per page. Defaults to config.py ROSTER_PAGE_SIZE.
+    :param timeout: Timeout for the request. Defaults to config.py ENDPOINT_TIMEOUTS['roster'].
+    :return: A list of dicts like get_user() returns. The API may return less than page_size members per page, only an
+    empty page means that there are no more members.
+    """
+    res, _ = client.get_cached('roster', '/members', params={'page': page, 'page_size': page_size}, timeout=timeout)
+
+    res.raise_for_status()  # Raise any HTTP errors which occurred when making the request
+    result = json.loads(res.text)  # Convert response to a list of dicts
+    for member in result:
+        _normalize_member(member)
 
     return result
 
 
-def post_sale(user_id: int, product_id: int, quantity: int, timeout: float = TIMEOUT):
+def post_sale(user_id: int, product_id: int, quantity: int, timeout: float = None):
     """
     POSTs a sale to Congressus API. This method may raise exceptions if the request is not valid or legal. Warning: This
     will add payments to a user.
@@ -122,22 +521,33 @@ def post_sale(user_id: int, product_id: int, quantity: int, timeout: float = TIM
     :param user_id: User ID to post to.
     :param product_id: Product ID.
     :param quantity: Amount to buy.
-    :param timeout: Timeout for the request. Defaults to config.py TIMEOUT.
+    :param timeout: Timeout for the request. Defaults to config.py ENDPOINT_TIMEOUTS['sales'].
+    :return: A dict containing the server response converted from a JSON string.
+    """
+    return post_sale_items(user_id, [{"product_id": product_id, "quantity": quantity}], timeout=timeout)
+
+
+def post_sale_items(user_id: int, items: list, timeout: float = None):
+    """
+    POSTs a sale with one or more items to Congressus API in a single request. This method may raise exceptions if the
+    request is not valid or legal. Warning: This will add payments to a user.
+
+    :param user_id: User ID to post to.
+    :param items: List of dicts with the 'product_id' and 'quantity' of every item. The items in the response are in
+    the same order.
+    :param timeout: Timeout for the request. Defaults to config.py ENDPOINT_TIMEOUTS['sales'].
     :return: A dict containing the server response converted from a JSON string.
     """
     payload = {  # Store the sales parameters in the format required by Congressus
         "user_id": user_id,  # User id
-        "items": [{"product_id": product_id,  # Product id
-                   "quantity": quantity  # Amount of items
-                   }], "payments": [{"type": "direct_debit"  # Type of payment
+        "items": [{"product_id": item["product_id"],  # Product id
+                   "quantity": item["quantity"]  # Amount of items
+                   } for item in items], "payments": [{"type": "direct_debit"  # Type of payment
                                      # TODO: Direct debit is hard coded right now. This may be changed later, although
                                      #  the streeplijst is intended to only work with direct debit for now. See
                                      #  http://docs.congressus.nl/#!/default/post_sales for more info.
                                      }]}
-    url = BASE_URL + "/sales"
-    headers = BASE_HEADER
-    res = requests.post(url=url, headers=headers, json=payload,
-                        timeout=timeout)  # Send request with payload and default timeout
+    res = client.post('sales', '/sales', json=payload, timeout=timeout)  # Send request with payload
 
     # A user might not have signed their SDD mandate (SEPA machtiging) in which case POSTing a sale is forbidden.
     # Congressus returns a 404 (NOT FOUND) error but that should be a 403 (FORBIDDEN) error. That is corrected below.
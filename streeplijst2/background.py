@@ -0,0 +1,70 @@
+"""
+Run tasks in background threads, outside of the HTTP request which triggered them.
+"""
+import logging
+import threading
+
+from flask import current_app
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()  # Protects _tasks
+_tasks = dict()  # Threads of the running tasks, by key
+
+
+def run_once(key, func, *args, **kwargs) -> bool:
+    """
+    Run a function in a background thread inside an app context, unless a task with the same key is still running. This
+    makes sure there is at most one task in flight per key. Any exception raised by the function is logged.
+
+    Must be called from inside an app context.
+
+    :param key: Hashable key which identifies the task, e.g. ('folder', 1998).
+    :param func: The function to run.
+    :param args: Positional arguments for the function.
+    :param kwargs: Keyword arguments for the function.
+    :return: True if the task was started, False if a task with the same key was still running.
+    """
+    app = current_app._get_current_object()  # The app itself is passed to the thread, not the context local proxy
+
+    def target():
+        try:
+            with app.app_context():
+                func(*args, **kwargs)
+        except Exception:
+            logger.exception('Background task %s failed', key)
+        finally:
+            with _lock:
+                _tasks.pop(key, None)
+
+    with _lock:
+        if key in _tasks:  # A task with this key is already running
+            return False
+        thread = threading.Thread(target=target, name='background-%s' % (key,), daemon=True)
+        _tasks[key] = thread
+    thread.start()
+    return True
+
+
+def is_running(key) -> bool:
+    """
+    Check if a task is running.
+
+    :param key: Key of the task.
+    :return: True if a task with this key is running.
+    """
+    with _lock:
+        return key in _tasks
+
+
+def join(key, timeout: float = None) -> None:
+    """
+    Wait until a task is finished. Returns immediately if no task with this key is running.
+
+    :param key: Key of the task.
+    :param timeout: (optional) Max nr of seconds to wait.
+    """
+    with _lock:
+        thread = _tasks.get(key)
+    if thread is not None:
+        thread.join(timeout)
@@ -1,3 +1,4 @@
+import os
 import yaml
 from pathlib import Path
 from datetime import datetime
@@ -15,9 +16,50 @@ with open(config_path) as file:
 
 PORT = global_cfg['PORT']
 UPDATE_INTERVAL = global_cfg['UPDATE_INTERVAL']
+SYNC_WORKERS = global_cfg['SYNC_WORKERS']
+BACKGROUND_SYNC = global_cfg['BACKGROUND_SYNC']
+SYNC_RETRY_INTERVAL = global_cfg['SYNC_RETRY_INTERVAL']
+SYNC_LEASE_TIMEOUT = global_cfg['SYNC_LEASE_TIMEOUT']
+LOGIN_FRESHNESS = global_cfg['LOGIN_FRESHNESS']
+LOGIN_NOT_FOUND_TTL = global_cfg['LOGIN_NOT_FOUND_TTL']
+LOGIN_NOT_FOUND_MAX = global_cfg['LOGIN_NOT_FOUND_MAX']
+ROSTER_SYNC = global_cfg['ROSTER_SYNC']
+ROSTER_SYNC_INTERVAL = global_cfg['ROSTER_SYNC_INTERVAL']
+ROSTER_PAGE_SIZE = global_cfg['ROSTER_PAGE_SIZE']
+ROSTER_MIN_SEEN = global_cfg['ROSTER_MIN_SEEN']
+CATALOG_CACHE = global_cfg['CATALOG_CACHE']
+CATALOG_CHECK_INTERVAL = global_cfg['CATALOG_CHECK_INTERVAL']
+QUERY_STATS = global_cfg['QUERY_STATS']
+SLOW_QUERY_SECONDS = global_cfg['SLOW_QUERY_SECONDS']
+REQUEST_QUERY_BUDGET = global_cfg['REQUEST_QUERY_BUDGET']
+REQUEST_TIME_BUDGET = global_cfg['REQUEST_TIME_BUDGET']
+LIST_PAGE_SIZE = global_cfg['LIST_PAGE_SIZE']
+LIST_BATCH_SIZE = global_cfg['LIST_BATCH_SIZE']
+SALE_OUTBOX = global_cfg['SALE_OUTBOX']
+OUTBOX_WORKERS = global_cfg['OUTBOX_WORKERS']
+OUTBOX_POLL_INTERVAL = global_cfg['OUTBOX_POLL_INTERVAL']
+OUTBOX_MAX_ATTEMPTS = global_cfg['OUTBOX_MAX_ATTEMPTS']
+OUTBOX_BACKOFF = global_cfg['OUTBOX_BACKOFF']
+OUTBOX_BACKOFF_MAX = global_cfg['OUTBOX_BACKOFF_MAX']
+OUTBOX_CLAIM_TIMEOUT = global_cfg['OUTBOX_CLAIM_TIMEOUT']
+SALE_BATCH_WINDOW = global_cfg['SALE_BATCH_WINDOW']
+SALE_BATCH_MAX = global_cfg['SALE_BATCH_MAX']
+CART_MAX_QUANTITY = global_cfg['CART_MAX_QUANTITY']
 TIMEOUT = global_cfg['TIMEOUT']
-BASE_URL = global_cfg['BASE_URL']
+SQLITE_PRAGMAS = global_cfg['SQLITE_PRAGMAS']
+SQLITE_POOL_SIZE = global_cfg['SQLITE_POOL_SIZE']
+SQLITE_MAX_OVERFLOW = global_cfg['SQLITE_MAX_OVERFLOW']
+BASE_URL = os.environ.get('STREEPLIJST_BASE_URL', global_cfg['BASE_URL'])  # Override e.g. to use a stand-in
 BASE_HEADER = global_cfg['BASE_HEADER']
+POOL_SIZE = global_cfg['POOL_SIZE']
+RETRIES = global_cfg['RETRIES']
+BACKOFF_FACTOR = global_cfg['BACKOFF_FACTOR']
+ENDPOINT_TIMEOUTS = global_cfg['ENDPOINT_TIMEOUTS']
+API_LATENCY_BUCKETS = global_cfg['API_LATENCY_BUCKETS']
+API_CACHE = global_cfg['API_CACHE']
+API_CACHE_TTL = global_cfg['API_CACHE_TTL']
+API_CACHE_MAX_SIZE = global_cfg['API_CACHE_MAX_SIZE']
+API_CACHE_FOLDER = INSTANCE_FOLDER / 'api_cache'
 
 ###########################
 # Sensitive configuration #
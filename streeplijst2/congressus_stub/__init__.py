@@ -0,0 +1,327 @@
+"""
+Local stand-in for the parts of the Congressus API which are used by streeplijst2.api. It serves the products, members
+and sales endpoints from YAML fixtures, so the tests and benchmarks can run without network access and without charging
+real accounts. Latency, random server errors and specific errors can be injected, and all requests are recorded so they
+can be saved and replayed later.
+
+Point config.yaml BASE_URL (or the STREEPLIJST_BASE_URL environment variable) at the URL of a running stand-in to use
+it.
+"""
+import hashlib
+import itertools
+import json
+import random
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+import yaml
+from flask import Flask, Response, request
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+FIXTURES_PATH = Path(__file__).resolve().parent / 'fixtures.yaml'
+
+ENDPOINTS = ('products', 'product', 'members', 'sales')  # Endpoint names, equal to the names used by api.py
+
+
+class _RequestHandler(WSGIRequestHandler):
+    disable_nagle_algorithm = True  # Headers and body are written separately, do not let them wait for an ACK
+
+    def log(self, type, message, *args):
+        pass  # Do not log every request
+
+
+class CongressusStub:
+    """
+    Congressus stand-in server. Use start() to serve it from a background thread, or use the Flask app in self.app
+    directly.
+    """
+
+    def __init__(self, fixtures: Path = FIXTURES_PATH, latency=0, error_rate: float = 0, seed: int = None,
+                 replay: Path = None):
+        """
+        Instantiates a CongressusStub object.
+
+        :param fixtures: YAML file with the MEMBERS, FOLDERS and PRODUCTS to serve. Defaults to fixtures.yaml.
+        :param latency: Nr of seconds every request takes, or a dict with the nr of seconds per endpoint.
+        :param error_rate: Fraction of the requests which is answered with a 503 (Service Unavailable).
+        :param seed: (optional) Seed for the random errors, to make a run reproducible.
+        :param replay: (optional) Recording created with save_recording(). If given, every request is answered with
+        the recorded response for the same request instead of with the fixtures.
+        """
+        with open(fixtures) as file:
+            data = yaml.safe_load(file)
+        self.members = dict((member['id'], member) for member in data['MEMBERS'])
+        self.folders = dict(data['FOLDERS'])
+        self.products = dict((product['id'], product) for product in data['PRODUCTS'])
+
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.requests = []  # Recorded requests and responses
+        self.sales = []  # Sales which were posted
+
+        self._lock = threading.Lock()  # Protects all mutable state below and above
+        self._injected = dict()  # Lists of errors to return for the next requests, by endpoint
+        self._sale_ids = itertools.count(1)
+        self._replay = None
+        if replay is not None:
+            self.load_recording(replay)
+
+        self._server = None
+        self._thread = None
+        self.app = self._create_app()
+
+    ###################
+    # Test controls   #
+    ###################
+
+    def add_members(self, n: int, first_id: int = 600000) -> list:
+        """
+        Add generated members, e.g. to load test logins of many different members.
+
+        :param n: Nr of members to add.
+        :param first_id: ID of the first member. The student numbers are 's' + id.
+        :return: A list of the student numbers of the new members.
+        """
+        with self._lock:
+            for id in range(first_id, first_id + n):
+                self.members[id] = dict(id=id, username='s%d' % id, first_name='Member', primary_last_name_prefix=None,
+                                        primary_last_name_main=str(id), date_of_birth='2000-01-01',
+                                        has_sdd_mandate=True, profile_picture=None)
+        return ['s%d' % id for id in range(first_id, first_id + n)]
+
+    def add_products(self, folder_id: int, n: int, first_id: int = 900000, price: int = 50) -> list:
+        """
+        Add generated products to a folder, e.g. to benchmark the synchronization of large folders.
+
+        :param folder_id: Folder to add the products to. It must be in the fixtures.
+        :param n: Nr of products to add.
+        :param first_id: ID of the first product.
+        :param price: Price of every product in cents.
+        :return: A list of the ids of the new products.
+        """
+        with self._lock:
+            for id in range(first_id, first_id + n):
+                self.products[id] = dict(id=id, name='Product %d' % id, price=price, published=True,
+                                         folder_id=folder_id)
+        return list(range(first_id, first_id + n))
+
+    def inject(self, endpoint: str, error, count: int = 1) -> None:
+        """
+        Answer the next requests to an endpoint with an error.
+
+        :param endpoint: 'products', 'product', 'members' or 'sales'.
+        :param error: HTTP status code to return, or 'mandate' to return the mandate error of Congressus (sales only).
+        :param count: Nr of requests to answer with this error.
+        """
+        if endpoint not in ENDPOINTS:
+            raise ValueError('Unknown endpoint %s' % endpoint)
+        with self._lock:
+            self._injected.setdefault(endpoint, []).extend([error] * count)
+
+    def reset(self) -> None:
+        """
+        Remove all recorded requests, posted sales and injected errors.
+        """
+        with self._lock:
+            self.requests = []
+            self.sales = []
+            self._injected = dict()
+
+    def count(self, endpoint: str = None) -> int:
+        """
+        Return the nr of recorded requests.
+
+        :param endpoint: (optional) Only count the requests to this endpoint.
+        :return: The nr of requests.
+        """
+        with self._lock:
+            return sum(1 for req in self.requests if endpoint is None or req['endpoint'] == endpoint)
+
+    def save_recording(self, path: Path) -> None:
+        """
+        Save all recorded requests and responses as JSON lines.
+
+        :param path: File to write.
+        """
+        with self._lock:
+            recorded = list(self.requests)
+        with open(path, 'w') as file:
+            for req in recorded:
+                file.write(json.dumps(req) + '\n')
+
+    def load_recording(self, path: Path) -> None:
+        """
+        Replay a recording: every request is answered with the response which was recorded for the same request. If the
+        same request was recorded multiple times, the responses are returned in the recorded order.
+
+        :param path: Recording created with save_recording().
+        """
+        replay = dict()
+        with open(path) as file:
+            for line in file:
+                req = json.loads(line)
+                replay.setdefault(self._replay_key(req['method'], req['url'], req['json']), []).append(req)
+        with self._lock:
+            self._replay = replay
+
+    @staticmethod
+    def _replay_key(method: str, url: str, payload) -> tuple:
+        return method, url, json.dumps(payload, sort_keys=True)
+
+    ###################
+    # Server          #
+    ###################
+
+    def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        """
+        Serve the stand-in from a background thread.
+
+        :param host: Host to listen on.
+        :param port: Port to listen on. Defaults to a free port.
+        :return: The base URL of the server, to use as BASE_URL.
+        """
+        self._server = make_server(host, port, self.app, threaded=True, request_handler=_RequestHandler)
+        self._thread = threading.Thread(target=self._server.serve_forever, name='congressus-stub', daemon=True)
+        self._thread.start()
+        return self.url
+
+    def stop(self) -> None:
+        """
+        Stop the server started by start().
+        """
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+    @property
+    def url(self) -> str:
+        """Base URL of the running server."""
+        return 'http://%s:%d' % (self._server.host, self._server.port)
+
+    ###################
+    # Endpoints       #
+    ###################
+
+    def _create_app(self) -> Flask:
+        app = Flask(__name__)
+
+        @app.route('/products')
+        def products():
+            return self._handle('products', self._get_products)
+
+        @app.route('/products/<int:product_id>')
+        def product(product_id):
+            return self._handle('product', self._get_product, product_id)
+
+        @app.route('/members')
+        def members():
+            return self._handle('members', self._get_members)
+
+        @app.route('/sales', methods=('POST',))
+        def sales():
+            return self._handle('sales', self._post_sale)
+
+        return app
+
+    def _handle(self, endpoint: str, func, *args) -> Response:
+        """
+        Answer a request: wait for the latency, return an injected, random or replayed response if there is one and
+        call func otherwise. The request and response are recorded.
+        """
+        latency = self.latency.get(endpoint, 0) if isinstance(self.latency, dict) else self.latency
+        if latency:
+            time.sleep(latency)
+
+        url = request.full_path.rstrip('?')
+        payload = request.get_json(silent=True)
+        with self._lock:
+            injected = self._injected.get(endpoint)
+            error = injected.pop(0) if injected else None
+            replayed = None
+            if self._replay is not None:
+                recorded = self._replay.get(self._replay_key(request.method, url, payload))
+                replayed = recorded.pop(0) if recorded else None
+            random_error = self.error_rate > 0 and self.random.random() < self.error_rate
+
+        if replayed is not None:
+            (status, body) = (replayed['status'], replayed['response'])
+        elif self._replay is not None:
+            (status, body) = (501, dict(message='Request is not in the recording'))
+        elif error == 'mandate':
+            (status, body) = (404, dict(message='Member has no signed mandate for direct debit'))
+        elif error is not None:
+            (status, body) = (error, dict(message='Injected error'))
+        elif random_error:
+            (status, body) = (503, dict(message='Random error'))
+        else:
+            (status, body) = func(*args)
+
+        with self._lock:
+            self.requests.append(dict(method=request.method, endpoint=endpoint, url=url, json=payload, status=status,
+                                      response=body))
+
+        text = json.dumps(body)
+        response = Response(text, status=status, mimetype='application/json')
+        if request.method == 'GET' and status == 200:  # Congressus-like caching headers, see api.ResponseCache
+            response.set_etag(hashlib.md5(text.encode('utf-8')).hexdigest())
+            response.make_conditional(request)  # Returns a 304 if the If-None-Match header matches
+        return response
+
+    def _product_dict(self, product: dict) -> dict:
+        media = product.get('media')
+        return dict(id=product['id'], name=product['name'], price=str(product['price']),
+                    published=product['published'], folder_id=product['folder_id'],
+                    folder=self.folders.get(product['folder_id']), media=[dict(url=media)] if media else [])
+
+    def _get_products(self) -> tuple:
+        folder_id = request.args.get('folder_id', type=int)
+        with self._lock:
+            products = [self._product_dict(product) for product in self.products.values()
+                        if folder_id is None or product['folder_id'] == folder_id]
+        return 200, products  # Congressus returns an empty list for an unknown folder
+
+    def _get_product(self, product_id: int) -> tuple:
+        with self._lock:
+            product = self.products.get(product_id)
+        if product is None:
+            return 404, dict(message='Product %d not found' % product_id)
+        return 200, self._product_dict(product)
+
+    def _get_members(self) -> tuple:
+        username = request.args.get('username')
+        page = request.args.get('page', type=int)
+        page_size = request.args.get('page_size', 100, type=int)
+        with self._lock:
+            members = [dict(member) for (_, member) in sorted(self.members.items())
+                       if username is None or member['username'] == username]
+        if page is not None:  # Pages are sorted by id, a page after the last member is empty
+            members = members[(page - 1) * page_size:page * page_size]
+        return 200, members  # Congressus returns an empty list for an unknown username
+
+    def _post_sale(self) -> tuple:
+        payload = request.get_json()
+        with self._lock:
+            member = self.members.get(payload.get('user_id'))
+            if member is None:
+                return 404, dict(message='Member %s not found' % payload.get('user_id'))
+            if member['has_sdd_mandate'] is not True:
+                return 404, dict(message='Member has no signed mandate for direct debit')
+
+            items = []
+            for item in payload['items']:
+                product = self.products.get(item['product_id'])
+                if product is None:
+                    return 404, dict(message='Product %s not found' % item['product_id'])
+                items.append(dict(product_id=product['id'], quantity=item['quantity'], price=str(product['price']),
+                                  total_price=str(product['price'] * item['quantity'])))
+
+            sale_id = next(self._sale_ids)
+            sale = dict(id=sale_id, reference='STUB%d' % sale_id, user_id=member['id'], items=items,
+                        payments=payload.get('payments', []), created=datetime.now().isoformat(), modified='')
+            self.sales.append(sale)
+        return 201, sale
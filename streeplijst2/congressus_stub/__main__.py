@@ -0,0 +1,46 @@
+"""
+Run the Congressus stand-in server.
+
+Usage: python -m streeplijst2.congressus_stub [--port PORT] [--latency SECONDS] [--error-rate FRACTION] [--seed SEED]
+                                             [--fixtures FILE] [--record FILE] [--replay FILE]
+
+Start the app against it with: STREEPLIJST_BASE_URL=http://127.0.0.1:PORT flask run
+"""
+import signal
+import threading
+from argparse import ArgumentParser
+
+from streeplijst2.congressus_stub import CongressusStub, FIXTURES_PATH
+
+
+def main() -> None:
+    parser = ArgumentParser(description='Run the Congressus stand-in server.')
+    parser.add_argument('--host', default='127.0.0.1', help='Host to listen on')
+    parser.add_argument('--port', type=int, default=5050, help='Port to listen on')
+    parser.add_argument('--latency', type=float, default=0, help='Nr of seconds every request takes')
+    parser.add_argument('--error-rate', type=float, default=0, help='Fraction of requests answered with a 503')
+    parser.add_argument('--seed', type=int, default=None, help='Seed for the random errors')
+    parser.add_argument('--fixtures', default=FIXTURES_PATH, help='YAML file with members, folders and products')
+    parser.add_argument('--record', default=None, help='Save all requests and responses to this file on exit')
+    parser.add_argument('--replay', default=None, help='Answer requests with the responses in this recording')
+    args = parser.parse_args()
+
+    stub = CongressusStub(fixtures=args.fixtures, latency=args.latency, error_rate=args.error_rate, seed=args.seed,
+                          replay=args.replay)
+    print('Congressus stand-in running on %s' % stub.start(host=args.host, port=args.port))
+
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+    try:
+        stopped.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stub.stop()
+        if args.record is not None:
+            stub.save_recording(args.record)
+            print('Saved %d requests to %s' % (len(stub.requests), args.record))
+
+
+if __name__ == '__main__':
+    main()
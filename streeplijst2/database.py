@@ -1,9 +1,29 @@
-from streeplijst2.models import User
+from streeplijst2.models import User, SyncRun
 from streeplijst2.extensions import db
+from streeplijst2.config import LIST_PAGE_SIZE, LIST_BATCH_SIZE, LOGIN_FRESHNESS, LOGIN_NOT_FOUND_TTL, \
+    LOGIN_NOT_FOUND_MAX, ROSTER_PAGE_SIZE, ROSTER_SYNC_INTERVAL, ROSTER_MIN_SEEN
+import streeplijst2.api as api
+import streeplijst2.background as background
+import streeplijst2.singleflight as singleflight
 
-from sqlalchemy import asc
+from flask import current_app
 
-from datetime import datetime
+from sqlalchemy import and_, asc, bindparam, desc, literal, or_, select, tuple_
+from sqlalchemy.orm.util import identity_key
+
+import base64
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+# Max nr of ids in a single SELECT ... WHERE id IN (...), SQLite allows at most 999 parameters per statement
+SELECT_CHUNK_SIZE = 500
 
 
 def init_database(config=None) -> None:
@@ -15,7 +35,424 @@ def init_database(config=None) -> None:
     pass  # It is not needed to initialize any models from this module
 
 
+@contextmanager
+def transaction():
+    """
+    Context manager which turns all *DB calls inside it into a single unit of work: the calls flush their changes
+    instead of committing them, and everything is committed once at the end of the block. If the block raises an
+    exception, all changes are rolled back. Nested blocks join the outermost block.
+
+    Example::
+
+        with transaction():
+            SaleDB.update(id=1, status=Sale.STATUS_OK)
+            SaleDB.update(id=2, status=Sale.STATUS_OK)  # Both sales are committed here, in a single transaction
+
+    :return: The database session.
+    """
+    info = db.session.info  # Per session, so every thread and app context has its own unit of work
+    info['transaction_depth'] = info.get('transaction_depth', 0) + 1
+    outermost = info['transaction_depth'] == 1
+    try:
+        yield db.session
+        if outermost:
+            db.session.commit()
+    except BaseException:
+        if outermost:
+            db.session.rollback()
+        raise
+    finally:
+        info['transaction_depth'] -= 1
+
+
+def commit() -> None:
+    """
+    Commit the session, or only flush it if this is called inside a transaction() block. All *DB write methods end with
+    this call instead of db.session.commit().
+    """
+    if db.session.info.get('transaction_depth', 0) > 0:
+        db.session.flush()  # Send the changes to the database, the transaction() block commits them
+    else:
+        db.session.commit()
+
+
+def require_no_transaction(action: str) -> None:
+    """
+    Make sure no transaction() block is open. Writes which other processes must see at once (e.g. taking a lease or
+    claiming a sale) commit on their own, so inside a block they would also commit the unfinished changes of the block.
+
+    :param action: Description of the write, used in the error message.
+    :raises RuntimeError: If this is called inside a transaction() block.
+    """
+    if db.session.info.get('transaction_depth', 0) > 0:
+        raise RuntimeError('Cannot %s inside a transaction() block, since it commits on its own' % action)
+
+
+def partial_update(model, id: int, values: dict, timestamp: str = None, only_changed: bool = False) -> bool:
+    """
+    Write some columns of a row with a single UPDATE statement, without loading the row first. If the row is loaded in
+    the session, the written attributes are expired so they are loaded again when they are used.
+
+    :param model: The model class, e.g. User.
+    :param id: The primary key of the row.
+    :param values: The columns to write and their new values.
+    :param timestamp: (optional) Name of a column which is set to the current time when the row is written.
+    :param only_changed: When set to True, the row is only written if at least one of the values differs from the
+    stored value.
+    :return: True if the row was written.
+    """
+    if not values:
+        return False
+
+    table = model.__table__
+    statement = table.update().where(table.c.id == id)
+    if only_changed:
+        changed = [table.c[column].is_distinct_from(value) for (column, value) in values.items()]
+        statement = statement.where(or_(*changed))
+    written = dict(values, **{timestamp: datetime.now()}) if timestamp is not None else values
+    result = db.session.execute(statement.values(**written))
+
+    instance = db.session.identity_map.get(identity_key(model, id))
+    if instance is not None:  # The stored attributes of this instance no longer match the database
+        db.session.expire(instance, list(written.keys()))
+    commit()
+    return result.rowcount == 1
+
+
+class Page:
+    """
+    One page of a Listing.
+    """
+
+    def __init__(self, items: list, next_cursor: str = None):
+        """
+        Instantiates a Page object.
+
+        :param items: The rows on this page.
+        :param next_cursor: Cursor of the next page, or None if this is the last page.
+        """
+        self.items = items
+        self.next_cursor = next_cursor
+
+    @property
+    def has_next(self) -> bool:
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __repr__(self):
+        return '<Page of %d rows, next cursor %s>' % (len(self.items), self.next_cursor)
+
+
+class Listing:
+    """
+    A sorted and filtered listing of the rows of a model, which can be loaded completely, one page at a time or as a
+    stream. Pages use keyset pagination: the cursor holds the sort value and id of the last row of a page, and the next
+    page starts right after that row. Unlike OFFSET, this is as fast for the last page as for the first, and rows which
+    are added in the meantime do not shift the pages.
+
+    Example::
+
+        page = SaleDB.listing(sort='created', descending=True, status=Sale.STATUS_FAILED).page(limit=20)
+        next_page = SaleDB.listing(sort='created', descending=True, status=Sale.STATUS_FAILED).page(page.next_cursor)
+    """
+
+    def __init__(self, model, sort: str = 'id', descending: bool = False, since: datetime = None,
+                 until: datetime = None, sort_fields: tuple = ('id',), **filters):
+        """
+        Instantiates a Listing object.
+
+        :param model: The model class, e.g. User.
+        :param sort: Column to sort by. Rows with the same value are sorted by id. Rows with a NULL value come first in
+        ascending order and last in descending order, like SQLite sorts NULL before any other value.
+        :param descending: When set to True, the rows are sorted in descending order.
+        :param since: (optional) Only list rows which were created at or after this time.
+        :param until: (optional) Only list rows which were created before this time.
+        :param sort_fields: The columns which may be used as sort column.
+        :param filters: Only list rows of which these columns are equal to these values. If a value is a list, tuple or
+        set, the column must be equal to one of its values.
+        """
+        if sort not in sort_fields:
+            raise ValueError('Cannot sort %s by %s, sort by one of %s' % (model.__name__, sort, ', '.join(sort_fields)))
+        table = model.__table__
+        for column in filters.keys():
+            if column not in table.c:
+                raise ValueError('%s has no column %s to filter by' % (model.__name__, column))
+
+        self.model = model
+        self.descending = descending
+        self._sort_column = table.c[sort]
+        self._id_column = table.c.id
+
+        query = model.query
+        for (column, value) in filters.items():
+            if isinstance(value, (list, tuple, set)):
+                query = query.filter(table.c[column].in_(list(value)))
+            else:
+                query = query.filter(table.c[column] == value)
+        if since is not None:
+            query = query.filter(table.c.created >= since)
+        if until is not None:
+            query = query.filter(table.c.created < until)
+        self._query = query
+
+    def query(self):
+        """
+        Return the sorted and filtered query.
+        """
+        order = desc if self.descending else asc
+        if self._sort_column is self._id_column:
+            return self._query.order_by(order(self._id_column))
+        return self._query.order_by(order(self._sort_column), order(self._id_column))
+
+    def all(self) -> list:
+        """
+        Load all rows at once. Use page() or stream() for tables which can grow large.
+
+        :return: A List of all rows.
+        """
+        return self.query().all()
+
+    def page(self, cursor: str = None, limit: int = LIST_PAGE_SIZE) -> Page:
+        """
+        Load a single page of rows.
+
+        :param cursor: (optional) The next_cursor of the previous page. If not given, the first page is loaded.
+        :param limit: Max nr of rows on the page.
+        :return: The page.
+        """
+        query = self.query()
+        if cursor is not None:
+            (value, id) = self._decode_cursor(cursor)
+            if self._sort_column is self._id_column:
+                after = self._id_column < id if self.descending else self._id_column > id
+            else:
+                after = self._after(value, id)
+            query = query.filter(after)
+
+        rows = query.limit(limit + 1).all()  # One extra row to find out if there is a next page
+        if len(rows) <= limit:
+            return Page(rows)
+        rows = rows[:limit]
+        return Page(rows, self._encode_cursor(rows[-1]))
+
+    def stream(self, batch_size: int = LIST_BATCH_SIZE):
+        """
+        Iterate over all rows, while only loading batch_size rows from the database at a time. Rows which were yielded
+        earlier are not kept in memory by the listing. The session must not be committed or rolled back during the
+        iteration.
+
+        :param batch_size: Nr of rows to load at a time.
+        :return: An iterator of rows.
+        """
+        return iter(self.query().yield_per(batch_size))
+
+    def _after(self, value, id: int):
+        """
+        Return the condition for the rows after the row with this sort value and id. A comparison with NULL is never
+        true, so the rows with a NULL sort value (which come before all other rows) are handled separately.
+        """
+        is_null = self._sort_column.is_(None)
+        if value is None:  # The last row had a NULL value, so the rest of the NULL rows and (ascending) all other rows
+            same_value = and_(is_null, self._id_column < id if self.descending else self._id_column > id)
+            return same_value if self.descending else or_(same_value, self._sort_column.isnot(None))
+
+        last = tuple_(literal(value, self._sort_column.type), literal(id, self._id_column.type))
+        columns = tuple_(self._sort_column, self._id_column)
+        if self.descending:
+            return or_(columns < last, is_null)  # The NULL rows come after all other rows
+        return columns > last  # Never true for the NULL rows, which come before all other rows
+
+    def _encode_cursor(self, row) -> str:
+        value = getattr(row, self._sort_column.key)
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        return base64.urlsafe_b64encode(json.dumps([value, row.id]).encode('utf-8')).decode('ascii')
+
+    def _decode_cursor(self, cursor: str) -> tuple:
+        try:
+            (value, id) = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+            if value is not None and isinstance(self._sort_column.type, db.DateTime):
+                value = datetime.fromisoformat(value)
+        except (ValueError, TypeError):
+            raise ValueError('Invalid cursor %s' % cursor)
+        return value, id
+
+
+class SyncDiff:
+    """
+    Result of a synchronization of rows (e.g. items or users) with the API.
+    """
+
+    def __init__(self, added: list = None, changed: list = None, removed: list = None, unchanged: int = 0):
+        """
+        Instantiates a SyncDiff object.
+
+        :param added: IDs of the rows which were not stored yet.
+        :param changed: IDs of the stored rows of which at least one field changed.
+        :param removed: IDs of the stored rows which are no longer returned by the API.
+        :param unchanged: Nr of stored rows which did not change.
+        """
+        self.added = added if added is not None else list()
+        self.changed = changed if changed is not None else list()
+        self.removed = removed if removed is not None else list()
+        self.unchanged = unchanged
+
+    @property
+    def has_changes(self) -> bool:
+        """True if any row was added, changed or removed."""
+        return bool(self.added or self.changed or self.removed)
+
+    def counts(self) -> dict:
+        """
+        Return the nr of rows per category.
+
+        :return: A dict with the nr of 'added', 'changed', 'removed' and 'unchanged' rows.
+        """
+        return dict(added=len(self.added), changed=len(self.changed), removed=len(self.removed),
+                    unchanged=self.unchanged)
+
+    def __repr__(self):
+        return '<SyncDiff added=%d changed=%d removed=%d unchanged=%d>' % (
+            len(self.added), len(self.changed), len(self.removed), self.unchanged)
+
+
+def bulk_upsert(model, rows: list, fields: tuple, extra: dict = None) -> tuple:
+    """
+    Insert or update many rows without loading them as instances. The stored rows are loaded with one SELECT per
+    SELECT_CHUNK_SIZE rows and compared field by field with the new values. New rows are inserted with a single
+    executemany INSERT and changed rows are updated with a single executemany UPDATE. The changes are not committed, so
+    the caller can add its own changes and commit everything at once.
+
+    :param model: The model class, e.g. Item. It must have an id, a created and an updated column.
+    :param rows: Dicts with the id and the fields of every row, e.g. as returned by the API.
+    :param fields: Names of the fields which are compared and written.
+    :param extra: (optional) Columns and values which are written to every row, including the rows which did not
+    change. If not given, rows which did not change are not written at all.
+    :return: A (SyncDiff, stored) tuple. The SyncDiff holds the added and changed ids, stored holds the previously
+    stored values of the fields by id.
+    """
+    table = model.__table__
+    columns = [table.c[field] for field in fields]
+    extra = extra if extra is not None else dict()
+    new_rows = {row['id']: row for row in rows}  # If an id occurs twice, the last one is used
+
+    # Load the currently stored values of all rows in a few queries
+    ids = list(new_rows.keys())
+    stored = dict()
+    for start in range(0, len(ids), SELECT_CHUNK_SIZE):
+        query = select([table.c.id] + columns).where(table.c.id.in_(ids[start:start + SELECT_CHUNK_SIZE]))
+        for row in db.session.execute(query):
+            stored[row[0]] = tuple(row[1:])
+
+    # Sort the rows in new, changed and unchanged rows
+    diff = SyncDiff()
+    now = datetime.now()
+    inserts = []
+    updates = []
+    unchanged = []
+    for (id, row) in new_rows.items():
+        values = dict((field, row.get(field)) for field in fields)
+        if id not in stored:
+            inserts.append(dict(values, id=id, created=now, updated=now, **extra))
+            diff.added.append(id)
+        elif stored[id] != tuple(values.values()):
+            updates.append(dict(values, row_id=id, updated=now, **extra))
+            diff.changed.append(id)
+        else:
+            unchanged.append(id)
+            diff.unchanged += 1
+
+    if inserts:
+        db.session.execute(table.insert(), inserts)
+    if updates:
+        db.session.execute(table.update().where(table.c.id == bindparam('row_id')), updates)
+    _expire(model, diff.changed)
+    if extra:
+        bulk_update(model, unchanged, extra)
+    return diff, stored
+
+
+def bulk_update(model, ids: list, values: dict) -> None:
+    """
+    Write the same values to many rows, with one UPDATE per SELECT_CHUNK_SIZE rows. The changes are not committed.
+
+    :param model: The model class, e.g. User.
+    :param ids: The primary keys of the rows.
+    :param values: The columns to write and their new values.
+    """
+    table = model.__table__
+    for start in range(0, len(ids), SELECT_CHUNK_SIZE):
+        db.session.execute(table.update().where(table.c.id.in_(ids[start:start + SELECT_CHUNK_SIZE])).values(**values))
+    _expire(model, ids)
+
+
+def _expire(model, ids: list) -> None:
+    for id in ids:
+        instance = db.session.identity_map.get(identity_key(model, id))
+        if instance is not None:  # The stored attributes of this instance no longer match the database
+            db.session.expire(instance)
+
+
+class NegativeCache:
+    """
+    Bounded set of keys which were looked up and not found, e.g. mistyped student numbers. Every key is remembered for
+    ttl seconds. When the cache is full, the key which was added first is forgotten. A single cache may be shared
+    between threads.
+    """
+
+    def __init__(self, ttl: float = LOGIN_NOT_FOUND_TTL, max_size: int = LOGIN_NOT_FOUND_MAX):
+        """
+        Instantiates a NegativeCache object.
+
+        :param ttl: Nr of seconds a key is remembered.
+        :param max_size: Max nr of keys which are remembered.
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()  # Protects _expires
+        self._expires = OrderedDict()  # time.monotonic() at which each key is forgotten, oldest first
+
+    def add(self, key) -> None:
+        """
+        Remember a key as not found.
+        """
+        with self._lock:
+            self._expires.pop(key, None)  # Move the key to the end
+            self._expires[key] = time.monotonic() + self.ttl
+            while len(self._expires) > self.max_size:
+                self._expires.popitem(last=False)
+
+    def discard(self, key) -> None:
+        """
+        Forget a key, e.g. because it was found after all.
+        """
+        with self._lock:
+            self._expires.pop(key, None)
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            expires = self._expires.get(key)
+            if expires is not None and expires <= time.monotonic():
+                del self._expires[key]
+                return False
+            return expires is not None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._expires)
+
+
 class UserDB:
+    UPDATE_FIELDS = ('s_number', 'first_name', 'last_name_prefix', 'last_name', 'date_of_birth', 'has_sdd_mandate',
+                     'profile_picture')  # Fields which can be changed with update()
+    SORT_FIELDS = ('id', 's_number', 'last_name', 'created')  # Fields which users can be sorted by
+    SYNC_FIELDS = UPDATE_FIELDS  # Fields which are synchronized with the roster
+    ROSTER_RUN = 'roster'  # Name of the roster synchronization in the sync_runs table
 
     @classmethod
     def create(cls, id: int, s_number: str, first_name: str, last_name: str, date_of_birth: datetime,
@@ -44,33 +481,192 @@ class UserDB:
                         last_name=last_name, date_of_birth=date_of_birth, has_sdd_mandate=has_sdd_mandate,
                         profile_picture=profile_picture)
         db.session.add(new_user)
-        db.session.commit()
+        commit()
         return new_user
 
+    @classmethod
+    def sync_user(cls, s_number: str, timeout: float = None) -> User:
+        """
+        Fetch a user from the API and store it in the database. If another thread is already fetching this user (e.g.
+        when a login form is submitted twice), wait for it instead of fetching and storing the same user again.
+
+        :param s_number: Student or Employee number (Congressus user name).
+        :param timeout: Timeout for the API request in seconds (defaults to the API endpoint timeout).
+        :return: The stored user.
+        """
+
+        def fetch_and_store():
+            user = cls.create(**api.get_user(s_number=s_number, timeout=timeout))
+            if user.removed is not None:  # The user is a member again
+                partial_update(User, user.id, dict(removed=None))
+                commit()
+            return user.id  # Only the id leaves this session
+
+        return cls.get(singleflight.do(('sync_user', s_number), fetch_and_store))
+
+    @classmethod
+    def bulk_upsert(cls, users: list) -> SyncDiff:
+        """
+        Insert or update many users in a single transaction with the bulk_upsert() function. Of the users which did not
+        change, only the synchronized time is written. Users which were removed before are no longer marked as removed.
+
+        :param users: List of user dicts as returned by api.get_members().
+        :return: A SyncDiff with the added and changed user ids.
+        """
+        (diff, _) = bulk_upsert(User, users, cls.SYNC_FIELDS, extra=dict(synchronized=datetime.now(), removed=None))
+        commit()  # Store all changes in one transaction
+        return diff
+
+    @classmethod
+    def sync_roster(cls, page_size: int = ROSTER_PAGE_SIZE, timeout: float = None,
+                    min_seen: float = ROSTER_MIN_SEEN) -> SyncDiff:
+        """
+        Synchronize all members of Congressus with the users table, so logins can be answered from the database. The
+        members are requested one page at a time and every page is stored in its own transaction with bulk_upsert().
+        The pages are requested through the response cache, so on later runs a page which did not change costs a 304
+        without a body, and only the users which changed are written. The pages are requested until an empty page,
+        since the API may return fewer members per page than requested.
+
+        :param page_size: Nr of members per page (defaults to ROSTER_PAGE_SIZE).
+        :param timeout: Timeout for every API request in seconds (defaults to the API endpoint timeout).
+        :param min_seen: Min fraction of the stored users which must be seen before the others are marked as removed
+        (defaults to ROSTER_MIN_SEEN). If fewer were seen, the API probably returned an incomplete roster.
+        :return: A SyncDiff with the added, changed and removed user ids. Removed users are not deleted, since sales may
+        still refer to them, but they are marked as removed so they can no longer log in.
+        """
+        started = datetime.now()
+        diff = SyncDiff()
+        seen = set()
+        page = 1
+        while True:
+            members = api.get_members(page=page, page_size=page_size, timeout=timeout)
+            if not members:  # Past the last page
+                break
+            page_diff = cls.bulk_upsert(members)
+            diff.added.extend(page_diff.added)
+            diff.changed.extend(page_diff.changed)
+            diff.unchanged += page_diff.unchanged
+            seen.update(member['id'] for member in members)
+            page += 1
+
+        table = User.__table__  # Users stored during this run (e.g. by a login) may not be in the pages
+        query = select([table.c.id]).where(table.c.created < started).order_by(table.c.id)
+        stored = [row[0] for row in db.session.execute(query)]
+        missing = [id for id in stored if id not in seen]
+        if len(stored) - len(missing) >= min_seen * len(stored):
+            diff.removed = missing
+            cls._mark_removed(diff.removed)
+        else:  # Marking them would send the logins of most members to the API
+            logger.error('The roster contained only %d of the %d stored users, so none were marked as removed',
+                         len(stored) - len(missing), len(stored))
+
+        run = SyncRun.query.get(cls.ROSTER_RUN) or SyncRun(name=cls.ROSTER_RUN)
+        run.completed = datetime.now()  # Only stored after all pages, so a run which failed halfway is run again
+        db.session.add(run)
+        commit()
+
+        logger.info('Synchronized the roster in %d pages: %s', page - 1, diff)
+        if diff.removed:
+            logger.warning('Users %s are no longer members according to the API', diff.removed)
+        return diff
+
+    @classmethod
+    def schedule_roster_sync(cls, interval: float = ROSTER_SYNC_INTERVAL) -> bool:
+        """
+        Synchronize the roster in a background thread, unless it was synchronized less than interval seconds ago or a
+        synchronization is still running.
+
+        :param interval: Nr of seconds between two synchronizations (defaults to ROSTER_SYNC_INTERVAL).
+        :return: True if a synchronization was scheduled.
+        """
+        synchronized = cls.roster_synchronized()
+        if synchronized is not None and synchronized > datetime.now() - timedelta(seconds=interval):
+            return False
+        return background.run_once(('roster',), cls.sync_roster)
+
+    @classmethod
+    def roster_synchronized(cls) -> datetime:
+        """
+        Return when the last complete synchronization of the roster finished. The pages of a run are committed one by
+        one, so a run which failed halfway did update some users, but it does not count as a synchronization.
+
+        :return: The time of the last complete synchronization, or None if the roster was never synchronized completely.
+        """
+        return db.session.query(SyncRun.completed).filter(SyncRun.name == cls.ROSTER_RUN).scalar()
+
+    @classmethod
+    def login(cls, s_number: str, freshness: float = LOGIN_FRESHNESS, timeout: float = None) -> User:
+        """
+        Return the user to log in. A user which is stored in the database is returned without an API request. If it was
+        synchronized more than freshness seconds ago, it is refreshed from the API in a background thread. Other users,
+        and stored users which were marked as removed, are fetched from the API. Student numbers which the API did not
+        find are rejected without a request for LOGIN_NOT_FOUND_TTL seconds.
+
+        :param s_number: Student or Employee number (Congressus user name).
+        :param freshness: Nr of seconds after which a stored user is refreshed (defaults to LOGIN_FRESHNESS).
+        :param timeout: Timeout for the API request in seconds (defaults to the API endpoint timeout).
+        :return: The user.
+        :raises UserNotFoundException: If the API did not find the user, now or recently.
+        """
+        not_found = current_app.extensions['users_not_found']
+        if s_number in not_found:
+            raise api.UserNotFoundException('User %s was not found by the API recently' % s_number)
+
+        user = cls.get_by_s_number(s_number)
+        if user is not None and user.removed is None:
+            synchronized = max(user.updated, user.synchronized or datetime.min)  # By a login or by the roster
+            if synchronized < datetime.now() - timedelta(seconds=freshness):  # The user may have changed in Congressus
+                background.run_once(('user', s_number), cls._refresh, s_number, timeout=timeout)
+            return user
+
+        try:  # A removed user is asked again once per LOGIN_NOT_FOUND_TTL, in case they became a member again
+            return cls.sync_user(s_number, timeout=timeout)
+        except api.UserNotFoundException:
+            not_found.add(s_number)
+            raise
+
+    @classmethod
+    def _refresh(cls, s_number: str, timeout: float = None) -> None:
+        """
+        Fetch a stored user from the API again. Any error is logged instead of raised.
+
+        :param s_number: Student or Employee number (Congressus user name).
+        :param timeout: Timeout for the API request in seconds (defaults to the API endpoint timeout).
+        """
+        try:
+            cls.sync_user(s_number, timeout=timeout)
+        except api.UserNotFoundException:  # The user was removed from Congressus, so stop logging them in
+            logger.warning('User %s is no longer found by the API', s_number)
+            current_app.extensions['users_not_found'].add(s_number)
+            user = cls.get_by_s_number(s_number)
+            if user is not None:
+                cls._mark_removed([user.id])  # Also after the negative cache forgot them
+                commit()
+        except Exception as err:  # The stored user can still log in, it is refreshed again at the next login
+            logger.warning('Refreshing user %s failed: %s', s_number, err)
+
+    @classmethod
+    def _mark_removed(cls, ids: list) -> None:
+        """
+        Mark users as no longer a member, so login() no longer returns them without asking the API. The changes are
+        not committed.
+
+        :param ids: IDs of the removed users.
+        """
+        bulk_update(User, ids, dict(removed=datetime.now()))
+
     @classmethod
     def update(cls, id: int, **kwargs) -> User:
         """
         Update a user's data fields.
 
         :param id: The id of the user to update.
-        :param kwargs: The fields are updated with keyword arguments.
+        :param kwargs: The fields are updated with keyword arguments. Fields which are not given are not written.
         :return: The updated user.
         """
-        modified_user = User.query.get(id)
-
-        # If no kwarg is given for an attribute, set it to the already stored attribute
-        modified_user.s_number = kwargs.get('s_number', modified_user.s_number)
-        modified_user.first_name = kwargs.get('first_name', modified_user.first_name)
-        modified_user.last_name_prefix = kwargs.get('last_name_prefix', modified_user.last_name_prefix)
-        modified_user.last_name = kwargs.get('last_name', modified_user.last_name)
-        modified_user.date_of_birth = kwargs.get('date_of_birth', modified_user.date_of_birth)
-        modified_user.has_sdd_mandate = kwargs.get('has_sdd_mandate', modified_user.has_sdd_mandate)
-        modified_user.profile_picture = kwargs.get('profile_picture', modified_user.profile_picture)
-
-        modified_user.updated = datetime.now()
-        db.session.commit()
-
-        return modified_user
+        values = dict((field, kwargs[field]) for field in cls.UPDATE_FIELDS if field in kwargs)
+        partial_update(User, id, values, timestamp='updated')
+        return User.query.get(id)
 
     @classmethod
     def delete(cls, id: int) -> User:
@@ -82,19 +678,36 @@ class UserDB:
         """
         deleted_person = User.query.get(id)
         db.session.delete(deleted_person)
-        db.session.commit()
+        commit()
 
         return deleted_person
 
     @classmethod
-    def list_all(cls) -> list:
+    def list_all(cls, sort: str = 'id', descending: bool = False) -> list:
         """
         List all users.
 
+        :param sort: Field to sort by, one of SORT_FIELDS.
+        :param descending: When set to True, the users are sorted in descending order.
         :return: A List of all users.
         """
-        # TODO: Add a way to sort result differently
-        return User.query.order_by(asc(User.id)).all()
+        return cls.listing(sort=sort, descending=descending).all()
+
+    @classmethod
+    def listing(cls, sort: str = 'id', descending: bool = False, since: datetime = None, until: datetime = None,
+                **filters) -> Listing:
+        """
+        Return a sorted and filtered listing of users, which can be paginated or streamed. See Listing.
+
+        :param sort: Field to sort by, one of SORT_FIELDS.
+        :param descending: When set to True, the users are sorted in descending order.
+        :param since: (optional) Only list users which were created at or after this time.
+        :param until: (optional) Only list users which were created before this time.
+        :param filters: Only list users with these field values, e.g. has_sdd_mandate=True.
+        :return: The listing.
+        """
+        return Listing(User, sort=sort, descending=descending, since=since, until=until, sort_fields=cls.SORT_FIELDS,
+                       **filters)
 
     @classmethod
     def get(cls, id: int) -> User:
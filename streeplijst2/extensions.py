@@ -1,5 +1,49 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
 
 SQLALCHEMY_DATABASE_URI = 'sqlite:///instance/database.sqlite'
 
 db = SQLAlchemy()
+
+
+def sqlite_engine_options(uri: str, pool_size: int, max_overflow: int = 0) -> dict:
+    """
+    Return the SQLAlchemy engine options for a SQLite database file: a pool of connections which are kept open and
+    which may be used by any thread (one thread at a time), instead of a new connection for every session.
+
+    :param uri: The database URI. No options are returned for other databases or in-memory SQLite databases.
+    :param pool_size: Nr of connections which are kept open. If 0, every session opens a new connection.
+    :param max_overflow: Nr of extra connections which may be opened when all pooled connections are in use.
+    :return: The engine options, to be used as SQLALCHEMY_ENGINE_OPTIONS.
+    """
+    url = make_url(uri)
+    if url.drivername != 'sqlite' or url.database in (None, '', ':memory:') or not pool_size:
+        return dict()  # Flask-SQLAlchemy uses a StaticPool for in-memory databases and a NullPool otherwise
+    return dict(poolclass=QueuePool, pool_size=pool_size, max_overflow=max_overflow,
+                connect_args=dict(check_same_thread=False))  # The pool hands a connection to one thread at a time
+
+
+def set_sqlite_pragmas(engine: Engine, pragmas: dict) -> None:
+    """
+    Set pragmas on every new connection of a SQLite engine. Must be called before the engine connects for the first
+    time. Other engines are ignored.
+
+    :param engine: The engine.
+    :param pragmas: The pragmas and their values, e.g. {'journal_mode': 'WAL', 'synchronous': 'NORMAL'}.
+    """
+    if engine.dialect.name != 'sqlite' or not pragmas:
+        return
+
+    statements = ['PRAGMA %s = %s' % (pragma, value) for (pragma, value) in pragmas.items()]
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for statement in statements:
+                cursor.execute(statement)
+        finally:
+            cursor.close()
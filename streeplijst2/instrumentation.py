@@ -0,0 +1,174 @@
+"""
+Query instrumentation: every SQL statement which the app sends to its database is timed with the engine events
+before_cursor_execute and after_cursor_execute. The statements are recorded per Flask request, so the nr of queries,
+the total database time and the slowest statements of every request are known.
+
+Statements which take longer than SLOW_QUERY_SECONDS are logged right away. Requests which make more than
+REQUEST_QUERY_BUDGET queries or spend more than REQUEST_TIME_BUDGET seconds in the database are logged with all their
+statements when they end. Statements outside of a request (e.g. of the background synchronization or the outbox) are
+only counted.
+"""
+import heapq
+import logging
+import threading
+import time
+
+from flask import Flask, current_app, g, has_request_context, request
+from sqlalchemy import event
+
+from streeplijst2.config import SLOW_QUERY_SECONDS, REQUEST_QUERY_BUDGET, REQUEST_TIME_BUDGET
+from streeplijst2.extensions import db
+
+logger = logging.getLogger(__name__)
+
+UNMATCHED = '<unmatched>'  # Endpoint of the requests for URLs without a route, e.g. 404s
+
+
+class RequestQueries:
+    """
+    The statements of a single request, as stored in flask.g.
+    """
+    MAX_STATEMENTS = 100  # Max nr of statements which are kept per request, all statements are counted
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0
+        self.statements = []  # (seconds, statement) tuples in the order in which they were executed
+
+    def add(self, seconds: float, statement: str) -> None:
+        self.count += 1
+        self.seconds += seconds
+        if len(self.statements) < self.MAX_STATEMENTS:
+            self.statements.append((seconds, statement))
+
+    def slowest(self, n: int = 5) -> list:
+        """
+        Return the slowest statements of the request.
+
+        :param n: Max nr of statements to return.
+        :return: A list of (seconds, statement) tuples, slowest first.
+        """
+        return heapq.nlargest(n, self.statements, key=lambda recorded: recorded[0])
+
+
+class QueryStats:
+    """
+    Query instrumentation of a single app. Use get_query_stats() to get the instrumentation of the current app.
+    """
+    SLOWEST_SIZE = 10  # Nr of slowest statements of all requests which are kept for stats()
+
+    def __init__(self, app: Flask, slow_query: float = SLOW_QUERY_SECONDS, query_budget: int = REQUEST_QUERY_BUDGET,
+                 time_budget: float = REQUEST_TIME_BUDGET):
+        """
+        Instantiates a QueryStats object and starts recording the statements of the app.
+
+        :param app: The app to instrument. Its database must be initialized.
+        :param slow_query: Nr of seconds after which a single statement is logged as slow.
+        :param query_budget: Max nr of queries of a request before it is logged.
+        :param time_budget: Max nr of seconds a request may spend in the database before it is logged.
+        """
+        self.slow_query = slow_query
+        self.query_budget = query_budget
+        self.time_budget = time_budget
+        self._lock = threading.Lock()  # Protects all attributes below
+        self._requests = 0
+        self._queries = 0
+        self._seconds = 0
+        self._over_budget = 0
+        self._slow_queries = 0
+        self._background_queries = 0
+        self._background_seconds = 0
+        self._endpoints = dict()  # Dicts with the nr of requests, queries and seconds, by endpoint
+        self._slowest = []  # Heap of the slowest (seconds, statement, endpoint) tuples
+
+        with app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', self._before_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_execute)
+        event.listen(engine, 'handle_error', self._on_error)
+        app.before_request(self._start_request)
+        app.teardown_request(self._end_request)
+
+    def stats(self) -> dict:
+        """
+        Return the aggregated statistics of all requests since the app started.
+
+        :return: A dict with the nr of requests, queries and seconds spent in the database, the nr of requests over
+        budget, the nr of slow queries, the queries and seconds outside of requests, the stats per endpoint and the
+        slowest statements.
+        """
+        with self._lock:
+            return dict(requests=self._requests, queries=self._queries, db_seconds=self._seconds,
+                        over_budget=self._over_budget, slow_queries=self._slow_queries,
+                        background_queries=self._background_queries, background_seconds=self._background_seconds,
+                        endpoints=dict((endpoint, dict(stats)) for (endpoint, stats) in self._endpoints.items()),
+                        slowest=[dict(seconds=seconds, statement=statement, endpoint=endpoint)
+                                 for (seconds, statement, endpoint) in sorted(self._slowest, reverse=True)])
+
+    def _start_request(self) -> None:
+        g.request_queries = RequestQueries()
+
+    def _end_request(self, exc=None) -> None:
+        queries = g.pop('request_queries', None)
+        if queries is None:
+            return
+        endpoint = request.endpoint or UNMATCHED  # Not the path, any client could add endpoints by requesting paths
+        with self._lock:
+            self._requests += 1
+            self._queries += queries.count
+            self._seconds += queries.seconds
+            stats = self._endpoints.setdefault(endpoint, dict(requests=0, queries=0, db_seconds=0, max_queries=0))
+            stats['requests'] += 1
+            stats['queries'] += queries.count
+            stats['db_seconds'] += queries.seconds
+            stats['max_queries'] = max(stats['max_queries'], queries.count)
+            for (seconds, statement) in queries.slowest(self.SLOWEST_SIZE):
+                if len(self._slowest) < self.SLOWEST_SIZE:
+                    heapq.heappush(self._slowest, (seconds, statement, endpoint))
+                elif seconds > self._slowest[0][0]:
+                    heapq.heapreplace(self._slowest, (seconds, statement, endpoint))
+            over_budget = queries.count > self.query_budget or queries.seconds > self.time_budget
+            if over_budget:
+                self._over_budget += 1
+
+        if over_budget:
+            logger.warning('%s %s made %d queries in %.1f ms, over the budget of %d queries in %.1f ms:\n%s',
+                           request.method, request.path, queries.count, queries.seconds * 1000, self.query_budget,
+                           self.time_budget * 1000, '\n'.join('%8.2f ms  %s' % (seconds * 1000, _one_line(statement))
+                                                             for (seconds, statement) in queries.statements))
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany) -> None:
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany) -> None:
+        seconds = time.perf_counter() - conn.info['query_start'].pop()
+        queries = g.get('request_queries') if has_request_context() else None
+        if queries is not None:
+            queries.add(seconds, statement)
+        else:
+            with self._lock:
+                self._background_queries += 1
+                self._background_seconds += seconds
+
+        if seconds > self.slow_query:
+            with self._lock:
+                self._slow_queries += 1
+            logger.warning('Slow query of %.1f ms: %s', seconds * 1000, _one_line(statement))
+
+    def _on_error(self, context) -> None:
+        starts = context.connection.info.get('query_start') if context.connection is not None else None
+        if starts:
+            starts.pop()  # The statement failed, so after_cursor_execute is not called
+
+
+def _one_line(statement: str) -> str:
+    return ' '.join(statement.split())  # The statements of the ORM span multiple lines
+
+
+def get_query_stats() -> QueryStats:
+    """
+    Return the query instrumentation of the current app. Must be called from inside an app context.
+
+    :return: The query instrumentation, or None if it is disabled.
+    """
+    return current_app.extensions.get('query_stats')
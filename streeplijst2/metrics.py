@@ -0,0 +1,258 @@
+"""
+Metrics of the Congressus API calls and the sales, exposed in the Prometheus text format at /metrics together with the
+statistics of the response cache, the catalog cache and the query instrumentation.
+
+Recording a metric must not slow down the request which records it, so every thread records in its own shard without
+taking a lock. The shards are only combined when the metrics are read. The shard of a thread which ended is merged into
+a base shard, so short-lived threads (e.g. background synchronizations) do not add up.
+"""
+import bisect
+import threading
+
+from flask import current_app
+
+from streeplijst2.config import API_LATENCY_BUCKETS
+
+
+class _Shard:
+    """
+    The metrics recorded by a single thread. Only the owning thread writes to it.
+    """
+
+    def __init__(self, n_buckets: int):
+        self.n_buckets = n_buckets
+        self.counters = dict()  # Values by (name, labels) tuples, labels is a tuple of (label, value) tuples
+        self.histograms = dict()  # [bucket counts (not cumulative), sum, count] lists by (name, labels) tuples
+
+    def observe(self, key: tuple, index: int, value: float) -> None:
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [[0] * (self.n_buckets + 1), 0, 0]  # One extra bucket for +Inf
+        histogram[0][index] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+    def merge(self, other: '_Shard') -> None:
+        """
+        Add the metrics of another shard to this shard.
+        """
+        for (key, value) in list(other.counters.items()):  # Copied at once, the owner may be adding keys
+            self.counters[key] = self.counters.get(key, 0) + value
+        for (key, (buckets, total, count)) in list(other.histograms.items()):
+            histogram = self.histograms.setdefault(key, [[0] * (self.n_buckets + 1), 0, 0])
+            histogram[0] = [a + b for (a, b) in zip(histogram[0], buckets)]
+            histogram[1] += total
+            histogram[2] += count
+
+
+class _ShardOwner:
+    """
+    Stored in the thread-local data of the thread which owns a shard. The thread-local data is deleted when the thread
+    ends, so the shard is retired then.
+    """
+
+    def __init__(self, retired: list, shard: _Shard):
+        self.retired = retired
+        self.shard = shard
+
+    def __del__(self):
+        self.retired.append(self.shard)  # No lock, __del__ may be called by any thread, even one which holds the lock
+
+
+class Metrics:
+    """
+    Registry of the counters and histograms of the app. A single registry may be shared between threads.
+    """
+
+    HELP = {  # Name: (type, help text) of every metric which is recorded in the registry
+        'streeplijst_api_request_duration_seconds': ('histogram', 'Duration of the requests to the Congressus API.'),
+        'streeplijst_api_responses_total': ('counter', 'Responses of the Congressus API by status code.'),
+        'streeplijst_api_errors_total': ('counter', 'Requests to the Congressus API which failed without a response.'),
+        'streeplijst_sales_total': ('counter', 'Posted sales by their final status, retried sales are counted once.'),
+    }
+
+    def __init__(self, buckets: list = API_LATENCY_BUCKETS):
+        """
+        Instantiates a Metrics object.
+
+        :param buckets: Upper bounds in seconds of the latency histogram buckets, in increasing order.
+        """
+        self.buckets = tuple(buckets)
+        self._local = threading.local()
+        self._lock = threading.Lock()  # Protects _base and _shards, each shard is only written by its thread
+        self._base = _Shard(len(self.buckets))  # Metrics of the threads which ended
+        self._shards = set()  # Shards of the running threads
+        self._retired = []  # Shards of the threads which ended and which are not yet merged into _base
+
+    def observe_api_request(self, endpoint: str, seconds: float, status_code: int = None, error: str = None) -> None:
+        """
+        Record a request to the Congressus API.
+
+        :param endpoint: Endpoint name (e.g. 'products', 'product', 'members' or 'sales').
+        :param seconds: Duration of the request.
+        :param status_code: Status code of the response, or None if there was no response.
+        :param error: (optional) Kind of error if there was no response, e.g. 'timeout' or 'connection'.
+        """
+        shard = self._shard()
+        labels = (('endpoint', endpoint),)
+        shard.observe(('streeplijst_api_request_duration_seconds', labels), bisect.bisect_left(self.buckets, seconds),
+                      seconds)
+        if status_code is not None:
+            self._increment(shard, 'streeplijst_api_responses_total', labels + (('code', str(status_code)),))
+        if error is not None:
+            self._increment(shard, 'streeplijst_api_errors_total', labels + (('error', error),))
+
+    def count_sales(self, status: str, n: int = 1) -> None:
+        """
+        Record the outcome of posting sales. Must be called once per sale, with the final status of the sale, so not
+        for a failed post which is retried later.
+
+        :param status: The final status of the sales, one of the Sale.STATUS_* values.
+        :param n: Nr of sales with this outcome.
+        """
+        self._increment(self._shard(), 'streeplijst_sales_total', (('status', status),), n)
+
+    def render(self) -> list:
+        """
+        Return all recorded metrics in the Prometheus text format.
+
+        :return: A list of lines.
+        """
+        merged = _Shard(len(self.buckets))
+        with self._lock:
+            self._merge_retired()
+            merged.merge(self._base)
+            shards = list(self._shards)  # A shard which is retired from now on is still counted once, by its owner
+        for shard in shards:
+            merged.merge(shard)
+        (counters, histograms) = (merged.counters, merged.histograms)
+
+        lines = []
+        for (name, (metric_type, help_text)) in self.HELP.items():
+            lines += ['# HELP %s %s' % (name, help_text), '# TYPE %s %s' % (name, metric_type)]
+            if metric_type == 'counter':
+                lines += [sample(name, dict(labels), value)
+                          for ((key_name, labels), value) in sorted(counters.items()) if key_name == name]
+                continue
+            for ((key_name, labels), (buckets, total, count)) in sorted(histograms.items()):
+                if key_name != name:
+                    continue
+                cumulative = 0
+                for (bound, bucket_count) in zip(self.buckets + ('+Inf',), buckets):
+                    cumulative += bucket_count
+                    lines.append(sample(name + '_bucket', dict(labels, le=str(bound)), cumulative))
+                lines += [sample(name + '_sum', dict(labels), total), sample(name + '_count', dict(labels), count)]
+        return lines
+
+    def reset(self) -> None:
+        """
+        Forget all recorded metrics.
+        """
+        with self._lock:
+            self._merge_retired()
+            for shard in list(self._shards) + [self._base]:
+                shard.counters.clear()
+                shard.histograms.clear()
+
+    def _shard(self) -> _Shard:
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:  # The first metric of this thread
+            shard = self._local.shard = _Shard(len(self.buckets))
+            self._local.owner = _ShardOwner(self._retired, shard)
+            with self._lock:
+                self._merge_retired()  # Also when the metrics are never read, so the nr of shards stays bounded
+                self._shards.add(shard)
+        return shard
+
+    def _merge_retired(self) -> None:
+        """
+        Merge the shards of the threads which ended into the base shard. Must be called while holding the lock.
+        """
+        while self._retired:
+            shard = self._retired.pop()
+            self._base.merge(shard)
+            self._shards.discard(shard)
+
+    @staticmethod
+    def _increment(shard: _Shard, name: str, labels: tuple, n: int = 1) -> None:
+        key = (name, labels)
+        shard.counters[key] = shard.counters.get(key, 0) + n
+
+
+def sample(name: str, labels: dict, value) -> str:
+    """
+    Format a single sample in the Prometheus text format.
+
+    :param name: The metric name.
+    :param labels: The labels and their values.
+    :param value: The value.
+    :return: A line like 'name{label="value"} 1'.
+    """
+    if labels:
+        escaped = ('%s="%s"' % (label, str(label_value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                   for (label, label_value) in labels.items())
+        name = '%s{%s}' % (name, ','.join(escaped))
+    return '%s %s' % (name, repr(float(value)) if isinstance(value, float) else value)
+
+
+def family(name: str, metric_type: str, help_text: str, samples: list) -> list:
+    """
+    Format a metric with all its samples in the Prometheus text format.
+
+    :param name: The metric name.
+    :param metric_type: 'counter' or 'gauge'.
+    :param help_text: Description of the metric.
+    :param samples: A list of (labels, value) tuples.
+    :return: A list of lines.
+    """
+    return ['# HELP %s %s' % (name, help_text), '# TYPE %s %s' % (name, metric_type)] + \
+        [sample(name, labels, value) for (labels, value) in samples]
+
+
+def exposition() -> str:
+    """
+    Return the metrics of the registry and the statistics of the current app in the Prometheus text format. Must be
+    called from inside an app context.
+
+    :return: The text to serve at /metrics.
+    """
+    import streeplijst2.api as api  # Imported here, since api.py records its requests in this module
+
+    lines = registry.render()
+    if api.client.cache is not None:
+        lines += family('streeplijst_api_cache_total', 'counter', 'Lookups in the API response cache by result.',
+                        [(dict(result=result), count) for (result, count) in api.client.cache.stats().items()])
+
+    catalog = current_app.extensions.get('catalog')
+    if catalog is not None:
+        stats = catalog.stats()
+        lines += family('streeplijst_catalog_lookups_total', 'counter', 'Lookups in the catalog cache by result.',
+                        [(dict(result='hit'), stats['hits']), (dict(result='miss'), stats['misses'])])
+        lines += family('streeplijst_catalog_rebuild_seconds_total', 'counter',
+                        'Time spent rebuilding folders of the catalog cache.', [(dict(), stats['rebuild_seconds'])])
+        lines += family('streeplijst_catalog_folders', 'gauge', 'Folders in the catalog cache.',
+                        [(dict(), stats['folders'])])
+
+    query_stats = current_app.extensions.get('query_stats')
+    if query_stats is not None:
+        stats = query_stats.stats()
+        lines += family('streeplijst_db_queries_total', 'counter', 'SQL statements by Flask endpoint.',
+                        [(dict(endpoint=endpoint), endpoint_stats['queries'])
+                         for (endpoint, endpoint_stats) in sorted(stats['endpoints'].items())] +
+                        [(dict(endpoint='background'), stats['background_queries'])])
+        lines += family('streeplijst_db_seconds_total', 'counter', 'Time spent on SQL statements by Flask endpoint.',
+                        [(dict(endpoint=endpoint), endpoint_stats['db_seconds'])
+                         for (endpoint, endpoint_stats) in sorted(stats['endpoints'].items())] +
+                        [(dict(endpoint='background'), stats['background_seconds'])])
+        lines += family('streeplijst_http_requests_total', 'counter', 'Finished Flask requests by endpoint.',
+                        [(dict(endpoint=endpoint), endpoint_stats['requests'])
+                         for (endpoint, endpoint_stats) in sorted(stats['endpoints'].items())])
+        lines += family('streeplijst_db_requests_over_budget_total', 'counter',
+                        'Requests which made more queries or spent more time in the database than their budget.',
+                        [(dict(), stats['over_budget'])])
+        lines += family('streeplijst_db_slow_queries_total', 'counter',
+                        'SQL statements slower than SLOW_QUERY_SECONDS.', [(dict(), stats['slow_queries'])])
+    return '\n'.join(lines) + '\n'
+
+
+registry = Metrics()  # Shared registry used by api.py, SaleDB and the outbox
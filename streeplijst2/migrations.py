@@ -0,0 +1,116 @@
+"""
+Versioned schema migrations for existing databases. db.create_all() creates missing tables, but it does not add columns
+or indexes to tables which already exist. The migrations below do that. The schema version of a database is stored in
+the SQLite user_version pragma, and every migration which is newer than that version is applied at startup by
+create_app().
+
+Every migration must be safe to apply to a database which already has its changes (e.g. a new database created by
+db.create_all()), so it checks what exists before adding it. To change the schema, add the column or index to the model
+and add a new migration to MIGRATIONS with the next version.
+"""
+import logging
+
+from sqlalchemy import inspect
+from sqlalchemy.engine import Connection, Engine
+
+from streeplijst2.extensions import db
+
+logger = logging.getLogger(__name__)
+
+
+def _add_columns(connection: Connection, table: str, columns: dict) -> None:
+    """
+    Add columns to a table if they do not exist yet.
+
+    :param connection: The connection to use.
+    :param table: The table name.
+    :param columns: The column names and their SQL definitions, e.g. {'attempts': 'INTEGER'}.
+    """
+    existing = set(column['name'] for column in inspect(connection).get_columns(table))
+    for (name, definition) in columns.items():
+        if name not in existing:
+            connection.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table, name, definition))
+
+
+def _create_indexes(connection: Connection, *names: str) -> None:
+    """
+    Create indexes which are declared on the models if they do not exist yet.
+
+    :param connection: The connection to use.
+    :param names: The names of the indexes.
+    """
+    indexes = dict((index.name, index) for table in db.metadata.tables.values() for index in table.indexes)
+    for name in names:
+        index = indexes[name]
+        existing = set(found['name'] for found in inspect(connection).get_indexes(index.table.name))
+        if name not in existing:
+            index.create(connection)
+
+
+def _sync_and_outbox_columns(connection: Connection) -> None:
+    _add_columns(connection, 'folders', dict(sync_failed='DATETIME', sync_error='VARCHAR', lease_owner='VARCHAR',
+                                             lease_expires='DATETIME'))
+    _add_columns(connection, 'sale', dict(attempts='INTEGER', next_attempt='DATETIME'))
+    connection.execute('UPDATE sale SET attempts = 0 WHERE attempts IS NULL')  # Sales made before the outbox
+
+
+def _query_indexes(connection: Connection) -> None:
+    _create_indexes(connection, 'ix_items_folder_id', 'ix_sale_user_id_created', 'ix_sale_item_id_created',
+                    'ix_sale_status_created', 'ix_sale_next_attempt')
+
+
+def _catalog_generation(connection: Connection) -> None:
+    _add_columns(connection, 'folders', dict(generation='INTEGER DEFAULT 0'))
+
+
+def _user_synchronized(connection: Connection) -> None:
+    _add_columns(connection, 'users', dict(synchronized='DATETIME'))
+
+
+def _user_removed(connection: Connection) -> None:
+    _add_columns(connection, 'users', dict(removed='DATETIME'))
+
+
+MIGRATIONS = [  # (version, description, function) in the order in which they must be applied
+    (1, 'Add the folder sync and lease columns and the sale outbox columns', _sync_and_outbox_columns),
+    (2, 'Add indexes for the sale, item and outbox queries', _query_indexes),
+    (3, 'Add the catalog generation of the folders', _catalog_generation),
+    (4, 'Add the roster synchronization time of the users', _user_synchronized),
+    (5, 'Add the removal time of the users', _user_removed),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def get_version(connection: Connection) -> int:
+    """
+    Return the schema version of a database.
+
+    :param connection: A connection to the database.
+    :return: The version stored in the user_version pragma, 0 for a database which was never migrated.
+    """
+    return connection.execute('PRAGMA user_version').scalar()
+
+
+def migrate(engine: Engine) -> int:
+    """
+    Apply all migrations which are newer than the schema version of the database. The new version is only stored after
+    a migration succeeded, so a migration which failed halfway is applied again (and completed) at the next start.
+
+    :param engine: The engine of the database. Must be a SQLite database.
+    :return: The schema version after migrating.
+    """
+    with engine.connect() as connection:
+        version = get_version(connection)
+
+    for (migration_version, description, function) in MIGRATIONS:
+        if migration_version <= version:
+            continue
+        with engine.begin() as connection:
+            if get_version(connection) >= migration_version:  # Another process applied it in the meantime
+                continue
+            function(connection)
+            connection.execute('PRAGMA user_version = %d' % migration_version)
+        logger.info('Migrated the database to version %d: %s', migration_version, description)
+        version = migration_version
+    return version
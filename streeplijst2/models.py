@@ -16,6 +16,8 @@ class User(db.Model):
     date_of_birth = db.Column(db.DateTime)
     has_sdd_mandate = db.Column(db.Boolean)
     profile_picture = db.Column(db.String, nullable=True)
+    synchronized = db.Column(db.DateTime, nullable=True)  # Last roster synchronization which included this user
+    removed = db.Column(db.DateTime, nullable=True)  # When the API reported that this user is no longer a member
 
     created = db.Column(db.DateTime)
     updated = db.Column(db.DateTime)
@@ -40,6 +42,18 @@ class User(db.Model):
     def __repr__(self):
         return '<User %s>' % self.s_number
 
+
+class SyncRun(db.Model):
+    # Class attributes for SQLAlchemy
+    __tablename__ = 'sync_runs'
+
+    # Table columns
+    name = db.Column(db.String, primary_key=True)  # Name of the synchronization, e.g. 'roster'
+    completed = db.Column(db.DateTime)  # When the last complete run finished, a run which failed halfway is not stored
+
+    def __repr__(self):
+        return '<SyncRun %s>' % self.name
+
 # class User(db.Model):
 #     # Class attributes for SQLAlchemy
 #     __tablename__ = 'user'
@@ -1,11 +1,13 @@
-from flask import redirect, url_for, render_template, request, flash, session, Blueprint
+from flask import redirect, url_for, render_template, request, flash, session, Blueprint, jsonify, Response
 
 from requests.exceptions import HTTPError
 from functools import wraps  # Used in the login_required decorator function
 
 # from streeplijst2.database import DBController as db_controller
 from streeplijst2.database import UserDB
+from streeplijst2.instrumentation import get_query_stats
 import streeplijst2.api as api
+import streeplijst2.metrics as metrics
 
 
 def login_required(func):
@@ -60,8 +62,8 @@ def login():
 
     elif request.method == 'POST':  # Attempt to login the user
         s_number = request.form['s-number']  # Load the student number from the push form
-        try:  # Attempt to find the user from Congressus
-            user_dict = api.get_user(s_number=s_number)  # Create a User
+        try:  # Find the user in the database, or get it from Congressus and add it to the database
+            user = UserDB.login(s_number=s_number)
         except api.UserNotFoundException as err:  # The user was not found
             flash('User ' + s_number + ' not found, try again.', 'error')
             return render_template('login.jinja2')
@@ -69,9 +71,6 @@ def login():
             flash(str(err), 'error')
             return render_template('login.jinja2')
 
-        # Add user to the database
-        user = UserDB.create(**user_dict)
-
         # Add session variables to identify the user
         session['user_id'] = user.id
         session['user_first_name'] = user.first_name
@@ -86,3 +85,16 @@ def logout():
         session.pop(key, None)  # Remove all items from the session (user data)
     flash('Logged out.')  # TODO: Add temporary messages which disappear after a time.
     return redirect(url_for('home.login'))
+
+
+@bp_home.route('/api/queries/stats')
+def query_stats():
+    query_stats = get_query_stats()
+    if query_stats is None:  # The instrumentation is disabled
+        return jsonify(dict())
+    return jsonify(query_stats.stats())
+
+
+@bp_home.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.exposition(), mimetype='text/plain; version=0.0.4')  # Prometheus text exposition format
@@ -0,0 +1,124 @@
+"""
+Coalesce concurrent identical calls: while a call with a key is in flight, other callers with the same key wait for it
+and share its result or exception instead of making the same call again.
+"""
+import inspect
+import threading
+from functools import wraps
+
+
+class _Call:
+    """
+    A call which is in flight. Waiting callers block on done until the result or error is set.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.shared = 0  # Nr of callers which waited for this call instead of making it themselves
+
+
+class SingleFlight:
+    """
+    Group of coalesced calls. A single group may be shared between threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()  # Protects _calls
+        self._calls = dict()  # Calls in flight, by key
+
+    def do(self, key, func, *args, **kwargs):
+        """
+        Call a function, unless a call with the same key is in flight. In that case, wait for that call and return its
+        result, or raise its exception. The result is shared between all callers, so it must not be modified.
+
+        :param key: Hashable key which identifies the call, e.g. ('products', 1998).
+        :param func: The function to call.
+        :param args: Positional arguments for the function.
+        :param kwargs: Keyword arguments for the function.
+        :return: The result of the function.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:  # Another thread is already making this call
+                call.shared += 1
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+        except BaseException as err:  # Waiting callers receive the same exception
+            call.error = err
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)  # Callers which arrive from now on make a new call
+            call.done.set()
+        return call.result
+
+    def in_flight(self, key) -> bool:
+        """
+        Check if a call is in flight.
+
+        :param key: Key of the call.
+        :return: True if a call with this key is in flight.
+        """
+        with self._lock:
+            return key in self._calls
+
+
+_group = SingleFlight()  # Group which is shared by all coalesced calls in this app
+
+
+def do(key, func, *args, **kwargs):
+    """
+    Call a function through the shared group. See SingleFlight.do().
+
+    :param key: Hashable key which identifies the call.
+    :param func: The function to call.
+    :param args: Positional arguments for the function.
+    :param kwargs: Keyword arguments for the function.
+    :return: The result of the function.
+    """
+    return _group.do(key, func, *args, **kwargs)
+
+
+def in_flight(key) -> bool:
+    """
+    Check if a call is in flight in the shared group. See SingleFlight.in_flight().
+
+    :param key: Key of the call.
+    :return: True if a call with this key is in flight.
+    """
+    return _group.in_flight(key)
+
+
+def coalesce(func):
+    """
+    Decorator function: concurrent calls of the decorated function with the same arguments share a single call. The
+    'timeout' argument is not part of the key, so callers with a different timeout also share the call. All other
+    arguments must be hashable.
+
+    :param func: Function to be decorated.
+    :return: The decorated function.
+    """
+    signature = inspect.signature(func)
+
+    @wraps(func)
+    def wrapper_coalesce(*args, **kwargs):
+        arguments = signature.bind(*args, **kwargs)
+        arguments.apply_defaults()
+        key = (func.__qualname__,) + tuple(value for (name, value) in arguments.arguments.items() if name != 'timeout')
+        return _group.do(key, func, *args, **kwargs)
+
+    return wrapper_coalesce
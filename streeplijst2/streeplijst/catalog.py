@@ -0,0 +1,216 @@
+"""
+In-memory cache of the catalog: the folders and their items as shown on the folder page. The catalog only changes when
+a folder is synchronized, so most folder page loads are served from memory without any database query.
+
+Every change of a folder or its items increments the generation of the folder in the database (see
+database.bump_generation). The cache of this process drops a changed folder as soon as the change is committed. Caches
+of other worker processes compare the generations in the database with the generations of their cached folders at most
+once per CATALOG_CHECK_INTERVAL seconds, and drop the folders which changed. A dropped folder is rebuilt the next time
+it is requested, and replaced as a whole, so readers never see a half-built folder.
+"""
+import logging
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, select
+
+from streeplijst2.config import CATALOG_CHECK_INTERVAL, UPDATE_INTERVAL, SYNC_RETRY_INTERVAL
+from streeplijst2.extensions import db
+from streeplijst2.streeplijst.database import FolderDB, ItemDB, CHANGED_FOLDERS
+from streeplijst2.streeplijst.models import Folder
+import streeplijst2.background as background
+import streeplijst2.singleflight as singleflight
+
+logger = logging.getLogger(__name__)
+
+# Read-only folder with its items as ItemRows, as stored in the cache
+CatalogFolder = namedtuple('CatalogFolder', ('id', 'name', 'media', 'synchronized', 'sync_failed', 'generation',
+                                             'items'))
+
+
+class CatalogCache:
+    """
+    Catalog cache of a single app. Use get_catalog() to get the cache of the current app. A single cache may be shared
+    between threads.
+    """
+
+    def __init__(self, check_interval: float = CATALOG_CHECK_INTERVAL):
+        """
+        Instantiates a CatalogCache object.
+
+        :param check_interval: Max nr of seconds before changes made by other processes are noticed.
+        """
+        self.check_interval = check_interval
+        self._lock = threading.Lock()  # Protects all attributes below
+        self._folders = dict()  # CatalogFolders by id
+        self._dropped = dict()  # Nr of times each folder was dropped, to detect a drop during a rebuild
+        self._checked = None  # time.monotonic() of the last generation check
+        self._hits = 0
+        self._misses = 0
+        self._rebuilds = 0
+        self._rebuild_seconds = 0
+        self._last_rebuild_seconds = 0
+        self._checks = 0
+        self._drops = 0
+
+    def get(self, folder_id: int) -> CatalogFolder:
+        """
+        Return a folder and its items from the cache, or load them from the database if they are not cached.
+
+        :param folder_id: The folder id.
+        :return: The folder, or None if it is not in the database.
+        """
+        self._check_generations()
+        with self._lock:
+            folder = self._folders.get(folder_id)
+            if folder is not None:
+                self._hits += 1
+                return folder
+            self._misses += 1
+        return singleflight.do(('catalog', id(self), folder_id), self._rebuild, folder_id)
+
+    def load_folder(self, folder_id: int, auto_sync_interval: float = UPDATE_INTERVAL, timeout: float = None,
+                    background_sync: bool = False) -> CatalogFolder:
+        """
+        Return a folder and its items from the cache, like FolderDB.load_folder(). Only if the folder needs to be
+        synchronized, FolderDB.load_folder() is called to synchronize it (or to schedule a background synchronization).
+
+        :param folder_id: The folder id.
+        :param auto_sync_interval: Sync interval in seconds (defaults to UPDATE_INTERVAL).
+        :param timeout: Timeout for the API request in seconds (defaults to the API endpoint timeout).
+        :param background_sync: When set to True, an outdated folder is returned from the cache immediately and it is
+        synchronized in a background thread. See FolderDB.load_folder().
+        :return: The folder.
+        """
+        folder = self.get(folder_id)
+        if folder is None or self._needs_sync(folder, auto_sync_interval, background_sync):
+            FolderDB.load_folder(folder_id, auto_sync_interval=auto_sync_interval, timeout=timeout,
+                                 background_sync=background_sync)  # Raises NotInDatabaseException for unknown folders
+            if background_sync is not True:  # The folder may have been synchronized by another process
+                self.drop(folder_id)
+            folder = self.get(folder_id)
+        return folder
+
+    def drop(self, *folder_ids: int) -> None:
+        """
+        Drop folders from the cache, so they are rebuilt the next time they are requested.
+
+        :param folder_ids: The ids of the folders to drop.
+        """
+        with self._lock:
+            for folder_id in folder_ids:
+                self._dropped[folder_id] = self._dropped.get(folder_id, 0) + 1
+                if self._folders.pop(folder_id, None) is not None:
+                    self._drops += 1
+
+    def clear(self) -> None:
+        """
+        Drop all folders from the cache.
+        """
+        with self._lock:
+            folder_ids = list(self._folders.keys())
+        self.drop(*folder_ids)
+
+    def stats(self) -> dict:
+        """
+        Return the cache statistics.
+
+        :return: A dict with the nr of cached folders, hits, misses, the hit rate, the nr of rebuilds, the total and
+        last rebuild time in seconds, the nr of generation checks and the nr of dropped folders.
+        """
+        with self._lock:
+            requests = self._hits + self._misses
+            return dict(folders=len(self._folders), hits=self._hits, misses=self._misses,
+                        hit_rate=self._hits / requests if requests else 0, rebuilds=self._rebuilds,
+                        rebuild_seconds=self._rebuild_seconds, last_rebuild_seconds=self._last_rebuild_seconds,
+                        checks=self._checks, drops=self._drops)
+
+    def _rebuild(self, folder_id: int) -> CatalogFolder:
+        """
+        Load a folder and its items from the database and store them in the cache.
+        """
+        with self._lock:
+            dropped = self._dropped.get(folder_id, 0)
+        start = time.perf_counter()
+
+        table = Folder.__table__
+        row = db.session.execute(select([table.c.id, table.c.name, table.c.media, table.c.synchronized,
+                                         table.c.sync_failed, table.c.generation])
+                                 .where(table.c.id == folder_id)).first()  # Before the items, see _check_generations
+        if row is None:
+            return None
+        folder = CatalogFolder(*row, items=tuple(ItemDB.get_rows_by_folder_id(folder_id)))
+
+        seconds = time.perf_counter() - start
+        with self._lock:
+            self._rebuilds += 1
+            self._rebuild_seconds += seconds
+            self._last_rebuild_seconds = seconds
+            if self._dropped.get(folder_id, 0) == dropped:  # Do not store the folder if it changed during the rebuild
+                self._folders[folder_id] = folder
+        logger.debug('Rebuilt folder %s of the catalog in %.1f ms', folder_id, seconds * 1000)
+        return folder
+
+    def _check_generations(self) -> None:
+        """
+        Drop the cached folders which were changed by another process. Their generation was read before their items,
+        so if a folder changed during a rebuild its generation in the database is newer than the cached one.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self._checked is not None and now - self._checked < self.check_interval:
+                return
+            self._checked = now
+            self._checks += 1
+            cached = dict((folder_id, folder.generation) for (folder_id, folder) in self._folders.items())
+        if not cached:
+            return
+
+        table = Folder.__table__
+        generations = dict(db.session.execute(select([table.c.id, table.c.generation])).fetchall())
+        changed = [folder_id for (folder_id, generation) in cached.items() if generations.get(folder_id) != generation]
+        if changed:
+            logger.info('Folders %s of the catalog were changed by another process', changed)
+            self.drop(*changed)
+
+    @staticmethod
+    def _needs_sync(folder: CatalogFolder, auto_sync_interval: float, background_sync: bool) -> bool:
+        """
+        Check if FolderDB.load_folder() should be called to synchronize the folder (or schedule its synchronization).
+        """
+        if folder.synchronized >= datetime.now() - timedelta(seconds=auto_sync_interval):
+            return False  # The folder is up to date
+        if background_sync is True and folder.synchronized > datetime.min:  # The cached items can be served
+            if background.is_running(('folder', folder.id)):
+                return False  # The folder is being synchronized already
+            if folder.sync_failed is not None and folder.sync_failed > datetime.now() - timedelta(
+                    seconds=SYNC_RETRY_INTERVAL):
+                return False  # The last synchronization failed recently, FolderDB would not try again yet
+        return True
+
+
+def get_catalog() -> CatalogCache:
+    """
+    Return the catalog cache of the current app. Must be called from inside an app context.
+
+    :return: The catalog cache.
+    """
+    return current_app.extensions['catalog']
+
+
+@event.listens_for(db.session, 'after_commit')
+def _drop_changed_folders(session) -> None:
+    """
+    Drop the folders which were changed in the transaction which was just committed from the catalog cache.
+    """
+    folder_ids = session.info.pop(CHANGED_FOLDERS, None)
+    if folder_ids and has_app_context() and 'catalog' in current_app.extensions:
+        current_app.extensions['catalog'].drop(*folder_ids)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _forget_changed_folders(session) -> None:
+    session.info.pop(CHANGED_FOLDERS, None)  # The changes were rolled back, so the cached folders are still valid
@@ -1,13 +1,29 @@
+import logging
+import os
+import socket
+import time
+import uuid
+from collections import namedtuple
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from sqlalchemy import asc
+from sqlalchemy import asc, select
+from sqlalchemy.orm import selectinload
 
 from streeplijst2.streeplijst.models import Folder, Sale, Item
 from streeplijst2.exceptions import NotInDatabaseException, TotalPriceMismatchWarning, HTTPError, Timeout
 from streeplijst2.extensions import db
-from streeplijst2.database import UserDB
-from streeplijst2.config import FOLDERS, UPDATE_INTERVAL
+from streeplijst2.database import UserDB, Listing, SyncDiff, transaction, commit, partial_update, bulk_upsert, \
+    require_no_transaction
+from streeplijst2.config import FOLDERS, UPDATE_INTERVAL, SYNC_WORKERS, SYNC_RETRY_INTERVAL, SYNC_LEASE_TIMEOUT
 import streeplijst2.api as api
+import streeplijst2.metrics as metrics
+import streeplijst2.background as background
+import streeplijst2.singleflight as singleflight
+
+logger = logging.getLogger(__name__)
+
+CHANGED_FOLDERS = 'changed_folders'  # Key in the session info of the ids of the folders changed in this transaction
 
 
 def init_database(config=None) -> None:
@@ -16,12 +32,37 @@ def init_database(config=None) -> None:
 
     :param config: If provided, use this config.
     """
-    for (folder_id, folder_dict) in FOLDERS.items():
-        FolderDB.create(**folder_dict)
-        FolderDB.load_folder(folder_id)
+    with transaction():  # All folders are committed at once
+        for folder_dict in FOLDERS.values():
+            FolderDB.create(**folder_dict)
+    FolderDB.sync_many(list(FOLDERS.keys()))  # Fetch all folders which need to be synchronized at the same time
+
+
+def bump_generation(*folder_ids: int) -> None:
+    """
+    Mark the folders as changed by incrementing their generation, in the current transaction. Catalog caches compare
+    the generations to find out which folders they should rebuild (see catalog.py). The ids are also stored in the
+    session, so the catalog cache of this process can drop the folders as soon as the transaction is committed.
+
+    :param folder_ids: The ids of the folders which changed.
+    """
+    folder_ids = set(id for id in folder_ids if id is not None)
+    if not folder_ids:
+        return
+    table = Folder.__table__
+    db.session.execute(table.update().where(table.c.id.in_(folder_ids)).values(generation=table.c.generation + 1))
+    db.session.info.setdefault(CHANGED_FOLDERS, set()).update(folder_ids)
+
+
+# Read-only item with only the fields shown on the folder page. Much cheaper to build than an Item instance, which is
+# tracked by the session and its identity map. Use ItemDB.get_rows_by_folder_id() to load them.
+ItemRow = namedtuple('ItemRow', ('id', 'name', 'price', 'media'))
 
 
 class ItemDB:
+    # Item fields which are synchronized with the API
+    SYNC_FIELDS = ('name', 'price', 'published', 'media', 'folder_id', 'folder_name')
+    SORT_FIELDS = ('id', 'name', 'price', 'folder_id', 'created', 'updated')  # Fields which items can be sorted by
 
     @classmethod
     def create(cls, id: int, name: str, price: int, published: bool, folder_id: int, folder_name: int,
@@ -46,32 +87,55 @@ class ItemDB:
         new_item = Item(id=id, name=name, price=price, published=published, media=media, folder_id=folder_id,
                         folder_name=folder_name)
         db.session.add(new_item)
-        db.session.commit()
+        bump_generation(folder_id)
+        commit()
         return new_item
 
+    @classmethod
+    def bulk_upsert(cls, items: list, folder_id: int = None) -> SyncDiff:
+        """
+        Insert or update many items in a single transaction with the bulk_upsert() function. Items which did not change
+        are not written at all.
+
+        :param items: List of item dicts as returned by api.get_products_in_folder().
+        :param folder_id: (optional) If provided, stored items in this folder which are not in items are reported as
+        removed. Removed items are not deleted, since sales may still refer to them.
+        :return: A SyncDiff with the added, changed and removed item ids.
+        """
+        (diff, stored) = bulk_upsert(Item, items, cls.SYNC_FIELDS)
+
+        if folder_id is not None:  # Find the items which are no longer in the folder
+            table = Item.__table__
+            new_ids = set(item_dict['id'] for item_dict in items)
+            query = select([table.c.id]).where(table.c.folder_id == folder_id).order_by(table.c.id)
+            diff.removed = [row[0] for row in db.session.execute(query) if row[0] not in new_ids]
+
+        folder_index = cls.SYNC_FIELDS.index('folder_id')
+        new_folders = dict((item_dict['id'], item_dict.get('folder_id')) for item_dict in items)
+        bump_generation(*[new_folders[id] for id in diff.added + diff.changed],
+                        *[stored[id][folder_index] for id in diff.changed])  # Changed items may have moved
+        commit()  # Store all changes in one transaction
+
+        return diff
+
     @classmethod
     def update(cls, id: int, **kwargs) -> Item:
         """
-        Update this item's data fields.
+        Update this item's data fields with a single UPDATE statement.
 
         :param id: The item ID of the item to update.
         :param kwargs: The fields are updated with keyword arguments.
         :return: The updated item.
         """
-        modified_item = Item.query.get(id)
-
-        # If no kwarg is given for an attribute, set it to the already stored attribute
-        modified_item.name = kwargs.get('name', modified_item.name)
-        modified_item.price = kwargs.get('price', modified_item.price)
-        modified_item.published = kwargs.get('published', modified_item.published)
-        modified_item.media = kwargs.get('media', modified_item.media)
-        modified_item.folder_id = kwargs.get('folder_id', modified_item.folder_id)
-        modified_item.folder_name = kwargs.get('folder_name', modified_item.folder_name)
-
-        modified_item.updated = datetime.now()
-        db.session.commit()
-
-        return modified_item
+        # Only the given fields are written, and only if at least one of them differs from the stored value. If nothing
+        # changed, the item (including its updated field) is left untouched.
+        values = dict((field, kwargs[field]) for field in cls.SYNC_FIELDS if field in kwargs)
+        table = Item.__table__
+        with transaction():
+            old_folder_id = db.session.execute(select([table.c.folder_id]).where(table.c.id == id)).scalar()
+            if partial_update(Item, id, values, timestamp='updated', only_changed=True):
+                bump_generation(old_folder_id, values.get('folder_id'))  # The item may have moved to another folder
+        return Item.query.get(id)
 
     @classmethod
     def delete(cls, id: int) -> Item:
@@ -83,19 +147,37 @@ class ItemDB:
         """
         deleted_item = Item.query.get(id)
         db.session.delete(deleted_item)
-        db.session.commit()
+        bump_generation(deleted_item.folder_id)
+        commit()
 
         return deleted_item
 
     @classmethod
-    def list_all(cls) -> list:
+    def list_all(cls, sort: str = 'id', descending: bool = False) -> list:
         """
-        List all items sorted by id.
+        List all items, sorted by id unless another field is given.
 
+        :param sort: Field to sort by, one of SORT_FIELDS.
+        :param descending: When set to True, the items are sorted in descending order.
         :return: A List of all items.
         """
-        # TODO: Add a way to sort result differently
-        return Item.query.order_by(asc(Item.id)).all()
+        return cls.listing(sort=sort, descending=descending).all()
+
+    @classmethod
+    def listing(cls, sort: str = 'id', descending: bool = False, since: datetime = None, until: datetime = None,
+                **filters) -> Listing:
+        """
+        Return a sorted and filtered listing of items, which can be paginated or streamed. See Listing.
+
+        :param sort: Field to sort by, one of SORT_FIELDS.
+        :param descending: When set to True, the items are sorted in descending order.
+        :param since: (optional) Only list items which were created at or after this time.
+        :param until: (optional) Only list items which were created before this time.
+        :param filters: Only list items with these field values, e.g. folder_id=1998.
+        :return: The listing.
+        """
+        return Listing(Item, sort=sort, descending=descending, since=since, until=until, sort_fields=cls.SORT_FIELDS,
+                       **filters)
 
     @classmethod
     def get(cls, id: int) -> Item:
@@ -108,21 +190,52 @@ class ItemDB:
         return Item.query.get(id)
 
     @classmethod
-    def get_by_folder_id(cls, folder_id: int) -> list:
+    def get_many(cls, ids: list) -> list:
+        """
+        Return the items with those ids in a single query.
+
+        :param ids: The ids to get the items by.
+        :return: A List of items sorted by id. Ids which do not exist are left out.
+        """
+        return Item.query.filter(Item.id.in_(ids)).order_by(asc(Item.id)).all()
+
+    @classmethod
+    def get_by_folder_id(cls, folder_id: int, sort: str = 'id', descending: bool = False) -> list:
         """
         Return the items in the folder with that id.
 
         :param folder_id: The folder id to get items by.
+        :param sort: Field to sort by, one of SORT_FIELDS.
+        :param descending: When set to True, the items are sorted in descending order.
         :return: A List of items.
         """
-        return Item.query.filter_by(folder_id=folder_id).all()
+        return cls.listing(sort=sort, descending=descending, folder_id=folder_id).all()
+
+    @classmethod
+    def get_rows_by_folder_id(cls, folder_id: int) -> list:
+        """
+        Return the items in the folder with that id as read-only rows, straight from a single SELECT of the shown
+        columns. The rows are not added to the session, so they cannot be changed and are not expired by a commit.
+
+        :param folder_id: The folder id to get items by.
+        :return: A List of ItemRows sorted by id.
+        """
+        table = Item.__table__
+        query = select([table.c.id, table.c.name, table.c.price, table.c.media]) \
+            .where(table.c.folder_id == folder_id) \
+            .order_by(table.c.id)
+        return list(map(ItemRow._make, db.session.execute(query).fetchall()))
 
 
 class FolderDB:
+    UPDATE_FIELDS = ('name', 'media', 'synchronized', 'sync_failed', 'sync_error')  # Fields which update() can change
+    LEASE_POLL_INTERVAL = 0.2  # Nr of seconds between checks while waiting for the sync lease of another process
+    SORT_FIELDS = ('id', 'name')  # Fields which folders can be sorted by
 
     @classmethod
     def load_folder(cls, folder_id: int, force_sync: bool = False,
-                    auto_sync_interval: float = UPDATE_INTERVAL, timeout: float = api.TIMEOUT) -> Folder:
+                    auto_sync_interval: float = UPDATE_INTERVAL, timeout: float = None,
+                    background_sync: bool = False) -> Folder:
         """
         Load a folder from the database or from the API. The database loads much faster but may be out of sync with the
         API.
@@ -130,22 +243,288 @@ class FolderDB:
         :param folder_id: Folder ID to retrieve.
         :param force_sync: When set to True, the folder will sync its contents with the API.
         :param auto_sync_interval: Alternative sync interval in seconds (defaults to cls.UPDATE_INTERVAL).
-        :param timeout: Timeout for the API request in seconds (defautls to api.TIMEOUT).
+        :param timeout: Timeout for the API request in seconds (defaults to the API endpoint timeout).
+        :param background_sync: When set to True, an outdated folder is returned from the database immediately and it
+        is synchronized in a background thread. A folder which was never synchronized is always synchronized directly.
         :return: The Folder instance.
         """
+        folder = cls._get_or_raise(folder_id)
+
+        if cls._needs_sync(folder, force_sync, auto_sync_interval):  # The folder should sync with the API
+            interval = None if force_sync is True else auto_sync_interval  # Skip if another process just synchronized
+            if background_sync is True and folder.synchronized > datetime.min:  # There are items which can be served
+                cls._schedule_refresh(folder, timeout=timeout, auto_sync_interval=interval)
+            else:
+                cls.sync_folder_once(folder.id, timeout=timeout, auto_sync_interval=interval)
+                db.session.expire(folder)  # The folder may have been synchronized from the session of another thread
+
+        return folder
+
+    @classmethod
+    def sync_folder(cls, folder_id: int, timeout: float = None, auto_sync_interval: float = None) -> SyncDiff:
+        """
+        Synchronize the contents of a folder with the API. Only one process synchronizes a folder at the same time: if
+        another process holds the sync lease of this folder, the items in the database are kept as they are. A folder
+        which was never synchronized waits for the other process instead.
+
+        :param folder_id: Folder ID to synchronize.
+        :param timeout: Timeout for the API request in seconds (defaults to the API endpoint timeout).
+        :param auto_sync_interval: (optional) Sync interval in seconds. If given, the folder is not synchronized when
+        another process synchronized it less than auto_sync_interval seconds ago, which is checked after taking the
+        lease. If None, the folder is always synchronized.
+        :return: A SyncDiff with the added, changed and removed item ids. It is empty if another process synchronized
+        the folder.
+        """
+        folder = cls._get_or_raise(folder_id)
+        lease = cls._acquire_or_wait(folder)
+        if lease is None:  # Another process synchronized the folder
+            return SyncDiff()
+        if auto_sync_interval is not None and not cls._needs_sync(folder, False, auto_sync_interval):
+            logger.info('Folder %s was synchronized by another process in the meantime', folder.id)  # Reloaded
+            cls.release_lease(folder.id, lease)
+            return SyncDiff()
+
+        try:
+            items = api.get_products_in_folder(folder.id, timeout=timeout,
+                                               synchronized=folder.synchronized)  # Make the api call
+            return cls._store_items(folder, items)
+        except Exception:
+            db.session.rollback()  # Make sure the lease can be released
+            raise
+        finally:
+            cls.release_lease(folder.id, lease)
+
+    @classmethod
+    def sync_folder_once(cls, folder_id: int, timeout: float = None, auto_sync_interval: float = None) -> SyncDiff:
+        """
+        Synchronize the contents of a folder with the API. If another thread is already synchronizing this folder, wait
+        for it and share its result instead of fetching and writing the same items again.
+
+        :param folder_id: Folder ID to synchronize.
+        :param timeout: Timeout for the API request in seconds (defaults to the API endpoint timeout).
+        :param auto_sync_interval: (optional) Sync interval in seconds, see sync_folder().
+        :return: A SyncDiff with the added, changed and removed item ids.
+        """
+        return singleflight.do(('sync_folder', folder_id), cls.sync_folder, folder_id, timeout=timeout,
+                               auto_sync_interval=auto_sync_interval)
+
+    @classmethod
+    def sync_many(cls, folder_ids: list, force_sync: bool = False, auto_sync_interval: float = UPDATE_INTERVAL,
+                  timeout: float = None, max_workers: int = SYNC_WORKERS) -> list:
+        """
+        Synchronize multiple folders with the API. The folders are fetched from the API at the same time in a thread
+        pool, after which the results are written to the database one folder at a time from the calling thread. This
+        takes about as long as the slowest API call instead of the sum of all API calls.
+
+        If fetching a folder fails, all other folders are still stored before the first error is raised.
+
+        :param folder_ids: Folder IDs to synchronize.
+        :param force_sync: When set to True, all folders will sync their contents with the API.
+        :param auto_sync_interval: Alternative sync interval in seconds (defaults to UPDATE_INTERVAL).
+        :param timeout: Timeout for the API requests in seconds (defaults to the API endpoint timeout).
+        :param max_workers: Max nr of API requests at the same time (defaults to SYNC_WORKERS).
+        :return: A list of the Folder instances, in the order of folder_ids.
+        """
+        folders = [cls._get_or_raise(folder_id) for folder_id in folder_ids]
+        outdated_folders = [folder for folder in folders if cls._needs_sync(folder, force_sync, auto_sync_interval)]
+        if len(outdated_folders) == 0:  # Nothing needs to be synchronized
+            return folders
+
+        leases = dict()  # Leases by folder id, folders which are synchronized by another process are not fetched
+        for folder in outdated_folders:
+            lease = cls.acquire_lease(folder.id)
+            if lease is not None:
+                leases[folder.id] = lease
+        for folder in outdated_folders:  # The folders were reloaded by the commits of acquire_lease()
+            if folder.id in leases and not cls._needs_sync(folder, force_sync, auto_sync_interval):
+                logger.info('Folder %s was synchronized by another process in the meantime', folder.id)
+                cls.release_lease(folder.id, leases.pop(folder.id))
+        leased_folders = [folder for folder in outdated_folders if folder.id in leases]
+
+        errors = []
+        try:
+            if leased_folders:
+                with ThreadPoolExecutor(max_workers=min(max_workers, len(leased_folders))) as executor:
+                    # The worker threads only make the API calls, they never touch the database session
+                    futures = {executor.submit(api.get_products_in_folder, folder.id, timeout=timeout,
+                                               synchronized=folder.synchronized): folder
+                               for folder in leased_folders}
+                    for future in as_completed(futures):  # Store every folder as soon as its response arrives
+                        try:
+                            items = future.result()
+                        except Exception as err:  # Store the other folders before raising the error
+                            errors.append(err)
+                            continue
+                        cls._store_items(futures[future], items)
+        finally:
+            for (folder_id, lease) in leases.items():
+                cls.release_lease(folder_id, lease)
+
+        for folder in outdated_folders:  # Folders which were never synchronized wait for the other process
+            if folder.id not in leases and folder.synchronized == datetime.min:
+                cls.sync_folder(folder.id, timeout=timeout,
+                                auto_sync_interval=None if force_sync is True else auto_sync_interval)
+
+        if errors:
+            raise errors[0]
+        return folders
+
+    @classmethod
+    def _schedule_refresh(cls, folder: Folder, timeout: float = None, auto_sync_interval: float = None) -> bool:
+        """
+        Synchronize a folder in a background thread. Nothing is scheduled if a refresh of this folder is still running,
+        or if the last refresh failed less than SYNC_RETRY_INTERVAL seconds ago.
+
+        :param folder: The folder to synchronize.
+        :param timeout: Timeout for the API request in seconds (defaults to the API endpoint timeout).
+        :param auto_sync_interval: (optional) Sync interval in seconds, see sync_folder().
+        :return: True if a refresh was scheduled.
+        """
+        retry_threshold = datetime.now() - timedelta(seconds=SYNC_RETRY_INTERVAL)
+        if folder.sync_failed is not None and folder.sync_failed > retry_threshold:  # Do not hammer a failing API
+            return False
+        return background.run_once(('folder', folder.id), cls._refresh, folder.id, timeout=timeout,
+                                   auto_sync_interval=auto_sync_interval)
+
+    @classmethod
+    def _refresh(cls, folder_id: int, timeout: float = None, auto_sync_interval: float = None) -> None:
+        """
+        Synchronize a folder and store any error on the folder instead of raising it.
+
+        :param folder_id: Folder ID to synchronize.
+        :param timeout: Timeout for the API request in seconds (defaults to the API endpoint timeout).
+        :param auto_sync_interval: (optional) Sync interval in seconds, see sync_folder().
+        """
+        try:
+            cls.sync_folder_once(folder_id, timeout=timeout, auto_sync_interval=auto_sync_interval)
+        except Exception as err:  # Any error is stored, the user keeps being served the items in the database
+            db.session.rollback()
+            logger.warning('Background synchronization of folder %s failed: %s', folder_id, err)
+            cls.update(folder_id, sync_failed=datetime.now(), sync_error=str(err))
+
+    @classmethod
+    def acquire_lease(cls, folder_id: int, lease_timeout: float = SYNC_LEASE_TIMEOUT) -> str:
+        """
+        Take the sync lease of a folder, so other processes do not synchronize it at the same time. The lease is taken
+        with a single conditional UPDATE, so when multiple processes try to take it only one of them succeeds. A lease
+        which expired (e.g. because its owner stopped during a synchronization) can be taken again. The lease is
+        committed at once, so it must not be taken inside a transaction() block.
+
+        :param folder_id: Folder ID to take the lease of.
+        :param lease_timeout: Nr of seconds after which the lease expires (defaults to SYNC_LEASE_TIMEOUT).
+        :return: The lease token, which is needed to release the lease, or None if another process holds the lease.
+        :raises RuntimeError: If this is called inside a transaction() block.
+        """
+        require_no_transaction('take a sync lease')
+        table = Folder.__table__
+        now = datetime.now()
+        lease = '%s:%d:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])  # Unique per synchronization
+        result = db.session.execute(
+            table.update()
+            .where(table.c.id == folder_id)
+            .where(db.or_(table.c.lease_expires.is_(None), table.c.lease_expires < now))
+            .values(lease_owner=lease, lease_expires=now + timedelta(seconds=lease_timeout)))
+        db.session.commit()
+        return lease if result.rowcount == 1 else None
+
+    @classmethod
+    def release_lease(cls, folder_id: int, lease: str) -> bool:
+        """
+        Release the sync lease of a folder. Nothing happens if the lease expired and was taken by another process. Like
+        acquire_lease(), this commits at once and must not be called inside a transaction() block.
+
+        :param folder_id: Folder ID to release the lease of.
+        :param lease: The lease token returned by acquire_lease().
+        :return: True if the lease was released.
+        :raises RuntimeError: If this is called inside a transaction() block.
+        """
+        require_no_transaction('release a sync lease')
+        table = Folder.__table__
+        result = db.session.execute(
+            table.update()
+            .where(table.c.id == folder_id)
+            .where(table.c.lease_owner == lease)
+            .values(lease_owner=None, lease_expires=None))
+        db.session.commit()
+        return result.rowcount == 1
+
+    @classmethod
+    def _acquire_or_wait(cls, folder: Folder, lease_timeout: float = SYNC_LEASE_TIMEOUT) -> str:
+        """
+        Take the sync lease of a folder. If another process holds the lease, the stored items are served as they are,
+        unless the folder was never synchronized. In that case, wait until the other process is done or its lease
+        expired.
+
+        :param folder: The folder to take the lease of.
+        :param lease_timeout: Nr of seconds after which the lease expires (defaults to SYNC_LEASE_TIMEOUT).
+        :return: The lease token, or None if the folder was synchronized by another process.
+        """
+        deadline = time.time() + 2 * lease_timeout  # The other lease expires well before this
+        while True:
+            lease = cls.acquire_lease(folder.id, lease_timeout=lease_timeout)
+            if lease is not None:
+                return lease
+
+            db.session.expire(folder)  # Reload the folder, it may have been synchronized by the other process
+            if folder.synchronized > datetime.min:
+                logger.info('Folder %s is synchronized by %s, serving the stored items', folder.id, folder.lease_owner)
+                return None
+            if time.time() > deadline:
+                raise Timeout('Folder %s is being synchronized by %s' % (folder.id, folder.lease_owner))
+            time.sleep(cls.LEASE_POLL_INTERVAL)
+
+    @classmethod
+    def _get_or_raise(cls, folder_id: int) -> Folder:
+        """
+        Return the folder with that id or raise a NotInDatabaseException if it does not exist.
+
+        :param folder_id: The id to get the folder by.
+        :return: The folder.
+        """
         folder = cls.get(folder_id)
         if folder is None:  # The folder was not in the database
             raise NotInDatabaseException("Folder not in local database. Add it using FolderDB.create()")
+        return folder
 
-        # Check if the folder contents should be updated.
+    @classmethod
+    def _needs_sync(cls, folder: Folder, force_sync: bool, auto_sync_interval: float) -> bool:
+        """
+        Check if the folder contents should be updated.
+
+        :param folder: The folder to check.
+        :param force_sync: When set to True, the folder always needs to sync.
+        :param auto_sync_interval: Sync interval in seconds.
+        :return: True if the folder should sync with the API.
+        """
         update_threshold = datetime.now() - timedelta(seconds=auto_sync_interval)
-        if force_sync is True or folder.synchronized < update_threshold:  # The folder should sync with the API
-            items = api.get_products_in_folder(folder.id, timeout=timeout)  # Make the api call
-            for item_dict in items:  # Update existing items or create a new item if it did not exist in db before
-                ItemDB.create(**item_dict)
-            FolderDB.update(folder.id, synchronized=datetime.now())  # Update the timed folder fields.
+        return force_sync is True or folder.synchronized < update_threshold
 
-        return folder
+    @classmethod
+    def _store_items(cls, folder: Folder, items: list) -> SyncDiff:
+        """
+        Store the items of a folder which were retrieved from the API and mark the folder as synchronized.
+
+        :param folder: The folder which was synchronized.
+        :param items: List of item dicts as returned by api.get_products_in_folder(), or None if the API response did
+        not change since the last synchronization.
+        :return: A SyncDiff with the added, changed and removed item ids.
+        """
+        folder.synchronized = datetime.now()  # Update the timed folder fields, committed together with the items
+        folder.updated = datetime.now()
+        folder.sync_failed = None  # The synchronization succeeded, so clear any previous error
+        folder.sync_error = None
+        bump_generation(folder.id)  # The sync time of the folder changed, even if its items did not
+        if items is None:  # The stored items are still up to date, so they do not need to be compared
+            commit()
+            logger.info('Synchronized folder %s: not modified', folder.id)
+            return SyncDiff()
+
+        diff = ItemDB.bulk_upsert(items, folder_id=folder.id)  # Only new and changed items are written
+
+        logger.info('Synchronized folder %s: %s', folder.id, diff)
+        if diff.removed:
+            logger.warning('Items %s are no longer in folder %s according to the API', diff.removed, folder.id)
+        return diff
 
     @classmethod
     def create(cls, id: int, name: str, media: str = None) -> Folder:
@@ -163,29 +542,23 @@ class FolderDB:
         # If the folder does not exist yet, create it
         new_folder = Folder(id=id, name=name, media=media)
         db.session.add(new_folder)
-        db.session.commit()
+        commit()
         return new_folder
 
     @classmethod
     def update(cls, id: int, **kwargs) -> Folder:
         """
-        Update this folder's data fields.
+        Update this folder's data fields with a single UPDATE statement.
 
         :param id: The item ID of the folder to update.
-        :param kwargs: The fields are updated with keyword arguments.
+        :param kwargs: The fields are updated with keyword arguments. Fields which are not given are not written.
         :return: The updated folder.
         """
-        modified_folder = Folder.query.get(id)
-
-        # If no kwarg is given for an attribute, set it to the already stored attribute
-        modified_folder.name = kwargs.get('name', modified_folder.name)
-        modified_folder.media = kwargs.get('media', modified_folder.media)
-        modified_folder.synchronized = kwargs.get('synchronized', modified_folder.synchronized)
-
-        modified_folder.updated = datetime.now()
-        db.session.commit()
-
-        return modified_folder
+        values = dict((field, kwargs[field]) for field in cls.UPDATE_FIELDS if field in kwargs)
+        with transaction():
+            if partial_update(Folder, id, values, timestamp='updated'):
+                bump_generation(id)
+        return Folder.query.get(id)
 
     @classmethod
     def delete(cls, id: int) -> Folder:
@@ -197,28 +570,37 @@ class FolderDB:
         """
         deleted_folder = Folder.query.get(id)
         db.session.delete(deleted_folder)
-        db.session.commit()
+        db.session.info.setdefault(CHANGED_FOLDERS, set()).add(id)  # A deleted folder has no generation to bump
+        commit()
 
         return deleted_folder
 
     @classmethod
-    def list_all(cls) -> list:
+    def list_all(cls, sort: str = 'id', descending: bool = False, with_items: bool = False) -> list:
         """
-        List all folders sorted by id.
+        List all folders, sorted by id unless another field is given.
 
+        :param sort: Field to sort by, one of SORT_FIELDS.
+        :param descending: When set to True, the folders are sorted in descending order.
+        :param with_items: When set to True, folder.items is loaded for all folders with a single extra query.
         :return: A List of all folders.
         """
-        # TODO: Add a way to sort result differently
-        return Folder.query.order_by(asc(Folder.id)).all()
+        query = Listing(Folder, sort=sort, descending=descending, sort_fields=cls.SORT_FIELDS).query()
+        if with_items:
+            query = query.options(selectinload(Folder.items))
+        return query.all()
 
     @classmethod
-    def get(cls, id: int) -> Folder:
+    def get(cls, id: int, with_items: bool = False) -> Folder:
         """
         Return the folder with that id.
 
         :param id: The id to get the folder by.
+        :param with_items: When set to True, folder.items is loaded with a single extra query.
         :return: The folder.
         """
+        if with_items:  # Query.get() would skip the query, and the options, if the folder is in the session already
+            return Folder.query.options(selectinload(Folder.items)).filter(Folder.id == id).first()
         return Folder.query.get(id)
 
     @classmethod
@@ -233,68 +615,112 @@ class FolderDB:
 
 
 class SaleDB:
+    UPDATE_FIELDS = ('quantity', 'total_price', 'item_id', 'item_name', 'user_id', 'user_s_number', 'api_id',
+                     'api_reference', 'api_created', 'status', 'error_msg', 'attempts',
+                     'next_attempt')  # Fields which update() can change
+    SORT_FIELDS = ('id', 'created', 'total_price', 'quantity', 'user_id', 'item_id', 'status')  # Fields to sort by
 
     @classmethod
-    def post_sale(cls, id: int, timeout: float = api.TIMEOUT) -> Sale:
+    def post_sale(cls, id: int, timeout: float = None) -> Sale:
         """
         POST the sale to the API.
 
         :param id: The ID of the sale to post.
-        :param timeout: Timeout for the API request in seconds (defautls to api.TIMEOUT).
+        :param timeout: Timeout for the API request in seconds (defaults to the API endpoint timeout).
         """
-        sale = SaleDB.get(id)
+        return cls.post_sales([id], timeout=timeout)[0]
+
+    @classmethod
+    def post_sales(cls, ids: list, timeout: float = None, final: bool = True) -> list:
+        """
+        POST multiple sales of the same user to the API in a single request, with one item per sale. The total price
+        of every item in the response is checked against the sale it belongs to. If the request fails, the error is
+        stored on all sales.
+
+        :param ids: The IDs of the sales to post. All sales must be made by the same user.
+        :param timeout: Timeout for the API request in seconds (defaults to the API endpoint timeout).
+        :param final: When set to False, the sales may be posted again if the request fails (e.g. by the outbox), so an
+        error status is not counted as their outcome in the metrics. The caller counts their final status instead.
+        :return: A list of the updated sales, in the order of ids.
+        """
+        sales = SaleDB.get_many(ids)
+        user_ids = set(sale.user_id for sale in sales)
+        if len(user_ids) != 1:
+            raise ValueError("All sales must be made by the same user, got user ids %s." % sorted(user_ids))
 
         try:
-            response = api.post_sale(user_id=sale.user_id, product_id=sale.item_id, quantity=sale.quantity,
-                                     timeout=timeout)
-            updated_sale = SaleDB.update(id=sale.id,
-                                         api_id=response['id'],
-                                         api_reference=response['reference'],
-                                         api_created=response['created'],
-                                         status=Sale.STATUS_OK)
-
-            # Check the prices
-            api_total_price = 0
-            for item in response['items']:  # Adds prices of all items in sale to check
-                api_total_price += item['total_price']  # Synchronize the total prize with API response
-
-            if api_total_price != sale.total_price:  # Check if the total price matches
-                raise TotalPriceMismatchWarning(
-                    "total_price does not match (local total_price) %d != %d (API total_price)" % (
-                        sale.total_price, api_total_price))
-
-            return updated_sale
-
-        except TotalPriceMismatchWarning as warn:  # If warning is raised, add message to the sale but continue normally
-            updated_sale = SaleDB.update(id=sale.id,
-                                         status=sale.STATUS_TOTAL_PRICE_MISMATCH,  # Store the warnning
-                                         error_msg=str(warn))  # Store the warning message
-            return updated_sale  # Return the sale
+            response = api.post_sale_items(user_id=sales[0].user_id,
+                                           items=[{'product_id': sale.item_id, 'quantity': sale.quantity}
+                                                  for sale in sales],
+                                           timeout=timeout)
 
         except api.UserNotSignedException as err:  # The user needs to sign their SDD before posting sales
-            SaleDB.update(id=sale.id,
-                          status=Sale.STATUS_SDD_NOT_SIGNED,  # Store the reason the request failed
-                          error_msg=str(err))  # Save the entire error message
+            cls._update_all(ids, count_status=final,
+                            status=Sale.STATUS_SDD_NOT_SIGNED,  # Store the reason the request failed
+                            error_msg=str(err))  # Save the entire error message
             raise err
 
-        except Timeout as err:  # If a Timeout error occurred
-            SaleDB.update(id=sale.id,
-                          status=Sale.STATUS_TIMEOUT,  # Store the reason the request failed
-                          error_msg=str(err))  # Save the entire error message
+        except Timeout as err:  # If a Timeout error occurred, after a read timeout the API may have booked the sales
+            cls._update_all(ids, count_status=final,
+                            status=Sale.STATUS_TIMEOUT if api.request_not_sent(err) else Sale.STATUS_UNCONFIRMED,
+                            error_msg=str(err))  # Save the entire error message
             raise err
 
         except HTTPError as err:  # If an HTTPError occurred, the request was bad
-            SaleDB.update(id=sale.id,
-                          status=Sale.STATUS_HTTP_ERROR,  # Store the reason the request failed
-                          error_msg=str(err))  # Save the entire error message
+            cls._update_all(ids, count_status=final,
+                            status=Sale.STATUS_HTTP_ERROR,  # Store the reason the request failed
+                            error_msg=str(err))  # Save the entire error message
             raise err
 
-        except Exception as err:  # If another error occurred, something else went wrong
-            SaleDB.update(id=sale.id,
-                          status=Sale.STATUS_UNKNOWN_ERROR,  # Store the reason the request failed
-                          error_msg=str(err))  # Save the entire error message
+        except Exception as err:  # If another error occurred, the API may have booked the sales unless it was not sent
+            cls._update_all(ids, count_status=final,
+                            status=Sale.STATUS_UNKNOWN_ERROR if api.request_not_sent(err) else Sale.STATUS_UNCONFIRMED,
+                            error_msg=str(err))  # Save the entire error message
             raise err
 
+        updated_sales = []
+        api_items = response['items']  # The items in the response are in the same order as the posted items
+        with transaction():  # All sales are committed at once
+            for (index, sale) in enumerate(sales):
+                try:
+                    updated_sale = SaleDB.update(id=sale.id,
+                                                 api_id=response['id'],
+                                                 api_reference=response['reference'],
+                                                 api_created=response['created'],
+                                                 status=Sale.STATUS_OK)
+
+                    # Check the price of this line
+                    api_total_price = api_items[index]['total_price'] if index < len(api_items) else None
+                    if api_total_price != sale.total_price:  # Check if the total price matches
+                        raise TotalPriceMismatchWarning(
+                            "total_price does not match (local total_price) %s != %s (API total_price)" % (
+                                sale.total_price, api_total_price))
+
+                except TotalPriceMismatchWarning as warn:  # If warning is raised, add message to the sale but continue
+                    updated_sale = SaleDB.update(id=sale.id,
+                                                 status=sale.STATUS_TOTAL_PRICE_MISMATCH,  # Store the warnning
+                                                 error_msg=str(warn))  # Store the warning message
+                updated_sales.append(updated_sale)
+
+        for updated_sale in updated_sales:
+            metrics.registry.count_sales(updated_sale.status)
+        return updated_sales
+
+    @classmethod
+    def _update_all(cls, ids: list, count_status: bool = False, **kwargs) -> None:
+        """
+        Update the same data fields of multiple sales.
+
+        :param ids: The IDs of the sales to update.
+        :param count_status: When set to True, the new status is counted as the outcome of the sales in the metrics.
+        :param kwargs: The fields are updated with keyword arguments.
+        """
+        with transaction():  # All sales are committed at once
+            for id in ids:
+                cls.update(id=id, **kwargs)
+        if count_status is True:
+            metrics.registry.count_sales(kwargs['status'], len(ids))
+
     @classmethod
     def create_quick(cls, quantity: int, item_id: int, user_id: int):
         """
@@ -319,6 +745,34 @@ class SaleDB:
         return cls.create(quantity=quantity, total_price=total_price, item_id=item_id, item_name=item.name,
                           user_id=user_id, user_s_number=user.s_number)
 
+    @classmethod
+    def create_many(cls, user_id: int, lines: dict) -> list:
+        """
+        Instantiate a Sale object for every line of a cart and store them all in the database in a single transaction.
+
+        :param user_id: User ID.
+        :param lines: Dict with the quantity per item ID.
+        :return: A list of the sales, in the order of lines.
+        """
+        user = UserDB.get(user_id)
+        items = dict((item.id, item) for item in ItemDB.get_many(list(lines.keys())))
+
+        # Check if it is possible to create all sales correctly before storing any of them
+        if user is None:
+            raise NotInDatabaseException("User with id %d does not exist in database." % user_id)
+        for item_id in lines.keys():
+            if item_id not in items:
+                raise NotInDatabaseException("Item with id %d does not exist in database." % item_id)
+
+        new_sales = [Sale(quantity=quantity, total_price=quantity * items[item_id].price, item_id=item_id,
+                          item_name=items[item_id].name, user_id=user_id, user_s_number=user.s_number)
+                     for (item_id, quantity) in lines.items()]
+        db.session.add_all(new_sales)
+        db.session.flush()  # Assign the ids, reading them after the commit would reload every sale separately
+        ids = [sale.id for sale in new_sales]
+        commit()
+        return cls.get_many(ids)  # Reload the sales which were expired by the commit in a single query
+
     @classmethod
     def create(cls, quantity: int, total_price: int, item_id: int, item_name: str, user_id: int,
                user_s_number: str) -> Sale:
@@ -336,38 +790,21 @@ class SaleDB:
         new_sale = Sale(quantity=quantity, total_price=total_price, item_id=item_id, item_name=item_name,
                         user_id=user_id, user_s_number=user_s_number)
         db.session.add(new_sale)
-        db.session.commit()
+        commit()
         return new_sale
 
     @classmethod
     def update(cls, id: int, **kwargs) -> Sale:
         """
-        Update this sale's data fields.
+        Update this sale's data fields with a single UPDATE statement.
 
         :param id: The ID of the sale to update.
-        :param kwargs: The fields are updated with keyword arguments.
+        :param kwargs: The fields are updated with keyword arguments. Fields which are not given are not written.
         :return: The updated sale.
         """
-        modified_sale = Sale.query.get(id)
-
-        # If no kwarg is given for an attribute, set it to the already stored attribute
-        modified_sale.quantity = kwargs.get('quantity', modified_sale.quantity)
-        modified_sale.total_price = kwargs.get('total_price', modified_sale.total_price)
-        modified_sale.item_id = kwargs.get('item_id', modified_sale.item_id)
-        modified_sale.item_name = kwargs.get('item_name', modified_sale.item_name)
-        modified_sale.user_id = kwargs.get('user_id', modified_sale.user_id)
-        modified_sale.user_s_number = kwargs.get('user_s_number', modified_sale.user_s_number)
-
-        modified_sale.api_id = kwargs.get('api_id', modified_sale.api_id)
-        modified_sale.api_reference = kwargs.get('api_reference', modified_sale.api_reference)
-        modified_sale.api_created = kwargs.get('api_created', modified_sale.api_created)
-        modified_sale.status = kwargs.get('status', modified_sale.status)
-        modified_sale.error_msg = kwargs.get('error_msg', modified_sale.error_msg)
-
-        modified_sale.updated = datetime.now()
-        db.session.commit()
-
-        return modified_sale
+        values = dict((field, kwargs[field]) for field in cls.UPDATE_FIELDS if field in kwargs)
+        partial_update(Sale, id, values, timestamp='last_updated')
+        return Sale.query.get(id)
 
     @classmethod
     def delete(cls, id: int) -> Sale:
@@ -379,19 +816,37 @@ class SaleDB:
         """
         deleted_sale = Sale.query.get(id)
         db.session.delete(deleted_sale)
-        db.session.commit()
+        commit()
 
         return deleted_sale
 
     @classmethod
-    def list_all(cls) -> list:
+    def list_all(cls, sort: str = 'id', descending: bool = False) -> list:
         """
-        List all sales sorted by id.
+        List all sales, sorted by id unless another field is given. This loads the whole sale history, use listing()
+        to paginate or stream it instead.
 
+        :param sort: Field to sort by, one of SORT_FIELDS.
+        :param descending: When set to True, the sales are sorted in descending order.
         :return: A List of all sales.
         """
-        # TODO: Add a way to sort result differently
-        return Sale.query.order_by(asc(Sale.id)).all()
+        return cls.listing(sort=sort, descending=descending).all()
+
+    @classmethod
+    def listing(cls, sort: str = 'id', descending: bool = False, since: datetime = None, until: datetime = None,
+                **filters) -> Listing:
+        """
+        Return a sorted and filtered listing of sales, which can be paginated or streamed. See Listing.
+
+        :param sort: Field to sort by, one of SORT_FIELDS.
+        :param descending: When set to True, the sales are sorted in descending order.
+        :param since: (optional) Only list sales which were created at or after this time.
+        :param until: (optional) Only list sales which were created before this time.
+        :param filters: Only list sales with these field values, e.g. status=Sale.STATUS_FAILED or user_id=[1, 2].
+        :return: The listing.
+        """
+        return Listing(Sale, sort=sort, descending=descending, since=since, until=until, sort_fields=cls.SORT_FIELDS,
+                       **filters)
 
     @classmethod
     def get(cls, id: int) -> Sale:
@@ -404,24 +859,43 @@ class SaleDB:
         return Sale.query.get(id)
 
     @classmethod
-    def get_by_user_id(cls, user_id: int) -> list:
+    def get_many(cls, ids: list, with_items: bool = False) -> list:
+        """
+        Return the sales with those ids in a single query.
+
+        :param ids: The ids to get the sales by.
+        :param with_items: When set to True, sale.item is loaded for all sales with a single extra query.
+        :return: A List of sales in the order of ids. Ids which do not exist are left out.
+        """
+        query = Sale.query.filter(Sale.id.in_(ids))
+        if with_items:
+            query = query.options(selectinload(Sale.item))
+        sales = dict((sale.id, sale) for sale in query)
+        return [sales[id] for id in ids if id in sales]
+
+    @classmethod
+    def get_by_user_id(cls, user_id: int, sort: str = 'created', descending: bool = False) -> list:
         """
-        List all sales by this user.
+        List all sales by this user, oldest first unless another sort field is given.
 
+        :param user_id: The user id to get sales by.
+        :param sort: Field to sort by, one of SORT_FIELDS.
+        :param descending: When set to True, the sales are sorted in descending order.
         :return: A List of all sales by the user.
         """
-        # TODO: Add a way to sort result differently
-        return Sale.query.filter_by(user_id=user_id).all()
+        return cls.listing(sort=sort, descending=descending, user_id=user_id).all()
 
     @classmethod
-    def get_by_item_id(cls, item_id: int) -> list:
+    def get_by_item_id(cls, item_id: int, sort: str = 'created', descending: bool = False) -> list:
         """
-        List all sales of this item.
+        List all sales of this item, oldest first unless another sort field is given.
 
+        :param item_id: The item id to get sales by.
+        :param sort: Field to sort by, one of SORT_FIELDS.
+        :param descending: When set to True, the sales are sorted in descending order.
         :return: A List of all sales by the item.
         """
-        # TODO: Add a way to sort result differently
-        return Sale.query.filter_by(item_id=item_id).all()
+        return cls.listing(sort=sort, descending=descending, item_id=item_id).all()
 
 # class StreeplijstDBController(DBController):
 #
@@ -13,10 +13,20 @@ class Folder(db.Model):
     name = db.Column(db.String)
     media = db.Column(db.String, nullable=True)
     synchronized = db.Column(db.DateTime)  # When was this folder last synchronized with the API
+    sync_failed = db.Column(db.DateTime, nullable=True)  # When did the last background synchronization fail
+    sync_error = db.Column(db.String, nullable=True)  # Error message of the last failed background synchronization
+    lease_owner = db.Column(db.String, nullable=True)  # Process which is synchronizing this folder right now
+    lease_expires = db.Column(db.DateTime, nullable=True)  # When the lease expires if its owner stopped responding
+    generation = db.Column(db.Integer, default=0)  # Incremented whenever the folder or its items change, see catalog.py
 
     created = db.Column(db.DateTime)
     updated = db.Column(db.DateTime)
 
+    # Relationships. They never load lazily, so every page states how it loads them instead of running a query per row
+    # (e.g. FolderDB.get(id, with_items=True)). Deleting a folder leaves its items as they are.
+    items = db.relationship('Item', back_populates='folder', order_by='Item.id', lazy='raise_on_sql',
+                            passive_deletes=True)
+
     def __init__(self, **kwargs):
         """
         Instantiates a Folder object.
@@ -37,6 +47,9 @@ class Folder(db.Model):
 class Item(db.Model):
     # Class attributes for SQLAlchemy
     __tablename__ = 'items'
+    __table_args__ = (
+        db.Index('ix_items_folder_id', 'folder_id'),  # ItemDB.get_by_folder_id() and the folder page
+    )
 
     # Table columns
     id = db.Column(db.Integer, primary_key=True)
@@ -45,11 +58,15 @@ class Item(db.Model):
     published = db.Column(db.Boolean)
     media = db.Column(db.String, nullable=True)
     folder_id = db.Column(db.Integer, db.ForeignKey(Folder.__tablename__ + '.id'))  # Add a link to the folder id
-    folder_name = db.Column(db.String, db.ForeignKey(Folder.__tablename__ + '.name'))  # Add a link to the folder name
+    folder_name = db.Column(db.String)  # Name of the folder, folder names are not unique so this is not a foreign key
 
     created = db.Column(db.DateTime)
     updated = db.Column(db.DateTime)
 
+    # Relationships, see Folder. Deleting an item leaves its sales as they are.
+    folder = db.relationship(Folder, back_populates='items', lazy='raise_on_sql')
+    sales = db.relationship('Sale', back_populates='item', lazy='raise_on_sql', passive_deletes=True)
+
     def __init__(self, **kwargs):
         """
         Instantiate an Item object. This Item contains only relevant information provided by the API response.
@@ -78,17 +95,26 @@ class Sale(db.Model):
     STATUS_HTTP_ERROR = 'http_error'
     STATUS_SDD_NOT_SIGNED = 'sdd_not_signed'
     STATUS_UNKNOWN_ERROR = 'unknown_error'
+    STATUS_POSTING = 'posting'  # Claimed by an outbox worker which is posting it right now
+    STATUS_FAILED = 'failed'  # The outbox gave up after the max nr of attempts
+    STATUS_UNCONFIRMED = 'unconfirmed'  # The API may have booked it (e.g. after a read timeout), it must be reconciled
     STATUS_OK = 'ok'
 
     # Class attributes for SQLAlchemy
     __tablename__ = 'sale'
+    __table_args__ = (
+        db.Index('ix_sale_user_id_created', 'user_id', 'created'),  # SaleDB.get_by_user_id() and the outbox batches
+        db.Index('ix_sale_item_id_created', 'item_id', 'created'),  # SaleDB.get_by_item_id()
+        db.Index('ix_sale_status_created', 'status', 'created'),  # Sales by status, e.g. all failed sales
+        db.Index('ix_sale_next_attempt', 'next_attempt'),  # Due sales of the outbox, see SaleOutbox.due()
+    )
 
     # Table columns
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)  # Store sales with a local ID
     quantity = db.Column(db.Integer)  # Quantity of item purchased
     total_price = db.Column(db.Integer)  # Total price of the sale (quantity * item.price) in cents
     item_id = db.Column(db.Integer, db.ForeignKey(Item.__tablename__ + '.id'))  # Add a link to the item id
-    item_name = db.Column(db.String, db.ForeignKey(Item.__tablename__ + '.name'))  # Add a link to the item name
+    item_name = db.Column(db.String)  # Name of the item, item names are not unique so this is not a foreign key
     user_id = db.Column(db.Integer, db.ForeignKey(User.__tablename__ + '.id'))  # Add a link to the user id
     user_s_number = db.Column(db.String, db.ForeignKey(User.__tablename__ + '.s_number'))  # Add a link to the s_number
 
@@ -96,11 +122,19 @@ class Sale(db.Model):
     api_reference = db.Column(db.String, nullable=True)  # Congressus sale reference
     api_created = db.Column(db.DateTime, nullable=True)  # Created according to the API
     status = db.Column(db.String)
-    error_msg = db.Column(db.String, nullable=True)
+    error_msg = db.Column(db.String, nullable=True)  # Error message of the last attempt to post this sale
+
+    attempts = db.Column(db.Integer)  # Nr of attempts of the outbox to post this sale
+    next_attempt = db.Column(db.DateTime, nullable=True)  # When the outbox should (re)try to post, None: never
 
     created = db.Column(db.DateTime)
     last_updated = db.Column(db.DateTime)
 
+    # Relationships, see Folder. The sales of a user are available as user.sales.
+    item = db.relationship(Item, back_populates='sales', lazy='raise_on_sql')
+    user = db.relationship(User, foreign_keys=[user_id], lazy='raise_on_sql',
+                           backref=db.backref('sales', lazy='raise_on_sql', passive_deletes=True))
+
     def __init__(self, **kwargs):
         """
         Instantiates a Sale object.
@@ -115,6 +149,8 @@ class Sale(db.Model):
         super().__init__(**kwargs)
         # self.total_price = quantity * self.item.price  # The total price is set
         self.status = self.STATUS_NOT_POSTED
+        self.attempts = 0
+        self.next_attempt = None
 
         self.created = datetime.now()
         self.last_updated = datetime.now()
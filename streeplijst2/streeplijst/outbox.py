@@ -0,0 +1,300 @@
+"""
+Sale outbox: sales are stored as pending during checkout and posted to the API by a background worker, so the checkout
+does not have to wait for Congressus. Sales of the same user which are made shortly after each other are posted in a
+single request.
+"""
+import logging
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+from requests.exceptions import HTTPError
+
+from streeplijst2.streeplijst.models import Sale
+from streeplijst2.streeplijst.database import SaleDB
+from streeplijst2.database import transaction, commit, bulk_update, require_no_transaction
+from streeplijst2.extensions import db
+from streeplijst2.config import OUTBOX_WORKERS, OUTBOX_POLL_INTERVAL, OUTBOX_MAX_ATTEMPTS, OUTBOX_BACKOFF, \
+    OUTBOX_BACKOFF_MAX, OUTBOX_CLAIM_TIMEOUT, SALE_BATCH_WINDOW, SALE_BATCH_MAX
+import streeplijst2.api as api
+import streeplijst2.metrics as metrics
+
+logger = logging.getLogger(__name__)
+
+_wakeup = threading.Event()  # Set when a sale is enqueued, so the worker does not wait for the next poll
+
+
+class SaleOutbox:
+    # Sales with these statuses are (re)posted when their next_attempt has passed. STATUS_POSTING and
+    # STATUS_UNCONFIRMED are not included: the API may already have booked those sales, so they are never posted again.
+    PENDING_STATUSES = (Sale.STATUS_NOT_POSTED, Sale.STATUS_TIMEOUT, Sale.STATUS_HTTP_ERROR, Sale.STATUS_UNKNOWN_ERROR)
+
+    @classmethod
+    def enqueue(cls, id: int, batch_window: float = SALE_BATCH_WINDOW) -> Sale:
+        """
+        Mark a sale as pending so the outbox worker posts it. The sale is posted after batch_window seconds, so more
+        sales of the same user can join it. If the user already has a sale which is waiting for its batch window, this
+        sale joins that batch and is posted at the same time.
+
+        :param id: The ID of the sale to post.
+        :param batch_window: Nr of seconds to wait for more sales of the same user (defaults to SALE_BATCH_WINDOW).
+        :return: The sale.
+        """
+        sale = SaleDB.get(id)
+        now = datetime.now()
+        open_batch = db.session.query(Sale.next_attempt) \
+            .filter(Sale.user_id == sale.user_id, Sale.status == Sale.STATUS_NOT_POSTED, Sale.next_attempt > now) \
+            .order_by(Sale.next_attempt) \
+            .first()
+        next_attempt = open_batch[0] if open_batch is not None else now + timedelta(seconds=batch_window)
+
+        sale = SaleDB.update(id=id, next_attempt=next_attempt)
+        _wakeup.set()
+        return sale
+
+    @classmethod
+    def enqueue_many(cls, ids: list) -> list:
+        """
+        Mark multiple sales as pending so the outbox worker posts them as soon as possible. Sales of the same user are
+        posted in a single request. Inside a transaction() block, the sales are posted once the block is committed.
+
+        :param ids: The IDs of the sales to post.
+        :return: A list of the sales, in the order of ids.
+        """
+        bulk_update(Sale, ids, dict(next_attempt=datetime.now()))
+        commit()
+        _wakeup.set()
+        return SaleDB.get_many(ids)
+
+    @classmethod
+    def due(cls, limit: int = 100) -> list:
+        """
+        List the IDs of the sales which should be posted now, oldest first.
+
+        :param limit: Max nr of IDs to return.
+        :return: A list of sale IDs.
+        """
+        query = db.session.query(Sale.id) \
+            .filter(Sale.status.in_(cls.PENDING_STATUSES), Sale.next_attempt <= datetime.now()) \
+            .order_by(Sale.next_attempt, Sale.id) \
+            .limit(limit)
+        return [id for (id,) in query]
+
+    @classmethod
+    def next_due(cls) -> datetime:
+        """
+        Return when the next pending sale should be posted.
+
+        :return: The earliest next_attempt of all pending sales, or None if there are no pending sales.
+        """
+        return db.session.query(db.func.min(Sale.next_attempt)) \
+            .filter(Sale.status.in_(cls.PENDING_STATUSES)) \
+            .scalar()
+
+    @classmethod
+    def batches(cls, ids: list, batch_max: int = SALE_BATCH_MAX) -> list:
+        """
+        Group sales per user, so the sales of one user can be posted in a single request.
+
+        :param ids: The IDs of the sales to group.
+        :param batch_max: Max nr of sales per batch (defaults to SALE_BATCH_MAX).
+        :return: A list of lists of sale IDs. All sales in a list are made by the same user.
+        """
+        per_user = dict()
+        for id in ids:
+            per_user.setdefault(SaleDB.get(id).user_id, []).append(id)
+
+        batches = []
+        for user_ids in per_user.values():
+            batches.extend(user_ids[start:start + batch_max] for start in range(0, len(user_ids), batch_max))
+        return batches
+
+    @classmethod
+    def claim(cls, id: int, claim_timeout: float = OUTBOX_CLAIM_TIMEOUT) -> bool:
+        """
+        Claim a due sale for posting. The claim is a single conditional UPDATE, so when multiple workers (or processes)
+        try to claim the same sale only one of them succeeds. The claim is committed at once, so it must not be made
+        inside a transaction() block.
+
+        :param id: The ID of the sale to claim.
+        :param claim_timeout: Nr of seconds after which the claim expires if the sale is not posted.
+        :return: True if the sale was claimed.
+        :raises RuntimeError: If this is called inside a transaction() block.
+        """
+        require_no_transaction('claim a sale')
+        table = Sale.__table__
+        now = datetime.now()
+        result = db.session.execute(
+            table.update()
+            .where(table.c.id == id)
+            .where(table.c.status.in_(cls.PENDING_STATUSES))
+            .where(table.c.next_attempt <= now)
+            .values(status=Sale.STATUS_POSTING, attempts=table.c.attempts + 1,
+                    next_attempt=now + timedelta(seconds=claim_timeout), last_updated=now))
+        db.session.commit()
+        return result.rowcount == 1
+
+    @classmethod
+    def expire_claims(cls) -> int:
+        """
+        Mark the sales with an expired claim as unconfirmed. The worker which claimed such a sale stopped responding,
+        possibly after it posted the sale, so the sale must be reconciled with the API instead of posted again. Like
+        claim(), this commits at once and must not be called inside a transaction() block.
+
+        :return: The nr of sales with an expired claim.
+        :raises RuntimeError: If this is called inside a transaction() block.
+        """
+        require_no_transaction('expire the claims of sales')
+        table = Sale.__table__
+        now = datetime.now()
+        result = db.session.execute(
+            table.update()
+            .where(table.c.status == Sale.STATUS_POSTING)
+            .where(table.c.next_attempt <= now)
+            .values(status=Sale.STATUS_UNCONFIRMED, next_attempt=None, last_updated=now,
+                    error_msg='The claim expired while the sale was being posted'))
+        db.session.commit()
+        if result.rowcount:
+            logger.error('The claims of %d sales expired while they were being posted, they must be reconciled',
+                         result.rowcount)
+            metrics.registry.count_sales(Sale.STATUS_UNCONFIRMED, result.rowcount)
+        return result.rowcount
+
+    @classmethod
+    def deliver(cls, ids: list, max_attempts: int = OUTBOX_MAX_ATTEMPTS, backoff: float = OUTBOX_BACKOFF,
+                backoff_max: float = OUTBOX_BACKOFF_MAX) -> list:
+        """
+        POST claimed sales of one user to the API in a single request and schedule a retry if that failed with an
+        error which may be temporary.
+
+        :param ids: The IDs of the claimed sales, which must all be made by the same user.
+        :param max_attempts: Max nr of attempts, after which a sale is marked as failed.
+        :param backoff: Nr of seconds before the first retry. The delay doubles with every attempt.
+        :param backoff_max: Max nr of seconds before a retry.
+        :return: A list of the sales, in the order of ids.
+        """
+        try:
+            SaleDB.post_sales(ids, final=False)  # A failed post may be retried, the final status is counted below
+            with transaction():  # Posted, so they should not be posted again
+                return [SaleDB.update(id=id, next_attempt=None) for id in ids]
+
+        except Exception as err:  # post_sales already stored the status and error message on the sales
+            with transaction():
+                return [cls._schedule_retry(id, err, max_attempts, backoff, backoff_max) for id in ids]
+
+    @classmethod
+    def _schedule_retry(cls, id: int, err: Exception, max_attempts: int, backoff: float, backoff_max: float) -> Sale:
+        """
+        Schedule the next attempt to post a sale after posting it failed, or stop trying.
+
+        :param id: The ID of the sale.
+        :param err: The error raised while posting the sale.
+        :param max_attempts: Max nr of attempts, after which the sale is marked as failed.
+        :param backoff: Nr of seconds before the first retry. The delay doubles with every attempt.
+        :param backoff_max: Max nr of seconds before a retry.
+        :return: The sale.
+        """
+        sale = SaleDB.get(id)
+        if sale.status == Sale.STATUS_UNCONFIRMED:
+            logger.error('Sale %s may have been booked by the API, it must be reconciled instead of posted again: %s',
+                         id, err)
+            metrics.registry.count_sales(sale.status)
+            return SaleDB.update(id=id, next_attempt=None)
+        if not cls.is_retryable(err):
+            logger.warning('Sale %s was not posted and will not be retried: %s', id, err)
+            metrics.registry.count_sales(sale.status)
+            return SaleDB.update(id=id, next_attempt=None)
+        if sale.attempts >= max_attempts:
+            logger.error('Sale %s was not posted after %d attempts: %s', id, sale.attempts, err)
+            metrics.registry.count_sales(Sale.STATUS_FAILED)
+            return SaleDB.update(id=id, status=Sale.STATUS_FAILED, next_attempt=None)
+
+        delay = min(backoff * 2 ** (sale.attempts - 1), backoff_max)
+        logger.info('Sale %s was not posted, retrying in %d seconds: %s', id, delay, err)
+        return SaleDB.update(id=id, next_attempt=datetime.now() + timedelta(seconds=delay))
+
+    @classmethod
+    def is_retryable(cls, err: Exception) -> bool:
+        """
+        Check if a sale can safely be posted again after this error. The sales are posted without an idempotency key,
+        so only requests which were not processed by the API are retried: connection errors and connect timeouts
+        before the request was sent, and 503 Service Unavailable responses. Client errors (e.g. an unknown user or
+        item, or an unsigned SDD mandate) will fail again, and after a read timeout or another server error the API may
+        already have booked the sale.
+
+        :param err: The error raised by SaleDB.post_sale().
+        :return: True if the sale should be retried.
+        """
+        if isinstance(err, HTTPError) and err.response is not None:
+            return err.response.status_code == 503
+        return api.request_not_sent(err)
+
+    @classmethod
+    def drain(cls, max_workers: int = OUTBOX_WORKERS, limit: int = 100, batch_max: int = SALE_BATCH_MAX) -> int:
+        """
+        Post all due sales, with one request per user and at most max_workers requests at the same time. Must be called
+        from inside an app context.
+
+        :param max_workers: Max nr of requests which are sent at the same time.
+        :param limit: Max nr of sales to post.
+        :param batch_max: Max nr of sales per request (defaults to SALE_BATCH_MAX).
+        :return: The nr of sales which were claimed and posted.
+        """
+        app = current_app._get_current_object()  # The app itself is passed to the threads, not the context local proxy
+
+        def deliver(ids):
+            with app.app_context():  # Every thread uses its own database session
+                cls.deliver(ids)
+
+        cls.expire_claims()
+        claimed = [id for id in cls.due(limit=limit) if cls.claim(id)]
+        if claimed:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for future in [executor.submit(deliver, ids) for ids in cls.batches(claimed, batch_max=batch_max)]:
+                    future.result()
+        return len(claimed)
+
+
+class OutboxWorker(threading.Thread):
+    """
+    Background thread which drains the sale outbox every poll interval, or directly when a sale is enqueued.
+    """
+
+    def __init__(self, app, max_workers: int = OUTBOX_WORKERS, poll_interval: float = OUTBOX_POLL_INTERVAL):
+        """
+        Instantiates an OutboxWorker. Call start() to start it.
+
+        :param app: The Flask app to create app contexts for.
+        :param max_workers: Max nr of sales which are posted at the same time.
+        :param poll_interval: Nr of seconds between checks for due sales.
+        """
+        super().__init__(name='sale-outbox', daemon=True)
+        self.app = app
+        self.max_workers = max_workers
+        self.poll_interval = poll_interval
+        self._stop_event = threading.Event()
+
+    def run(self) -> None:
+        while not self._stop_event.is_set():
+            _wakeup.clear()
+            wait = self.poll_interval
+            try:
+                with self.app.app_context():
+                    SaleOutbox.drain(max_workers=self.max_workers)
+                    next_due = SaleOutbox.next_due()
+                if next_due is not None:  # Wake up when the next batch window closes, if that is before the next poll
+                    wait = max(0.1, min(wait, (next_due - datetime.now()).total_seconds()))
+            except Exception:  # The worker must keep running, the sales are retried on the next poll
+                logger.exception('Draining the sale outbox failed')
+            _wakeup.wait(wait)
+
+    def stop(self, timeout: float = None) -> None:
+        """
+        Stop the worker after the current drain and wait for it.
+
+        :param timeout: (optional) Max nr of seconds to wait.
+        """
+        self._stop_event.set()
+        _wakeup.set()
+        self.join(timeout)
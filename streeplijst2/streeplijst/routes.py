@@ -1,9 +1,11 @@
-from flask import redirect, url_for, render_template, flash, session, Blueprint
+from flask import redirect, url_for, render_template, flash, session, Blueprint, current_app, request, jsonify
 
-from streeplijst2.config import FOLDERS, TEST_FOLDER_ID
+from streeplijst2.config import FOLDERS, TEST_FOLDER_ID, BACKGROUND_SYNC, CART_MAX_QUANTITY
 from streeplijst2.routes import login_required
 from streeplijst2.streeplijst.database import FolderDB, SaleDB, ItemDB, UserDB
-from streeplijst2.exceptions import Streeplijst2Warning, Streeplijst2Exception
+from streeplijst2.streeplijst.outbox import SaleOutbox
+from streeplijst2.streeplijst.catalog import get_catalog
+from streeplijst2.exceptions import Streeplijst2Warning, Streeplijst2Exception, NotInDatabaseException
 
 ##################################
 # Streeplijst specific blueprint #
@@ -12,6 +14,20 @@ from streeplijst2.exceptions import Streeplijst2Warning, Streeplijst2Exception
 bp_streeplijst = Blueprint('streeplijst', __name__, url_prefix='/streeplijst')
 
 
+def _load_folder(folder_id: int) -> tuple:
+    """
+    Load a folder and its items, from the catalog cache if it is enabled.
+
+    :param folder_id: The folder id.
+    :return: A tuple of the folder and a list of its items as read-only ItemRows.
+    """
+    if current_app.config['CATALOG_CACHE'] is True:  # Usually served from memory without any database query
+        folder = get_catalog().load_folder(folder_id, background_sync=BACKGROUND_SYNC)
+        return folder, folder.items
+    folder = FolderDB.load_folder(folder_id=folder_id, background_sync=BACKGROUND_SYNC)
+    return folder, ItemDB.get_rows_by_folder_id(folder_id)  # Read-only rows, the page does not change the items
+
+
 # Default page and folder contents
 @bp_streeplijst.route('/')  # This is the default page of /streeplijst
 @bp_streeplijst.route('/index')  # This is the default page of /streeplijst
@@ -25,14 +41,27 @@ def index():
 @bp_streeplijst.route('/folder/<int:folder_id>')  # When a folder is specified it is loaded
 def folder(folder_id=TEST_FOLDER_ID):  # TODO: Change default folder to a more useful folder.
     if 'user_id' in session:
-        loaded_folder = FolderDB.load_folder(folder_id=folder_id)
+        (loaded_folder, items) = _load_folder(folder_id)
         meta_folders = FOLDERS  # The folder metas for all folders are loaded to display at top of the screen
-        return render_template('folder.jinja2', meta_folders=meta_folders, folder=loaded_folder)
+        return render_template('folder.jinja2', meta_folders=meta_folders, folder=loaded_folder, items=items,
+                               cart_size=sum(_get_cart().values()))
     else:
         flash('Log in first.', 'message')
         return redirect(url_for('home.login'))
 
 
+@bp_streeplijst.route('/api/folder/<int:folder_id>')
+@login_required
+def folder_json(folder_id):
+    (loaded_folder, items) = _load_folder(folder_id)
+    return jsonify(id=loaded_folder.id, name=loaded_folder.name, items=[item._asdict() for item in items])
+
+
+@bp_streeplijst.route('/api/catalog/stats')
+def catalog_stats():
+    return jsonify(get_catalog().stats())
+
+
 @bp_streeplijst.route('/sale', methods=['POST'])
 def sale():
     # quantity = request.form['quantity']
@@ -48,10 +77,98 @@ def sale():
     user = UserDB.get(user_id)
     sale = SaleDB.create_quick(quantity=quantity, item_id=item_id, user_id=user_id)
 
+    if current_app.config['SALE_OUTBOX'] is True:  # The sale is posted by the outbox worker, so do not wait for it
+        sale = SaleOutbox.enqueue(sale.id)
+    else:
+        try:
+            sale = SaleDB.post_sale(sale.id)
+        except Streeplijst2Warning as err:
+            flash(str(err))
+
+    meta_folders = FOLDERS  # The folder metas for all folders are loaded to display at top of the screen
+    return render_template('checkout.jinja2', meta_folders=meta_folders, lines=[(sale, item)], user=user)
+
+
+def _get_cart() -> dict:
+    """
+    Return the cart of the logged in user, which is stored in the session.
+
+    :return: A dict with the quantity per item ID.
+    """
+    return dict((int(item_id), quantity) for (item_id, quantity) in session.get('cart', dict()).items())
+
+
+def _set_cart(cart: dict) -> None:
+    """
+    Store the cart of the logged in user in the session.
+
+    :param cart: A dict with the quantity per item ID.
+    """
+    session['cart'] = dict((str(item_id), quantity) for (item_id, quantity) in cart.items())  # JSON needs str keys
+
+
+@bp_streeplijst.route('/cart/add', methods=['POST'])
+@login_required
+def cart_add():
+    back = redirect(request.referrer or url_for('streeplijst.folder'))  # Go back to the folder the item was added from
+    try:
+        item_id = int(request.form['item-id'])
+        quantity = int(request.form.get('quantity', 1))
+    except ValueError:
+        flash('Invalid item or quantity.', 'error')
+        return back
+
+    cart = _get_cart()
+    if quantity < 1 or cart.get(item_id, 0) + quantity > CART_MAX_QUANTITY:  # A sale of 0 or less would be a credit
+        flash('The quantity must be a whole number from 1 to %d per item.' % CART_MAX_QUANTITY, 'error')
+        return back
+    cart[item_id] = cart.get(item_id, 0) + quantity
+    _set_cart(cart)
+    return back
+
+
+@bp_streeplijst.route('/cart/remove', methods=['POST'])
+@login_required
+def cart_remove():
+    back = redirect(request.referrer or url_for('streeplijst.folder'))
     try:
-        sale = SaleDB.post_sale(sale.id)
-    except Streeplijst2Warning as err:
-        flash(str(err))
+        item_id = int(request.form['item-id'])
+    except ValueError:
+        flash('Invalid item.', 'error')
+        return back
+
+    cart = _get_cart()
+    cart.pop(item_id, None)
+    _set_cart(cart)
+    return back
+
+
+@bp_streeplijst.route('/checkout', methods=['POST'])
+@login_required
+def checkout():
+    cart = _get_cart()
+    if not cart:  # There is nothing to buy
+        flash('Your cart is empty.', 'message')
+        return redirect(url_for('streeplijst.folder'))
+
+    user_id = session['user_id']
+    try:
+        sales = SaleDB.create_many(user_id=user_id, lines=cart)  # All sales are stored in a single transaction
+    except NotInDatabaseException as err:
+        flash(str(err), 'error')
+        return redirect(url_for('streeplijst.folder'))
+    _set_cart(dict())  # The cart is stored as sales, so it can be emptied
+
+    sale_ids = [sale.id for sale in sales]
+    if current_app.config['SALE_OUTBOX'] is True:  # The sales are posted by the outbox worker in a single request
+        SaleOutbox.enqueue_many(sale_ids)
+    else:
+        try:
+            SaleDB.post_sales(sale_ids)  # All sales are posted in a single request
+        except Exception as err:  # post_sales already stored the status and error on the sales, which are shown below
+            flash(str(err), 'error')
 
+    sales = SaleDB.get_many(sale_ids, with_items=True)  # Two queries, however many lines there are
+    lines = [(sale, sale.item) for sale in sales]  # Every line shows the sale and the item it is for
     meta_folders = FOLDERS  # The folder metas for all folders are loaded to display at top of the screen
-    return render_template('checkout.jinja2', meta_folders=meta_folders, sale=sale, item=item, user=user)
+    return render_template('checkout.jinja2', meta_folders=meta_folders, lines=lines, user=UserDB.get(user_id))
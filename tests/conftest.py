@@ -1,8 +1,25 @@
 import os
+from datetime import datetime
+from pathlib import Path
 
 import pytest
+from sqlalchemy import event
 
-from streeplijst2 import create_app
+# The config module loads the credentials when it is imported, so a checkout without credentials gets dummy ones first.
+# The credentials file is never tracked, and an existing file (e.g. with a real token) is left alone.
+CREDENTIALS_FILE = Path(__file__).resolve().parent.parent / 'instance' / 'credentials.yaml'
+if not CREDENTIALS_FILE.exists():
+    CREDENTIALS_FILE.parent.mkdir(exist_ok=True)
+    CREDENTIALS_FILE.write_text('DEV_KEY: dev\nSECRET_KEY: test\nTOKEN: test\n')
+
+from streeplijst2 import create_app  # noqa: E402 (needs the credentials)
+from streeplijst2.config import TEST_USER
+from streeplijst2.congressus_stub import CongressusStub
+from streeplijst2.database import UserDB
+from streeplijst2.extensions import db
+import streeplijst2.api as api
+
+LIVE_API = os.environ.get('STREEPLIJST_LIVE_API') == '1'  # Set to 1 to run the tests against the real Congressus API
 
 
 @pytest.fixture(scope="module")
@@ -29,7 +46,46 @@ def test_app(script_loc, db_uri_string):
     yield test_app  # app is yielded instead of returned to allow closing any other connections after this line.
 
     # If any connections need to be closed they go below this line
+    with test_app.app_context():
+        db.session.remove()
+        db.engine.dispose()  # Close the pooled connections, so they cannot touch the database of the next test
     os.remove(db_uri_string)  # Remove the temporary database file
+    for suffix in ('-wal', '-shm'):  # Remove the write-ahead log files if they were not removed when closing
+        if os.path.exists(db_uri_string + suffix):
+            os.remove(db_uri_string + suffix)
+
+
+class QueryCounter:
+    """
+    Record the SQL statements which an app sends to its database while the counter is active, e.g. to find N+1 query
+    patterns in a request. An executemany counts as a single statement.
+    """
+
+    def __init__(self, app):
+        with app.app_context():
+            self.engine = db.engine
+        self.statements = []
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self._record)
+
+    def _record(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    @property
+    def selects(self) -> list:
+        """The recorded SELECT statements."""
+        return [statement for statement in self.statements if statement.startswith('SELECT')]
+
+
+@pytest.fixture
+def count_queries(test_app):
+    """Count the queries of the test app, use it as: with count_queries() as queries: client.get(...)"""
+    return lambda: QueryCounter(test_app)
 
 
 @pytest.fixture
@@ -38,7 +94,65 @@ def client(test_app):
     return test_app.test_client()
 
 
+@pytest.fixture
+def login(client, test_app):
+    """Log in through the login page, use it as: login(user). The user (defaults to the test user) is stored in the
+    database first, so the login makes no API request."""
+
+    def login_user(user: dict = TEST_USER):
+        with test_app.app_context():
+            UserDB.create(**user)
+        return client.post('/login', data={'s-number': user['s_number']})
+
+    return login_user
+
+
+@pytest.fixture
+def fake_post_sale_items():
+    """Make replacements for api.post_sale_items, use it as:
+    monkeypatch.setattr(api, 'post_sale_items', fake_post_sale_items(error, calls, price, prices))"""
+
+    def make(error: Exception = None, calls: list = None, price: int = 0, prices: dict = None):
+        """Return a replacement which raises error, or which returns a successful response with every item sold for
+        price cents, or for its price in prices (by item id). The items of every call are appended to calls."""
+
+        def post_sale_items(user_id, items, timeout=None):
+            if calls is not None:
+                calls.append(items)
+            if error is not None:
+                raise error
+            sold = []
+            for item in items:
+                item_price = (prices or dict()).get(item['product_id'], price)
+                sold.append(dict(item, price=item_price, total_price=item['quantity'] * item_price))
+            return dict({'id': 1, 'reference': 'REF1', 'created': datetime.now(), 'items': sold})
+
+        return post_sale_items
+
+    return make
+
+
 @pytest.fixture
 def runner(test_app):
     """A test runner for the app's Click commands."""
     return test_app.test_cli_runner()
+
+
+@pytest.fixture(scope="session")
+def congressus_stub_server():
+    """Start the Congressus stand-in once for all tests."""
+    stub = CongressusStub(latency=0.02)  # Slow enough to make the tests with a 0.001 second timeout time out
+    stub.start()
+    yield stub
+    stub.stop()
+
+
+@pytest.fixture(autouse=True)
+def congressus_stub(congressus_stub_server, monkeypatch, tmp_path):
+    """Send all API calls of a test to the Congressus stand-in, with an empty response cache."""
+    congressus_stub_server.reset()
+    if not LIVE_API:
+        monkeypatch.setattr(api, 'client', api.CongressusClient(base_url=congressus_stub_server.url,
+                                                                cache=api.ResponseCache(tmp_path / 'api_cache')))
+    yield congressus_stub_server
+    congressus_stub_server.latency = 0.02  # Undo any latency set by the test
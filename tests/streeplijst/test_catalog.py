@@ -0,0 +1,94 @@
+from datetime import datetime
+
+import pytest
+
+from streeplijst2.config import TEST_FOLDER, TEST_ITEM, TEST_ITEM_2, TEST_USER
+from streeplijst2.extensions import db
+from streeplijst2.streeplijst.catalog import get_catalog
+from streeplijst2.streeplijst.database import FolderDB, ItemDB, transaction
+from streeplijst2.streeplijst.models import Folder, Item
+
+
+def add_catalog_test_data(test_app):
+    """Store a synchronized test folder with both test items."""
+    with test_app.app_context():
+        FolderDB.create(**TEST_FOLDER)
+        FolderDB.update(TEST_FOLDER['id'], synchronized=datetime.now())  # The folder does not need to sync
+        ItemDB.create(**TEST_ITEM)
+        ItemDB.create(**TEST_ITEM_2)
+
+
+def test_catalog_hit(test_app):
+    add_catalog_test_data(test_app)
+    with test_app.app_context():
+        catalog = get_catalog()
+        folder = catalog.load_folder(TEST_FOLDER['id'])
+        assert folder.name == TEST_FOLDER['name']
+        assert [item.id for item in folder.items] == [TEST_ITEM['id'], TEST_ITEM_2['id']]
+        assert catalog.load_folder(TEST_FOLDER['id']) is folder  # The second load is served from the cache
+
+        stats = catalog.stats()
+        assert stats['hits'] == 1 and stats['misses'] == 1 and stats['rebuilds'] == 1 and stats['hit_rate'] == 0.5
+
+
+def test_catalog_local_change(test_app):
+    add_catalog_test_data(test_app)
+    with test_app.app_context():
+        catalog = get_catalog()
+        catalog.check_interval = 3600  # Only the changes of this process are noticed
+        folder = catalog.get(TEST_FOLDER['id'])
+
+        ItemDB.update(TEST_ITEM['id'], price=75)
+        changed_folder = catalog.get(TEST_FOLDER['id'])
+        assert changed_folder is not folder and changed_folder.items[0].price == 75  # Rebuilt after the commit
+
+        ItemDB.update(TEST_ITEM['id'], price=75)  # Nothing changes, so the folder is not rebuilt
+        assert catalog.get(TEST_FOLDER['id']) is changed_folder
+
+
+def test_catalog_rollback(test_app):
+    add_catalog_test_data(test_app)
+    with test_app.app_context():
+        catalog = get_catalog()
+        folder = catalog.get(TEST_FOLDER['id'])
+        with pytest.raises(ValueError):
+            with transaction():
+                ItemDB.update(TEST_ITEM['id'], price=75)
+                raise ValueError()
+        assert catalog.get(TEST_FOLDER['id']) is folder  # The change was rolled back, so the folder is still valid
+
+
+def test_catalog_change_by_other_process(test_app):
+    add_catalog_test_data(test_app)
+    with test_app.app_context():
+        catalog = get_catalog()
+        catalog.check_interval = 3600
+        folder = catalog.get(TEST_FOLDER['id'])
+
+        # Another process changes a price and bumps the generation, this process does not see the commit
+        (items, folders) = (Item.__table__, Folder.__table__)
+        with db.engine.begin() as connection:
+            connection.execute(items.update().where(items.c.id == TEST_ITEM['id']).values(price=99))
+            connection.execute(folders.update().values(generation=folders.c.generation + 1))
+
+        assert catalog.get(TEST_FOLDER['id']) is folder  # Not checked yet
+        catalog.check_interval = 0
+        assert catalog.get(TEST_FOLDER['id']).items[0].price == 99  # The generation changed, so it is rebuilt
+
+
+def test_folder_page_without_queries(client, test_app, count_queries):
+    add_catalog_test_data(test_app)
+    with client.session_transaction() as session:
+        session['user_id'] = TEST_USER['id']
+        session['user_first_name'] = TEST_USER['first_name']
+    with test_app.app_context():
+        get_catalog().check_interval = 3600
+
+    client.get('/streeplijst/folder/%d' % TEST_FOLDER['id'])  # Fills the cache
+    with count_queries() as queries:
+        response = client.get('/streeplijst/folder/%d' % TEST_FOLDER['id'])
+    assert TEST_ITEM['name'].encode() in response.data
+    assert queries.selects == []  # Make sure the page was served without any database reads
+
+    response = client.get('/streeplijst/api/catalog/stats')
+    assert response.get_json()['hits'] == 1
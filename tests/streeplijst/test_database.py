@@ -5,13 +5,18 @@
 import pytest
 import copy
 from datetime import datetime, timedelta
+import threading
 import time
 
 from streeplijst2.config import TEST_FOLDER, TEST_USER, TEST_ITEM, TEST_USER_NO_SDD, TEST_ITEM_2
-from streeplijst2.database import UserDB
-from streeplijst2.streeplijst.database import FolderDB, ItemDB, SaleDB, Sale
+from streeplijst2.database import UserDB, transaction
+from streeplijst2.streeplijst.database import FolderDB, ItemDB, ItemRow, SaleDB, Sale
+from streeplijst2.streeplijst.models import Folder
 from streeplijst2.exceptions import HTTPError, Timeout, TotalPriceMismatchWarning, NotInDatabaseException
+from streeplijst2.extensions import db
 import streeplijst2.api as api
+import streeplijst2.background as background
+from sqlalchemy.exc import InvalidRequestError
 
 TEST_FOLDER_NO_MEDIA = copy.deepcopy(TEST_FOLDER)
 TEST_FOLDER_NO_MEDIA.pop('media', None)  # Remove the media field
@@ -111,6 +116,30 @@ class TestFolder:
             items = FolderDB.get_items_in_folder(folder.id)
             assert len(items) == 0  # Make sure there are no items in
 
+    def test_get_folder_with_items(self, test_app):
+        with test_app.app_context():
+            FolderDB.create(**TEST_FOLDER)
+            ItemDB.create(**TEST_ITEM_2)
+            ItemDB.create(**TEST_ITEM)
+            db.session.expire_all()
+
+            folder = FolderDB.get(TEST_FOLDER['id'])
+            with pytest.raises(InvalidRequestError):
+                folder.items  # The items are never loaded lazily
+            folder = FolderDB.get(TEST_FOLDER['id'], with_items=True)
+            assert [item.id for item in folder.items] == sorted([TEST_ITEM['id'], TEST_ITEM_2['id']])
+            assert folder.items[0].folder is folder
+
+            folders = FolderDB.list_all(with_items=True)
+            assert [len(folder.items) for folder in folders] == [2]
+
+    def test_delete_folder_keeps_items(self, test_app):
+        with test_app.app_context():
+            FolderDB.create(**TEST_FOLDER)
+            ItemDB.create(**TEST_ITEM)
+            FolderDB.delete(TEST_FOLDER['id'])
+            assert ItemDB.get(TEST_ITEM['id']).folder_id == TEST_FOLDER['id']  # Sales may still refer to the item
+
 
 class TestFolderAPI:
 
@@ -151,6 +180,284 @@ class TestFolderAPI:
                 folder = FolderDB.load_folder(TEST_FOLDER['id'])
 
 
+def fake_products_in_folder(delay: float = 0):
+    """Return a replacement for api.get_products_in_folder which returns one item per folder after a delay."""
+
+    def get_products_in_folder(folder_id, timeout=None, synchronized=None):
+        time.sleep(delay)
+        return [dict({'id': folder_id * 10, 'name': 'Item %d' % folder_id, 'price': 100, 'published': True,
+                      'folder_id': folder_id, 'folder_name': 'Folder %d' % folder_id, 'media': ''})]
+
+    return get_products_in_folder
+
+
+class TestFolderSync:
+
+    def test_sync_many(self, test_app, monkeypatch):
+        monkeypatch.setattr(api, 'get_products_in_folder', fake_products_in_folder(delay=0.3))
+        with test_app.app_context():
+            for folder_id in range(1, 5):
+                FolderDB.create(id=folder_id, name='Folder %d' % folder_id)
+
+            start = time.perf_counter()
+            folders = FolderDB.sync_many([1, 2, 3, 4])
+            duration = time.perf_counter() - start
+
+            assert duration < 4 * 0.3  # The folders are fetched at the same time
+            assert [folder.id for folder in folders] == [1, 2, 3, 4]  # The order of the folder ids is kept
+            for folder in folders:
+                assert folder.synchronized > datetime.now() - timedelta(seconds=5)
+                assert len(FolderDB.get_items_in_folder(folder.id)) == 1
+
+    def test_sync_many_up_to_date(self, test_app, monkeypatch):
+        monkeypatch.setattr(api, 'get_products_in_folder', fake_products_in_folder())
+        with test_app.app_context():
+            FolderDB.create(id=1, name='Folder 1')
+            FolderDB.sync_many([1])
+            last_synchronized = FolderDB.get(1).synchronized
+
+            FolderDB.sync_many([1])  # The folder was just synchronized, so it should not sync again
+            assert FolderDB.get(1).synchronized == last_synchronized
+
+            FolderDB.sync_many([1], force_sync=True)
+            assert FolderDB.get(1).synchronized > last_synchronized
+
+    def test_sync_many_error(self, test_app, monkeypatch):
+        fake = fake_products_in_folder()
+
+        def get_products_in_folder(folder_id, timeout=None, synchronized=None):
+            if folder_id == 2:
+                raise Timeout('Folder 2 timed out')
+            return fake(folder_id)
+
+        monkeypatch.setattr(api, 'get_products_in_folder', get_products_in_folder)
+        with test_app.app_context():
+            FolderDB.create(id=1, name='Folder 1')
+            FolderDB.create(id=2, name='Folder 2')
+            with pytest.raises(Timeout):
+                FolderDB.sync_many([1, 2])
+            assert len(FolderDB.get_items_in_folder(1)) == 1  # The other folder is still stored
+            assert FolderDB.get(2).synchronized == datetime.min
+
+    def test_sync_folder(self, test_app, monkeypatch):
+        monkeypatch.setattr(api, 'get_products_in_folder', fake_products_in_folder())
+        with test_app.app_context():
+            folder = FolderDB.create(id=1, name='Folder 1')
+            assert FolderDB.sync_folder(1).added == [10]
+            assert FolderDB.sync_folder(1).has_changes is False
+            assert folder.synchronized > datetime.now() - timedelta(seconds=5)
+
+    def test_load_folder_background_sync(self, test_app, monkeypatch):
+        monkeypatch.setattr(api, 'get_products_in_folder', fake_products_in_folder())
+        with test_app.app_context():
+            FolderDB.create(id=1, name='Folder 1')
+            folder = FolderDB.load_folder(1, background_sync=True)  # Never synchronized, so it synchronizes directly
+            last_synchronized = folder.synchronized
+            assert last_synchronized > datetime.min
+
+            monkeypatch.setattr(api, 'get_products_in_folder', fake_products_in_folder(delay=0.3))
+            start = time.perf_counter()
+            folder = FolderDB.load_folder(1, force_sync=True, background_sync=True)
+            assert time.perf_counter() - start < 0.3  # The folder is returned without waiting for the API
+            assert folder.synchronized == last_synchronized
+            assert background.is_running(('folder', 1))
+
+            background.join(('folder', 1))
+            db.session.expire_all()  # The folder was changed by another session
+            assert FolderDB.get(1).synchronized > last_synchronized
+
+    def test_load_folder_background_sync_once(self, test_app, monkeypatch):
+        calls = []
+        fake = fake_products_in_folder(delay=0.3)
+
+        def get_products_in_folder(folder_id, timeout=None, synchronized=None):
+            calls.append(folder_id)
+            return fake(folder_id)
+
+        with test_app.app_context():
+            FolderDB.create(id=1, name='Folder 1')
+            FolderDB.update(1, synchronized=datetime(2020, 1, 1))  # The folder is outdated
+            monkeypatch.setattr(api, 'get_products_in_folder', get_products_in_folder)
+            for _ in range(5):
+                FolderDB.load_folder(1, background_sync=True)
+            background.join(('folder', 1))
+            assert len(calls) == 1  # Only one refresh was in flight
+
+    def test_load_folder_background_sync_error(self, test_app, monkeypatch):
+        def get_products_in_folder(folder_id, timeout=None, synchronized=None):
+            raise Timeout('Congressus is down')
+
+        monkeypatch.setattr(api, 'get_products_in_folder', get_products_in_folder)
+        with test_app.app_context():
+            FolderDB.create(id=1, name='Folder 1')
+            FolderDB.update(1, synchronized=datetime(2020, 1, 1))
+            folder = FolderDB.load_folder(1, background_sync=True)  # The error is not raised to the caller
+            background.join(('folder', 1))
+
+            db.session.expire_all()
+            folder = FolderDB.get(1)
+            assert folder.sync_error == 'Congressus is down'
+            assert folder.sync_failed > datetime.now() - timedelta(seconds=5)
+            assert folder.synchronized == datetime(2020, 1, 1)
+
+            FolderDB.load_folder(1, background_sync=True)  # The last refresh failed just now, so it is not retried
+            assert background.is_running(('folder', 1)) is False
+
+    def test_sync_folder_not_modified(self, test_app, monkeypatch):
+        calls = []
+
+        def get_products_in_folder(folder_id, timeout=None, synchronized=None):
+            calls.append(synchronized)
+            return None  # The API response did not change since the last synchronization
+
+        with test_app.app_context():
+            FolderDB.create(id=1, name='Folder 1')
+            monkeypatch.setattr(api, 'get_products_in_folder', fake_products_in_folder())
+            FolderDB.sync_folder(1)
+            synchronized = FolderDB.get(1).synchronized
+
+            monkeypatch.setattr(api, 'get_products_in_folder', get_products_in_folder)
+            diff = FolderDB.sync_folder(1)
+            assert calls == [synchronized]  # The API is told when the folder was last stored
+            assert diff.has_changes is False
+            assert FolderDB.get(1).synchronized > synchronized
+            assert [item.id for item in ItemDB.get_by_folder_id(1)] == [10]  # The stored items are kept
+
+    def test_load_folder_coalesced(self, test_app, monkeypatch):
+        calls = []
+
+        def get_products_in_folder(folder_id, timeout=None, synchronized=None):
+            calls.append(folder_id)
+            return fake_products_in_folder(delay=0.3)(folder_id)
+
+        monkeypatch.setattr(api, 'get_products_in_folder', get_products_in_folder)
+        with test_app.app_context():
+            FolderDB.create(id=1, name='Folder 1')
+
+        def load_folder():
+            with test_app.app_context():  # Every thread uses its own database session
+                folder = FolderDB.load_folder(1, force_sync=True)
+                synchronized.append(folder.synchronized)
+
+        synchronized = []
+        threads = [threading.Thread(target=load_folder) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        assert calls == [1]  # The folder was synchronized once, the other threads waited for it
+        assert len(synchronized) == 5 and all(time > datetime.min for time in synchronized)
+
+    def test_lease(self, test_app):
+        with test_app.app_context():
+            FolderDB.create(id=1, name='Folder 1')
+            lease = FolderDB.acquire_lease(1)
+            assert lease is not None and FolderDB.get(1).lease_owner == lease
+            assert FolderDB.acquire_lease(1) is None  # Only one process can hold the lease
+
+            assert FolderDB.release_lease(1, 'another process') is False  # Only the owner can release the lease
+            assert FolderDB.release_lease(1, lease) is True
+            assert FolderDB.acquire_lease(1) is not None
+
+    def test_lease_transaction(self, test_app):
+        with test_app.app_context():
+            with transaction():
+                FolderDB.create(id=1, name='Folder 1')
+                with pytest.raises(RuntimeError):
+                    FolderDB.acquire_lease(1)  # Would commit the folder before the end of the block
+            assert FolderDB.get(1).lease_owner is None
+
+    def test_lease_expired(self, test_app):
+        with test_app.app_context():
+            FolderDB.create(id=1, name='Folder 1')
+            lease = FolderDB.acquire_lease(1, lease_timeout=-1)  # The owner stopped responding
+            new_lease = FolderDB.acquire_lease(1)
+            assert new_lease is not None  # The expired lease is reclaimed
+            assert FolderDB.release_lease(1, lease) is False  # The old owner can no longer release it
+
+    def test_sync_folder_leased(self, test_app, monkeypatch):
+        calls = []
+
+        def get_products_in_folder(folder_id, timeout=None, synchronized=None):
+            calls.append(folder_id)
+            return fake_products_in_folder()(folder_id)
+
+        monkeypatch.setattr(api, 'get_products_in_folder', get_products_in_folder)
+        with test_app.app_context():
+            FolderDB.create(id=1, name='Folder 1')
+            FolderDB.sync_folder(1)
+            FolderDB.acquire_lease(1)  # Another process is synchronizing the folder
+
+            diff = FolderDB.sync_folder(1)
+            assert calls == [1]  # The folder was not synchronized again
+            assert diff.has_changes is False
+            assert [item.id for item in ItemDB.get_by_folder_id(1)] == [10]  # The stored items are still served
+
+    def test_sync_folder_wait_for_lease(self, test_app, monkeypatch):
+        monkeypatch.setattr(api, 'get_products_in_folder', fake_products_in_folder())
+        with test_app.app_context():
+            FolderDB.create(id=1, name='Folder 1')
+            FolderDB.acquire_lease(1, lease_timeout=0.5)  # Another process stops while synchronizing the folder
+
+            start = time.time()
+            diff = FolderDB.sync_folder(1)  # The folder was never synchronized, so it waits until the lease expires
+            assert time.time() - start >= 0.4
+            assert diff.added == [10]
+            assert FolderDB.get(1).lease_owner is None  # The lease is released after the synchronization
+
+    def test_sync_many_leased(self, test_app, monkeypatch):
+        calls = []
+
+        def get_products_in_folder(folder_id, timeout=None, synchronized=None):
+            calls.append(folder_id)
+            return fake_products_in_folder()(folder_id)
+
+        monkeypatch.setattr(api, 'get_products_in_folder', get_products_in_folder)
+        with test_app.app_context():
+            for folder_id in (1, 2):
+                FolderDB.create(id=folder_id, name='Folder %d' % folder_id)
+                FolderDB.update(folder_id, synchronized=datetime(2020, 1, 1))
+            FolderDB.acquire_lease(2)  # Another process is synchronizing folder 2
+
+            FolderDB.sync_many([1, 2])
+            assert calls == [1]
+            assert FolderDB.get(1).lease_owner is None
+
+    @pytest.mark.parametrize('sync', [lambda: FolderDB.load_folder(1), lambda: FolderDB.sync_many([1])])
+    def test_sync_synchronized_meanwhile(self, test_app, monkeypatch, sync):
+        calls = []
+
+        def get_products_in_folder(folder_id, timeout=None, synchronized=None):
+            calls.append(folder_id)
+            return fake_products_in_folder()(folder_id)
+
+        acquire_lease = FolderDB.acquire_lease
+
+        def acquire_lease_after_other_process(folder_id, **kwargs):
+            with db.engine.begin() as connection:  # Another process synchronized the folder and released its lease
+                connection.execute(Folder.__table__.update().where(Folder.__table__.c.id == folder_id)
+                                   .values(synchronized=datetime.now()))
+            return acquire_lease(folder_id, **kwargs)
+
+        monkeypatch.setattr(api, 'get_products_in_folder', get_products_in_folder)
+        monkeypatch.setattr(FolderDB, 'acquire_lease', acquire_lease_after_other_process)
+        with test_app.app_context():
+            FolderDB.create(id=1, name='Folder 1')
+            FolderDB.update(1, synchronized=datetime(2020, 1, 1))  # Outdated when the sync starts
+
+            sync()
+            assert calls == []  # The folder was not synchronized again after taking the lease
+            assert FolderDB.get(1).lease_owner is None
+
+            FolderDB.load_folder(1, force_sync=True)
+            assert calls == [1]  # A forced synchronization is always made
+
+    def test_sync_many_not_in_db(self, test_app):
+        with test_app.app_context():
+            with pytest.raises(NotInDatabaseException):
+                FolderDB.sync_many([1])
+
+
 class TestItem:
 
     def test_list_all_items(self, test_app):
@@ -164,6 +471,63 @@ class TestItem:
             else:
                 assert item_list[0] is item2 and item_list[1] == item1
 
+    def test_bulk_upsert(self, test_app):
+        with test_app.app_context():
+            diff = ItemDB.bulk_upsert([TEST_ITEM, TEST_ITEM_2])
+            assert diff.counts() == dict(added=2, changed=0, removed=0, unchanged=0)
+            for (key, value) in TEST_ITEM.items():  # Make sure all fields are stored correctly
+                assert ItemDB.get(TEST_ITEM['id']).__getattribute__(key) == value
+
+            changed_item = copy.deepcopy(TEST_ITEM)
+            changed_item['price'] = 250
+            diff = ItemDB.bulk_upsert([changed_item, TEST_ITEM_2])
+            assert diff.counts() == dict(added=0, changed=1, removed=0, unchanged=1)
+            assert diff.changed == [TEST_ITEM['id']]
+            assert ItemDB.get(TEST_ITEM['id']).price == 250
+            assert len(ItemDB.list_all()) == 2
+
+    def test_bulk_upsert_many(self, test_app):
+        with test_app.app_context():
+            items = [dict(TEST_ITEM, id=item_id) for item_id in range(1, 1201)]  # More items than a single SELECT
+            assert len(ItemDB.bulk_upsert(items).added) == 1200
+            assert ItemDB.bulk_upsert(items).unchanged == 1200
+
+    def test_bulk_upsert_unchanged(self, test_app):
+        with test_app.app_context():
+            ItemDB.bulk_upsert([TEST_ITEM])
+            updated = ItemDB.get(TEST_ITEM['id']).updated
+            diff = ItemDB.bulk_upsert([TEST_ITEM])
+            assert diff.has_changes is False
+            assert ItemDB.get(TEST_ITEM['id']).updated == updated  # The row is not rewritten
+
+    def test_bulk_upsert_removed(self, test_app):
+        with test_app.app_context():
+            ItemDB.bulk_upsert([TEST_ITEM, TEST_ITEM_2])
+            diff = ItemDB.bulk_upsert([TEST_ITEM], folder_id=TEST_ITEM['folder_id'])
+            assert diff.removed == [TEST_ITEM_2['id']]
+            assert ItemDB.get(TEST_ITEM_2['id']) is not None  # Removed items are reported, not deleted
+
+    def test_update_item_unchanged(self, test_app):
+        with test_app.app_context():
+            item = ItemDB.create(**TEST_ITEM)
+            updated = item.updated
+            ItemDB.update(**TEST_ITEM)  # Nothing changes, so the item is not written
+            assert item.updated == updated
+
+            ItemDB.update(id=TEST_ITEM['id'], price=50)
+            assert item.price == 50 and item.updated > updated
+
+    def test_get_rows_by_folder_id(self, test_app):
+        with test_app.app_context():
+            ItemDB.create(**TEST_ITEM_2)
+            ItemDB.create(**TEST_ITEM)
+            rows = ItemDB.get_rows_by_folder_id(TEST_ITEM['folder_id'])
+            assert [row.id for row in rows] == [TEST_ITEM['id'], TEST_ITEM_2['id']]  # Sorted by id
+            assert rows[0] == (TEST_ITEM['id'], TEST_ITEM['name'], TEST_ITEM['price'], TEST_ITEM['media'])
+            with pytest.raises(AttributeError):
+                rows[0].price = 100  # Make sure the rows cannot be changed
+            assert all(isinstance(row, ItemRow) for row in rows)  # Not Item instances tracked by the session
+
     def test_delete_item(self, test_app):
         with test_app.app_context():
             item = ItemDB.create(**TEST_ITEM)
@@ -204,6 +568,15 @@ class TestSale:
             assert sale1.id == 1  # The ID autoincrements, starting at 1
             assert sale2.id == 2  # Next ID must be 2
 
+    def test_update_sale(self, test_app):
+        with test_app.app_context():
+            sale = SaleDB.create(**TEST_SALE)
+            last_updated = sale.last_updated
+            updated_sale = SaleDB.update(sale.id, status=Sale.STATUS_OK, attempts=1)
+            assert updated_sale is sale and sale.status == Sale.STATUS_OK and sale.attempts == 1
+            assert sale.last_updated > last_updated  # Make sure the timestamp column is written
+            assert sale.quantity == TEST_SALE['quantity']  # Make sure fields which are not given are kept
+
     def test_sale_list_all(self, test_app):
         with test_app.app_context():
             sale1 = SaleDB.create(**TEST_SALE)
@@ -221,6 +594,22 @@ class TestSale:
             gotten_sale = SaleDB.get(sale.id)
             assert sale is gotten_sale
 
+    def test_sale_get_many(self, test_app, count_queries):
+        with test_app.app_context():
+            ItemDB.create(**TEST_ITEM)
+            ItemDB.create(**TEST_ITEM_2)
+            UserDB.create(**TEST_USER)
+            ids = [SaleDB.create(**TEST_SALE).id, SaleDB.create(**TEST_SALE_2).id, SaleDB.create(**TEST_SALE).id]
+            db.session.expire_all()
+
+            with count_queries() as queries:
+                sales = SaleDB.get_many(list(reversed(ids)) + [100], with_items=True)
+                assert [sale.item.id for sale in sales] == [TEST_ITEM['id'], TEST_ITEM_2['id'], TEST_ITEM['id']]
+            assert [sale.id for sale in sales] == list(reversed(ids))  # In the order of ids, without unknown ids
+            assert len(queries.selects) == 2  # One for the sales and one for their items
+            with pytest.raises(InvalidRequestError):
+                sales[0].user  # The user is not loaded lazily
+
     def test_sale_get_by_user_id(self, test_app):
         with test_app.app_context():
             sale1 = SaleDB.create(**TEST_SALE)
@@ -243,6 +632,47 @@ class TestSale:
             assert sale_list[0] is sale1 and sale_list[1] is sale3
             assert sale2 not in sale_list
 
+    def test_sale_listing_pages(self, test_app):
+        with test_app.app_context():
+            sales = [SaleDB.create(**TEST_SALE) for _ in range(5)]
+            now = datetime.now()
+            for (i, sale) in enumerate(sales):  # Two sales at the same time, to test the id as tie breaker
+                SaleDB.update(sale.id, status=Sale.STATUS_OK if i % 2 == 0 else Sale.STATUS_FAILED)
+                db.session.execute(Sale.__table__.update().where(Sale.id == sale.id)
+                                   .values(created=now - timedelta(minutes=min(i, 3))))
+            db.session.commit()
+
+            listing = SaleDB.listing(sort='created', descending=True)
+            page1 = listing.page(limit=2)
+            page2 = listing.page(page1.next_cursor, limit=2)
+            page3 = listing.page(page2.next_cursor, limit=2)
+            assert [sale.id for sale in page1] == [1, 2]  # Newest first
+            assert [sale.id for sale in page2] == [3, 5]  # Sales 4 and 5 were created at the same time, 5 comes first
+            assert [sale.id for sale in page3] == [4] and page3.has_next is False
+
+            failed = SaleDB.listing(status=Sale.STATUS_FAILED).all()
+            assert [sale.id for sale in failed] == [2, 4]
+            recent = SaleDB.listing(since=now - timedelta(minutes=1), until=now + timedelta(minutes=1)).all()
+            assert [sale.id for sale in recent] == [1, 2]
+            assert [sale.id for sale in SaleDB.listing(sort='id').stream(batch_size=2)] == [1, 2, 3, 4, 5]
+
+    def test_sale_listing_invalid(self, test_app):
+        with test_app.app_context():
+            with pytest.raises(ValueError):
+                SaleDB.listing(sort='error_msg')  # Not a sort field
+            with pytest.raises(ValueError):
+                SaleDB.listing(color='red')  # Not a column
+            with pytest.raises(ValueError):
+                SaleDB.listing().page('not a cursor')
+
+    def test_post_sales_different_users(self, test_app):
+        with test_app.app_context():
+            sale1 = SaleDB.create(**TEST_SALE)
+            sale2 = SaleDB.create(**TEST_SALE_2)
+            with pytest.raises(ValueError):  # Sales of different users can not be posted in one request
+                SaleDB.post_sales([sale1.id, sale2.id])
+            assert sale1.status == Sale.STATUS_NOT_POSTED
+
     def test_sale_delete(self, test_app):
         with test_app.app_context():
             sale = SaleDB.create(**TEST_SALE)
@@ -296,5 +726,5 @@ class TestSaleAPI:
                 sale = SaleDB.create(**TEST_SALE)
                 with pytest.raises(Timeout) as err:
                     SaleDB.post_sale(sale.id, timeout=0.001)
-                assert sale.status == Sale.STATUS_TIMEOUT
+                assert sale.status == Sale.STATUS_UNCONFIRMED  # A read timeout, so the API may have booked the sale
                 assert str(err.value) == sale.error_msg
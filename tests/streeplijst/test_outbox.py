@@ -0,0 +1,235 @@
+from datetime import datetime, timedelta
+import time
+
+import pytest
+import requests
+from urllib3.exceptions import MaxRetryError, NewConnectionError, ProtocolError
+
+from streeplijst2.config import TEST_USER, TEST_ITEM, TEST_USER_NO_SDD
+from streeplijst2.streeplijst.database import SaleDB, Sale
+from streeplijst2.streeplijst.outbox import SaleOutbox, OutboxWorker
+from streeplijst2.exceptions import HTTPError, UserNotSignedException
+from streeplijst2.database import transaction
+from streeplijst2.extensions import db
+import streeplijst2.api as api
+
+TEST_SALE = dict({
+    'quantity': 1,
+    'total_price': 0,
+    'item_id': TEST_ITEM['id'],
+    'item_name': TEST_ITEM['name'],
+    'user_id': TEST_USER['id'],
+    'user_s_number': TEST_USER['s_number'],
+})
+
+
+TEST_SALE_2 = dict(TEST_SALE, user_id=TEST_USER_NO_SDD['id'], user_s_number=TEST_USER_NO_SDD['s_number'])
+
+
+def http_error(status_code: int) -> HTTPError:
+    response = requests.Response()
+    response.status_code = status_code
+    return HTTPError('%d Error' % status_code, response=response)
+
+
+class TestSaleOutbox:
+
+    def test_enqueue(self, test_app):
+        with test_app.app_context():
+            sale = SaleDB.create(**TEST_SALE)
+            assert SaleOutbox.due() == []  # Sales which are not enqueued are not posted by the outbox
+
+            SaleOutbox.enqueue(sale.id, batch_window=0)
+            assert SaleOutbox.due() == [sale.id]
+            assert sale.status == Sale.STATUS_NOT_POSTED and sale.attempts == 0
+
+    def test_claim(self, test_app):
+        with test_app.app_context():
+            sale = SaleDB.create(**TEST_SALE)
+            SaleOutbox.enqueue(sale.id, batch_window=0)
+
+            assert SaleOutbox.claim(sale.id) is True
+            assert SaleOutbox.claim(sale.id) is False  # A sale can only be claimed once
+            assert SaleOutbox.due() == []
+
+            sale = SaleDB.get(sale.id)
+            assert sale.status == Sale.STATUS_POSTING and sale.attempts == 1
+
+    def test_enqueue_transaction(self, test_app):
+        with test_app.app_context():
+            sale = SaleDB.create(**TEST_SALE)
+            with pytest.raises(RuntimeError):
+                with transaction():
+                    SaleOutbox.enqueue_many([sale.id])  # Joins the transaction
+                    with pytest.raises(RuntimeError):
+                        SaleOutbox.claim(sale.id)  # Would commit the transaction early
+                    raise RuntimeError('Checkout failed')
+            assert SaleOutbox.due() == []  # The sale was rolled back with the transaction
+
+    def test_claim_expired(self, test_app):
+        with test_app.app_context():
+            sale = SaleDB.create(**TEST_SALE)
+            SaleOutbox.enqueue(sale.id, batch_window=0)
+            assert SaleOutbox.claim(sale.id, claim_timeout=-1) is True  # The claim expires immediately
+            assert SaleOutbox.claim(sale.id) is False  # The sale may have been posted, so it is not claimed again
+
+            assert SaleOutbox.expire_claims() == 1
+            sale = SaleDB.get(sale.id)
+            assert sale.status == Sale.STATUS_UNCONFIRMED and sale.next_attempt is None
+            assert SaleOutbox.due() == []
+
+    def test_deliver(self, test_app, monkeypatch, fake_post_sale_items):
+        monkeypatch.setattr(api, 'post_sale_items', fake_post_sale_items())
+        with test_app.app_context():
+            sale = SaleDB.create(**TEST_SALE)
+            SaleOutbox.enqueue(sale.id, batch_window=0)
+            SaleOutbox.claim(sale.id)
+
+            (sale,) = SaleOutbox.deliver([sale.id])
+            assert sale.status == Sale.STATUS_OK
+            assert sale.api_reference == 'REF1'
+            assert sale.next_attempt is None
+
+    def test_deliver_retry(self, test_app, monkeypatch, fake_post_sale_items):
+        monkeypatch.setattr(api, 'post_sale_items', fake_post_sale_items(error=requests.ConnectTimeout('Timed out')))
+        with test_app.app_context():
+            sale = SaleDB.create(**TEST_SALE)
+            SaleOutbox.enqueue(sale.id, batch_window=0)
+            SaleOutbox.claim(sale.id)
+
+            (sale,) = SaleOutbox.deliver([sale.id], backoff=10)
+            assert sale.status == Sale.STATUS_TIMEOUT
+            assert sale.error_msg == 'Timed out'
+            assert datetime.now() + timedelta(seconds=5) < sale.next_attempt < datetime.now() + timedelta(seconds=15)
+
+            SaleDB.update(sale.id, next_attempt=datetime.now())  # Pretend the backoff has passed
+            SaleOutbox.claim(sale.id)
+            (sale,) = SaleOutbox.deliver([sale.id], backoff=10)  # The delay doubles with every attempt
+            assert datetime.now() + timedelta(seconds=15) < sale.next_attempt < datetime.now() + timedelta(seconds=25)
+
+    def test_deliver_max_attempts(self, test_app, monkeypatch, fake_post_sale_items):
+        monkeypatch.setattr(api, 'post_sale_items', fake_post_sale_items(error=http_error(503)))
+        with test_app.app_context():
+            sale = SaleDB.create(**TEST_SALE)
+            SaleOutbox.enqueue(sale.id, batch_window=0)
+            SaleOutbox.claim(sale.id)
+
+            (sale,) = SaleOutbox.deliver([sale.id], max_attempts=1)
+            assert sale.status == Sale.STATUS_FAILED
+            assert sale.next_attempt is None
+
+    @pytest.mark.parametrize('error', [requests.ReadTimeout('Read timed out'),
+                                       requests.ConnectionError(ProtocolError('Connection aborted'))])
+    def test_deliver_unconfirmed(self, test_app, monkeypatch, fake_post_sale_items, error):
+        monkeypatch.setattr(api, 'post_sale_items', fake_post_sale_items(error=error))
+        with test_app.app_context():
+            sale = SaleDB.create(**TEST_SALE)
+            SaleOutbox.enqueue(sale.id, batch_window=0)
+            SaleOutbox.claim(sale.id)
+
+            (sale,) = SaleOutbox.deliver([sale.id])
+            assert sale.status == Sale.STATUS_UNCONFIRMED  # The API may have booked the sale
+            assert sale.next_attempt is None and SaleOutbox.due() == []  # So it is not posted again
+
+    @pytest.mark.parametrize('error, retryable', [
+        (requests.ConnectTimeout('Connect timed out'), True),
+        (requests.ConnectionError(MaxRetryError(None, '/sales', NewConnectionError(None, 'Connection refused'))), True),
+        (http_error(503), True),
+        (requests.ReadTimeout('Read timed out'), False),
+        (requests.ConnectionError(ProtocolError('Connection aborted')), False),
+        (http_error(500), False),
+        (ValueError('Invalid response'), False),
+    ])
+    def test_is_retryable(self, error, retryable):
+        assert SaleOutbox.is_retryable(error) is retryable
+
+    @pytest.mark.parametrize('error', [http_error(404), UserNotSignedException('403 Client Error: mandate')])
+    def test_deliver_not_retryable(self, test_app, monkeypatch, fake_post_sale_items, error):
+        monkeypatch.setattr(api, 'post_sale_items', fake_post_sale_items(error=error))
+        with test_app.app_context():
+            sale = SaleDB.create(**TEST_SALE)
+            SaleOutbox.enqueue(sale.id, batch_window=0)
+            SaleOutbox.claim(sale.id)
+
+            (sale,) = SaleOutbox.deliver([sale.id])
+            assert sale.next_attempt is None  # Client errors are not retried
+            assert SaleOutbox.due() == []
+
+    def test_drain(self, test_app, monkeypatch, fake_post_sale_items):
+        calls = []
+        monkeypatch.setattr(api, 'post_sale_items', fake_post_sale_items(calls=calls))
+        with test_app.app_context():
+            sales = [SaleDB.create(**TEST_SALE) for _ in range(5)]
+            for sale in sales:
+                SaleOutbox.enqueue(sale.id, batch_window=0)
+
+            assert SaleOutbox.drain(max_workers=2) == 5
+            assert len(calls) == 1  # All sales are made by the same user, so they are posted in one request
+            assert len(calls[0]) == 5
+            db.session.expire_all()  # The sales were posted from other sessions
+            assert all(SaleDB.get(sale.id).status == Sale.STATUS_OK for sale in sales)
+            assert SaleOutbox.drain() == 0  # Nothing left to post
+
+    def test_drain_per_user(self, test_app, monkeypatch, fake_post_sale_items):
+        calls = []
+        monkeypatch.setattr(api, 'post_sale_items', fake_post_sale_items(calls=calls))
+        with test_app.app_context():
+            for sale_dict in (TEST_SALE, TEST_SALE_2, TEST_SALE):
+                SaleOutbox.enqueue(SaleDB.create(**sale_dict).id, batch_window=0)
+
+            assert SaleOutbox.drain(batch_max=10) == 3
+            assert sorted(len(items) for items in calls) == [1, 2]  # One request per user
+
+    def test_enqueue_batch_window(self, test_app):
+        with test_app.app_context():
+            sale1 = SaleOutbox.enqueue(SaleDB.create(**TEST_SALE).id, batch_window=10)
+            assert SaleOutbox.due() == []  # The sale waits for more sales of the same user
+            assert datetime.now() + timedelta(seconds=5) < sale1.next_attempt
+
+            sale2 = SaleOutbox.enqueue(SaleDB.create(**TEST_SALE).id, batch_window=10)
+            assert sale2.next_attempt == sale1.next_attempt  # The second sale joins the batch of the first one
+
+            sale3 = SaleOutbox.enqueue(SaleDB.create(**TEST_SALE_2).id, batch_window=20)
+            assert sale3.next_attempt > sale1.next_attempt  # Sales of other users are not in the same batch
+            assert SaleOutbox.next_due() == sale1.next_attempt
+
+    def test_batches(self, test_app):
+        with test_app.app_context():
+            ids = [SaleDB.create(**sale_dict).id for sale_dict in (TEST_SALE, TEST_SALE_2, TEST_SALE, TEST_SALE)]
+            assert SaleOutbox.batches(ids, batch_max=2) == [[ids[0], ids[2]], [ids[3]], [ids[1]]]
+
+    def test_deliver_price_mismatch(self, test_app, monkeypatch, fake_post_sale_items):
+        monkeypatch.setattr(api, 'post_sale_items', fake_post_sale_items(price=100))
+        with test_app.app_context():
+            sale1 = SaleDB.create(**TEST_SALE)
+            sale2 = SaleDB.create(**dict(TEST_SALE, total_price=200, quantity=2))
+            for sale in (sale1, sale2):
+                SaleOutbox.enqueue(sale.id, batch_window=0)
+                SaleOutbox.claim(sale.id)
+
+            (sale1, sale2) = SaleOutbox.deliver([sale1.id, sale2.id])
+            assert sale1.status == Sale.STATUS_TOTAL_PRICE_MISMATCH  # The price is checked for every line
+            assert '0 != 100' in sale1.error_msg
+            assert sale2.status == Sale.STATUS_OK
+            assert sale1.api_reference == sale2.api_reference == 'REF1'
+
+
+class TestOutboxWorker:
+
+    def test_worker(self, test_app, monkeypatch, fake_post_sale_items):
+        monkeypatch.setattr(api, 'post_sale_items', fake_post_sale_items())
+        worker = OutboxWorker(test_app, poll_interval=10)
+        worker.start()
+        try:
+            with test_app.app_context():
+                sale = SaleDB.create(**TEST_SALE)
+                SaleOutbox.enqueue(sale.id, batch_window=0)  # Wakes up the worker before the poll interval passed
+
+                deadline = time.time() + 5
+                while SaleDB.get(sale.id).status != Sale.STATUS_OK and time.time() < deadline:
+                    time.sleep(0.05)
+                    db.session.expire_all()
+                assert SaleDB.get(sale.id).status == Sale.STATUS_OK
+        finally:
+            worker.stop(timeout=5)
+        assert worker.is_alive() is False
@@ -1,4 +1,14 @@
+from datetime import datetime
 
+import pytest
+import requests
+
+from streeplijst2.config import TEST_USER, TEST_ITEM, TEST_ITEM_2, CART_MAX_QUANTITY
+from streeplijst2.database import UserDB
+from streeplijst2.streeplijst.database import FolderDB, ItemDB, SaleDB, Sale
+from streeplijst2.streeplijst.outbox import SaleOutbox
+from streeplijst2.exceptions import UserNotSignedException
+import streeplijst2.api as api
 
 
 def test_index(client, test_app):
@@ -9,4 +19,172 @@ def test_index(client, test_app):
     assert 'http://localhost/login' == response.headers['Location']
 
     response = client.get('/streeplijst/index')
-    assert 'http://localhost/login' == response.headers['Location']
\ No newline at end of file
+    assert 'http://localhost/login' == response.headers['Location']
+
+
+def add_cart_test_data(test_app):
+    """Store the test user and test items in the database."""
+    with test_app.app_context():
+        UserDB.create(**TEST_USER)
+        ItemDB.create(**TEST_ITEM)
+        ItemDB.create(**dict(TEST_ITEM_2, price=150))
+
+
+def test_cart_add(client, test_app, login):
+    add_cart_test_data(test_app)
+    login()
+
+    client.post('/streeplijst/cart/add', data={'item-id': TEST_ITEM['id'], 'quantity': 2})
+    client.post('/streeplijst/cart/add', data={'item-id': TEST_ITEM['id'], 'quantity': 1})
+    client.post('/streeplijst/cart/add', data={'item-id': TEST_ITEM_2['id']})
+    with client.session_transaction() as session:
+        assert session['cart'] == {str(TEST_ITEM['id']): 3, str(TEST_ITEM_2['id']): 1}
+
+    client.post('/streeplijst/cart/remove', data={'item-id': TEST_ITEM['id']})
+    with client.session_transaction() as session:
+        assert session['cart'] == {str(TEST_ITEM_2['id']): 1}
+
+
+def test_cart_add_invalid(client, test_app, login):
+    add_cart_test_data(test_app)
+    login()
+    for quantity in (0, -1, 'two', 1.5, CART_MAX_QUANTITY + 1):
+        response = client.post('/streeplijst/cart/add', data={'item-id': TEST_ITEM['id'], 'quantity': quantity})
+        assert response.status_code == 302
+    response = client.post('/streeplijst/cart/add', data={'item-id': 'abc'})
+    assert response.status_code == 302
+    with client.session_transaction() as session:
+        assert session.get('cart', dict()) == dict()  # Nothing was added
+        assert len(session['_flashes']) == 6
+
+    client.post('/streeplijst/cart/add', data={'item-id': TEST_ITEM['id'], 'quantity': CART_MAX_QUANTITY})
+    client.post('/streeplijst/cart/add', data={'item-id': TEST_ITEM['id']})  # The cart already has the max quantity
+    with client.session_transaction() as session:
+        assert session['cart'] == {str(TEST_ITEM['id']): CART_MAX_QUANTITY}
+
+    response = client.post('/streeplijst/cart/remove', data={'item-id': 'abc'})
+    assert response.status_code == 302
+    with client.session_transaction() as session:
+        assert session['cart'] == {str(TEST_ITEM['id']): CART_MAX_QUANTITY}  # Nothing was removed
+
+
+def test_checkout(client, test_app, login):
+    add_cart_test_data(test_app)
+    login()
+    client.post('/streeplijst/cart/add', data={'item-id': TEST_ITEM['id'], 'quantity': 2})
+    client.post('/streeplijst/cart/add', data={'item-id': TEST_ITEM_2['id'], 'quantity': 3})
+
+    response = client.post('/streeplijst/checkout')
+    assert response.status_code == 200
+    assert TEST_ITEM['name'].encode() in response.data and TEST_ITEM_2['name'].encode() in response.data
+
+    with test_app.app_context():
+        sales = SaleDB.list_all()
+        assert [(sale.item_id, sale.quantity, sale.total_price) for sale in sales] == [
+            (TEST_ITEM['id'], 2, 0), (TEST_ITEM_2['id'], 3, 450)]
+        assert [sale.id for sale in sales] == SaleOutbox.due()  # The sales are posted by the outbox worker
+    with client.session_transaction() as session:
+        assert session['cart'] == {}  # The cart is emptied after checkout
+
+
+def test_checkout_without_outbox(client, test_app, monkeypatch, fake_post_sale_items, login):
+    calls = []
+    monkeypatch.setattr(api, 'post_sale_items', fake_post_sale_items(calls=calls, prices={TEST_ITEM_2['id']: 150}))
+    test_app.config['SALE_OUTBOX'] = False
+    add_cart_test_data(test_app)
+    login()
+    client.post('/streeplijst/cart/add', data={'item-id': TEST_ITEM['id']})
+    client.post('/streeplijst/cart/add', data={'item-id': TEST_ITEM_2['id']})
+
+    response = client.post('/streeplijst/checkout')
+    assert response.status_code == 200
+    assert len(calls) == 1 and len(calls[0]) == 2  # The cart is posted in a single request
+    status_badge = ('sale-status">%s<' % Sale.STATUS_OK).encode()
+    assert response.data.count(status_badge) == 2  # The result of every line is shown
+
+
+@pytest.mark.parametrize('error', [requests.ConnectionError('Connection aborted'),
+                                   UserNotSignedException('403 Client Error: mandate'), ValueError('Invalid response')])
+def test_checkout_without_outbox_error(client, test_app, monkeypatch, fake_post_sale_items, login, error):
+    monkeypatch.setattr(api, 'post_sale_items', fake_post_sale_items(error=error))
+    test_app.config['SALE_OUTBOX'] = False
+    add_cart_test_data(test_app)
+    login()
+    client.post('/streeplijst/cart/add', data={'item-id': TEST_ITEM['id']})
+
+    response = client.post('/streeplijst/checkout')
+    assert response.status_code == 200  # The stored sales are shown with their status
+    with test_app.app_context():
+        (sale,) = SaleDB.list_all()
+    assert ('sale-status">%s<' % sale.status).encode() in response.data and sale.status != Sale.STATUS_NOT_POSTED
+
+
+def test_checkout_empty_cart(client, test_app, login):
+    add_cart_test_data(test_app)
+    login()
+    response = client.post('/streeplijst/checkout')
+    assert response.status_code == 302
+
+
+def test_folder_cart_size(client, test_app, login):
+    add_cart_test_data(test_app)
+    with test_app.app_context():
+        FolderDB.create(id=TEST_ITEM['folder_id'], name=TEST_ITEM['folder_name'])
+        FolderDB.update(TEST_ITEM['folder_id'], synchronized=datetime.now())  # The folder does not need to sync
+    login()
+    client.post('/streeplijst/cart/add', data={'item-id': TEST_ITEM['id'], 'quantity': 2})
+
+    response = client.get('/streeplijst/folder/%d' % TEST_ITEM['folder_id'])
+    assert response.status_code == 200
+    assert b'Mandje: 2 product(en)' in response.data
+
+
+def test_folder_items(client, test_app, login):
+    add_cart_test_data(test_app)
+    with test_app.app_context():
+        FolderDB.create(id=TEST_ITEM['folder_id'], name=TEST_ITEM['folder_name'])
+        FolderDB.update(TEST_ITEM['folder_id'], synchronized=datetime.now())  # The folder does not need to sync
+    login()
+
+    response = client.get('/streeplijst/folder/%d' % TEST_ITEM['folder_id'])
+    assert TEST_ITEM['name'].encode() in response.data and TEST_ITEM_2['name'].encode() in response.data
+
+    response = client.get('/streeplijst/api/folder/%d' % TEST_ITEM['folder_id'])
+    assert response.status_code == 200
+    assert response.get_json() == dict(id=TEST_ITEM['folder_id'], name=TEST_ITEM['folder_name'], items=[
+        dict(id=TEST_ITEM['id'], name=TEST_ITEM['name'], price=TEST_ITEM['price'], media=TEST_ITEM['media']),
+        dict(id=TEST_ITEM_2['id'], name=TEST_ITEM_2['name'], price=150, media=TEST_ITEM_2['media'])])
+
+
+def test_folder_page_queries(client, test_app, count_queries, login):
+    test_app.config['CATALOG_CACHE'] = False  # Load the folder from the database for every request
+    with test_app.app_context():
+        FolderDB.create(id=TEST_ITEM['folder_id'], name=TEST_ITEM['folder_name'])
+        FolderDB.update(TEST_ITEM['folder_id'], synchronized=datetime.now())  # The folder does not need to sync
+        ItemDB.create(**TEST_ITEM)
+    login()
+
+    with count_queries() as one_item:
+        client.get('/streeplijst/folder/%d' % TEST_ITEM['folder_id'])
+    with test_app.app_context():
+        for id in range(1, 11):
+            ItemDB.create(**dict(TEST_ITEM, id=id))
+    with count_queries() as many_items:
+        client.get('/streeplijst/folder/%d' % TEST_ITEM['folder_id'])
+    assert len(many_items.statements) == len(one_item.statements)  # No query per item
+
+
+def test_checkout_queries(client, test_app, count_queries, login):
+    add_cart_test_data(test_app)
+    login()
+
+    client.post('/streeplijst/cart/add', data={'item-id': TEST_ITEM['id']})
+    with count_queries() as one_line:
+        client.post('/streeplijst/checkout')
+
+    client.post('/streeplijst/cart/add', data={'item-id': TEST_ITEM['id']})
+    client.post('/streeplijst/cart/add', data={'item-id': TEST_ITEM_2['id']})
+    with count_queries() as two_lines:
+        response = client.post('/streeplijst/checkout')
+    assert TEST_ITEM_2['name'].encode() in response.data
+    assert len(two_lines.selects) == len(one_line.selects)  # No query per line, only the INSERTs are per sale
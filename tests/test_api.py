@@ -1,4 +1,10 @@
+import os
+import threading
+import time
+from datetime import datetime
+
 import pytest
+import requests
 from requests.exceptions import HTTPError, Timeout
 
 import streeplijst2.api as api
@@ -17,6 +23,9 @@ These tests assume the following to be true in Congressus:
 
 - The incorrect_user, incorrect_item and incorrect_folder all do not exist in Congressus.
 
+By default, all tests run against the Congressus stand-in (streeplijst2.congressus_stub), whose fixtures satisfy the
+assumptions above. Set the environment variable STREEPLIJST_LIVE_API=1 to run them against Congressus itself.
+
 You can change the values in the global variables below.
 """
 
@@ -72,6 +81,16 @@ def test_get_user_incorrect():
         api.get_user(correct_user["s_number"], 0.001)
 
 
+# Test if the members are returned one page at a time
+def test_get_members():
+    first_page = api.get_members(page=1, page_size=2)
+    assert len(first_page) == 2 and all('s_number' in member for member in first_page)
+
+    members = first_page + api.get_members(page=2, page_size=2)
+    assert any(correct_user["s_number"] == member["s_number"] for member in members)
+    assert [member["id"] for member in members] == sorted(member["id"] for member in members)  # Sorted by id
+
+
 # Test if a valid item_id returns a response with correct data
 def test_get_item_correct():
     res = api.get_product(correct_item["id"])
@@ -138,3 +157,135 @@ def test_normalize_profile_picture():
     user_without_profile_pic = {'profile_picture': None}
     api._normalize_profile_picture(user_without_profile_pic)
     assert user_without_profile_pic['profile_picture'] == ''
+
+
+def test_client_timeouts():
+    client = api.CongressusClient(timeouts={'products': 3}, default_timeout=7)
+    assert client.timeout('products') == 3  # Endpoint specific timeout
+    assert client.timeout('sales') == 7  # Endpoints which are not configured use the default timeout
+    assert client.timeout('products', 0.5) == 0.5  # A timeout passed by the caller is always used
+    client.close()
+
+
+def test_client_connection_pool():
+    client = api.CongressusClient(pool_size=4, retries=3)
+    adapter = client.session.get_adapter(client.base_url)
+    assert adapter._pool_maxsize == 4  # Connections are kept in a shared pool
+    assert adapter.max_retries.total == 3
+    assert 'POST' not in adapter.max_retries.allowed_methods  # Sales are never retried after being sent
+    client.close()
+
+
+def make_response(status_code: int, text: str = '', headers: dict = None) -> requests.Response:
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = text.encode('utf-8')
+    response.encoding = 'utf-8'
+    response.headers.update(headers or dict())
+    return response
+
+
+def cached_client(monkeypatch, tmp_path, responses: list, requests_sent: list, **cache_kwargs):
+    """Return a client with a cache in tmp_path which sends its GET requests to a list of prepared responses."""
+    client = api.CongressusClient(cache=api.ResponseCache(tmp_path, **cache_kwargs))
+
+    def get(url, params=None, headers=None, timeout=None):
+        requests_sent.append(dict(headers or dict()))
+        return responses.pop(0)
+
+    monkeypatch.setattr(client.session, 'get', get)
+    return client
+
+
+def test_response_cache_etag(monkeypatch, tmp_path):
+    requests_sent = []
+    responses = [make_response(200, '[{"id": 1}]', {'ETag': '"v1"'}), make_response(304)]
+    client = cached_client(monkeypatch, tmp_path, responses, requests_sent)
+
+    res, changed = client.get_cached('products', '/products', params={'folder_id': 1})
+    assert res.json() == [{'id': 1}] and changed is not None
+    res, changed_again = client.get_cached('products', '/products', params={'folder_id': 1})
+    assert requests_sent[1]['If-None-Match'] == '"v1"'  # The cached response is revalidated
+    assert res.status_code == 200 and res.json() == [{'id': 1}]  # The 304 is answered with the cached body
+    assert changed_again == changed
+    assert client.cache.stats() == dict(hits=0, revalidated=1, misses=1)
+
+
+def test_response_cache_ttl(monkeypatch, tmp_path):
+    requests_sent = []
+    responses = [make_response(200, '[{"id": 1}]'), make_response(200, '[{"id": 1}]')]
+    client = cached_client(monkeypatch, tmp_path, responses, requests_sent, ttl=60)
+
+    _, changed = client.get_cached('products', '/products')
+    client.get_cached('products', '/products')
+    assert len(requests_sent) == 1  # Responses without validators are used without a request while they are fresh
+    assert client.cache.stats() == dict(hits=1, revalidated=0, misses=1)
+
+    client.cache.ttl = 0
+    _, changed_again = client.get_cached('products', '/products')
+    assert len(requests_sent) == 2
+    assert changed_again == changed  # The body was downloaded again, but it did not change
+
+
+def test_response_cache_evict(tmp_path):
+    cache = api.ResponseCache(tmp_path, max_size=1500)  # Room for two responses
+    for nr in range(2):
+        cache.put('/products/%d' % nr, make_response(200, 'x' * 400))
+        os.utime(cache._path('/products/%d' % nr), (time.time() - 10 + nr, time.time() - 10 + nr))
+
+    cache.put('/products/2', make_response(200, 'x' * 400))  # The cache is now larger than max_size
+    assert cache.get('/products/0') is None  # The least recently used response is removed first
+    assert cache.get('/products/1') is not None and cache.get('/products/2') is not None
+
+
+def test_response_cache_concurrent(tmp_path):
+    caches = [api.ResponseCache(tmp_path), api.ResponseCache(tmp_path)]  # Like two worker processes
+    errors = []
+
+    def put(cache):
+        try:
+            for nr in range(50):
+                cache.put('/products', make_response(200, 'x' * nr))
+                cache.clear()
+        except Exception as err:
+            errors.append(err)
+
+    threads = [threading.Thread(target=put, args=(caches[nr % 2],)) for nr in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert list(tmp_path.glob('*.tmp')) == []  # No temporary files are left behind
+
+
+def test_get_products_in_folder_not_modified(monkeypatch, tmp_path):
+    requests_sent = []
+    body = '[{"id": 1, "name": "Test", "price": "100", "folder": "Folder", "media": []}]'
+    responses = [make_response(200, body, {'ETag': '"v1"'}), make_response(304), make_response(304)]
+    monkeypatch.setattr(api, 'client', cached_client(monkeypatch, tmp_path, responses, requests_sent))
+
+    items = api.get_products_in_folder(1)
+    assert items[0]['price'] == 100 and items[0]['folder_name'] == 'Folder'
+    assert api.get_products_in_folder(1, synchronized=datetime.now()) is None  # The caller already stored these items
+    assert api.get_products_in_folder(1, synchronized=datetime.min) == items  # The caller is older than the response
+
+
+def test_get_products_in_folder_coalesced(monkeypatch):
+    calls = []
+
+    def get_cached(endpoint, path, params=None, timeout=None):
+        calls.append(params)
+        time.sleep(0.3)  # Slow API, so all threads are waiting at the same time
+        body = '[{"id": 1, "name": "Test", "price": "100", "folder": "Folder", "media": []}]'
+        return make_response(200, body), None
+
+    monkeypatch.setattr(api.client, 'get_cached', get_cached)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(api.get_products_in_folder(1))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert len(calls) == 1  # Only one request was sent to the API
+    assert len(results) == 5 and all(result == results[0] for result in results)
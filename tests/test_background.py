@@ -0,0 +1,37 @@
+import threading
+
+from flask import current_app
+
+import streeplijst2.background as background
+
+
+def test_run_once(test_app):
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def task(value):
+        calls.append((value, current_app.name))  # The task runs inside an app context
+        started.set()
+        release.wait(5)
+
+    with test_app.app_context():
+        assert background.run_once('task', task, 1) is True
+        started.wait(5)
+        assert background.run_once('task', task, 2) is False  # A task with the same key is still running
+        assert background.is_running('task')
+
+        release.set()
+        background.join('task')
+        assert background.is_running('task') is False
+        assert calls == [(1, test_app.name)]
+
+
+def test_run_once_error(test_app):
+    def task():
+        raise ValueError('Task failed')
+
+    with test_app.app_context():
+        assert background.run_once('failing task', task) is True
+        background.join('failing task')
+        assert background.is_running('failing task') is False  # The error is logged and the key is released
@@ -0,0 +1,60 @@
+import time
+
+import pytest
+from requests.exceptions import HTTPError
+
+from streeplijst2.congressus_stub import CongressusStub
+from streeplijst2.config import TEST_USER, TEST_ITEM, TEST_FOLDER_ID
+import streeplijst2.api as api
+
+
+def test_inject(congressus_stub):
+    congressus_stub.inject('product', 404)
+    with pytest.raises(api.ItemNotFoundException):
+        api.get_product(TEST_ITEM['id'])
+    assert api.get_product(TEST_ITEM['id'])['name'] == TEST_ITEM['name']  # Only the next request fails
+
+    congressus_stub.inject('sales', 'mandate')
+    with pytest.raises(api.UserNotSignedException):
+        api.post_sale(TEST_USER['id'], TEST_ITEM['id'], 1)
+
+    congressus_stub.inject('sales', 500)
+    with pytest.raises(HTTPError) as err:
+        api.post_sale(TEST_USER['id'], TEST_ITEM['id'], 1)
+    assert '500' in str(err.value)
+    assert congressus_stub.sales == []  # None of the sales were posted
+
+
+def test_latency(congressus_stub):
+    congressus_stub.latency = dict(members=0.2)
+    start = time.time()
+    api.get_user(TEST_USER['s_number'])
+    assert time.time() - start >= 0.2
+
+
+def test_error_rate(congressus_stub):
+    congressus_stub.error_rate = 1
+    try:
+        with pytest.raises(HTTPError) as err:
+            api.post_sale(TEST_USER['id'], TEST_ITEM['id'], 1)
+        assert '503' in str(err.value)
+    finally:
+        congressus_stub.error_rate = 0
+
+
+def test_record_replay(congressus_stub, tmp_path):
+    api.get_products_in_folder(TEST_FOLDER_ID)
+    sale = api.post_sale(TEST_USER['id'], TEST_ITEM['id'], 2)
+    assert congressus_stub.count() == 2 and congressus_stub.count('sales') == 1
+    congressus_stub.save_recording(tmp_path / 'recording.jsonl')
+
+    replay_stub = CongressusStub(replay=tmp_path / 'recording.jsonl')
+    api.client.base_url = replay_stub.start()
+    try:
+        assert api.post_sale(TEST_USER['id'], TEST_ITEM['id'], 2)['reference'] == sale['reference']
+        with pytest.raises(HTTPError) as err:  # Requests which were not recorded fail
+            api.post_sale(TEST_USER['id'], TEST_ITEM['id'], 3)
+        assert '501' in str(err.value)
+        assert replay_stub.sales == []  # Replayed sales are not posted again
+    finally:
+        replay_stub.stop()
@@ -1,9 +1,14 @@
 import pytest
 import copy
+import time
 
-from streeplijst2.database import UserDB
+from streeplijst2.database import UserDB, NegativeCache, transaction
+from streeplijst2.extensions import db
+from streeplijst2.models import User
 import streeplijst2.api as api
+import streeplijst2.background as background
 from streeplijst2.config import TEST_USER, TEST_USER_NO_SDD
+from streeplijst2.exceptions import Timeout
 
 from datetime import datetime
 
@@ -74,6 +79,16 @@ class TestUser:
                 assert updated_user.__getattribute__(key) == value
                 assert user.__getattribute__(key) == updated_user.__getattribute__(key)
 
+    def test_update_user_partial(self, test_app):
+        with test_app.app_context():
+            UserDB.create(**TEST_USER_1)
+            db.session.execute(User.__table__.update().where(User.id == TEST_USER_1['id']).values(last_name='Other'))
+            db.session.commit()  # Another process changes the last name after the user was loaded
+
+            user = UserDB.update(id=TEST_USER_1['id'], first_name='Test2')
+            assert user.first_name == 'Test2'  # Make sure the given field is updated
+            assert user.last_name == 'Other'  # Make sure fields which are not given are not overwritten
+
     def test_delete_user(self, test_app):
         with test_app.app_context():
             user = UserDB.create(**TEST_USER_1)
@@ -95,6 +110,223 @@ class TestUser:
             assert user1 == user_list[0]  # Make sure each user is in the list
             assert user2 == user_list[1]  # Also make sure the order is correct (ascending id)
 
+    def test_list_all_users_sorted(self, test_app):
+        with test_app.app_context():
+            user2 = UserDB.create(**TEST_USER_2)
+            user1 = UserDB.create(**TEST_USER_1)
+            assert UserDB.list_all(sort='id', descending=True) == [user2, user1]
+            assert UserDB.list_all(sort='created') == [user2, user1]  # User 2 was created first
+
+    def test_user_listing_pages(self, test_app):
+        with test_app.app_context():
+            users = [UserDB.create(id=id, s_number='s%d' % id, first_name='User', last_name=str(id % 3),
+                                   date_of_birth=datetime(2000, 1, 1)) for id in range(1, 8)]
+            listing = UserDB.listing(sort='last_name')
+            pages = [listing.page(limit=3)]
+            while pages[-1].has_next:
+                pages.append(listing.page(pages[-1].next_cursor, limit=3))
+            assert [len(page) for page in pages] == [3, 3, 1]
+            ids = [user.id for page in pages for user in page]
+            assert ids == [3, 6, 1, 4, 7, 2, 5]  # Sorted by last name, then by id
+            assert list(listing.stream(batch_size=2)) == [users[id - 1] for id in ids]
+
+    @pytest.mark.parametrize('descending, expected', [(False, [2, 4, 1, 3, 5]), (True, [5, 3, 1, 4, 2])])
+    def test_user_listing_pages_null(self, test_app, descending, expected):
+        with test_app.app_context():
+            for id in range(1, 6):
+                UserDB.create(id=id, s_number='s%d' % id, first_name='User', last_name=None if id % 2 == 0 else 'Name',
+                              date_of_birth=datetime(2000, 1, 1))
+            listing = UserDB.listing(sort='last_name', descending=descending)
+            pages = [listing.page(limit=1)]
+            while pages[-1].has_next:
+                pages.append(listing.page(pages[-1].next_cursor, limit=1))
+            assert [user.id for page in pages for user in page] == expected  # NULL sorts before any other value
+            assert [user.id for user in listing.all()] == expected
+
+
+class TestTransaction:
+
+    def test_transaction_commits_once(self, test_app):
+        with test_app.app_context():
+            commits = []
+            session = db.session()
+            db.event.listen(session, 'after_commit', lambda session: commits.append(session))
+            with transaction():
+                UserDB.create(**TEST_USER_1)
+                UserDB.update(id=TEST_USER_1['id'], first_name='Test2')
+                assert len(commits) == 0  # Make sure nothing is committed inside the block
+            assert len(commits) == 1  # Make sure everything is committed once at the end of the block
+            assert UserDB.get(TEST_USER_1['id']).first_name == 'Test2'
+
+    def test_transaction_rollback(self, test_app):
+        with test_app.app_context():
+            with pytest.raises(ValueError):
+                with transaction():
+                    UserDB.create(**TEST_USER_1)
+                    raise ValueError()
+            assert UserDB.get(TEST_USER_1['id']) is None  # Make sure the user is not stored
+
+    def test_transaction_nested(self, test_app):
+        with test_app.app_context():
+            with pytest.raises(ValueError):
+                with transaction():
+                    with transaction():  # The inner block joins the outer block and does not commit
+                        UserDB.create(**TEST_USER_1)
+                    raise ValueError()
+            assert UserDB.get(TEST_USER_1['id']) is None  # Make sure the inner block is rolled back as well
+
+
+class TestUserLogin:
+
+    def test_login_new_user(self, test_app, congressus_stub):
+        with test_app.app_context():
+            user = UserDB.login(TEST_USER['s_number'])
+            assert user.id == TEST_USER['id'] and congressus_stub.count('members') == 1  # Fetched from the API
+
+            assert UserDB.login(TEST_USER['s_number']) is user
+            assert congressus_stub.count('members') == 1  # A returning user is served from the database
+
+    def test_login_stale_user(self, test_app, congressus_stub):
+        with test_app.app_context():
+            UserDB.create(**dict(TEST_USER, first_name='Old'))
+            db.session.execute(User.__table__.update().values(updated=datetime(2000, 1, 1)))
+            db.session.commit()
+
+            user = UserDB.login(TEST_USER['s_number'])
+            assert user.first_name == 'Old'  # The stored user is returned immediately
+            background.join(('user', TEST_USER['s_number']), timeout=5)  # Wait for the refresh
+            assert congressus_stub.count('members') == 1
+
+            db.session.expire_all()
+            assert UserDB.get(TEST_USER['id']).first_name == TEST_USER['first_name']  # Refreshed in the background
+            assert UserDB.get(TEST_USER['id']).updated > datetime(2000, 1, 1)
+
+    def test_login_not_found(self, test_app, congressus_stub):
+        with test_app.app_context():
+            with pytest.raises(api.UserNotFoundException):
+                UserDB.login('s0000000')
+            with pytest.raises(api.UserNotFoundException):
+                UserDB.login('s0000000')
+            assert congressus_stub.count('members') == 1  # The second attempt did not make a request
+
+    def test_login_removed(self, test_app, congressus_stub):
+        with test_app.app_context():
+            user = UserDB.create(**TEST_USER_UPDATED)  # Not a member according to the API
+            db.session.execute(User.__table__.update().values(updated=datetime(2000, 1, 1)))
+            db.session.commit()
+
+            assert UserDB.login(TEST_USER_UPDATED['s_number']) is user  # Still a member as far as we know
+            background.join(('user', TEST_USER_UPDATED['s_number']), timeout=5)  # The refresh finds out
+            db.session.expire_all()
+            assert UserDB.get(user.id).removed is not None
+
+            test_app.extensions['users_not_found'].discard(TEST_USER_UPDATED['s_number'])  # Like after the TTL
+            with pytest.raises(api.UserNotFoundException):
+                UserDB.login(TEST_USER_UPDATED['s_number'])
+            assert congressus_stub.count('members') == 2  # The API was asked again instead of the stored user
+
+    def test_login_member_again(self, test_app, congressus_stub):
+        with test_app.app_context():
+            user = UserDB.create(**TEST_USER)
+            UserDB._mark_removed([user.id])
+            db.session.commit()
+
+            assert UserDB.login(TEST_USER['s_number']).removed is None
+            assert congressus_stub.count('members') == 1
+
+    def test_negative_cache(self):
+        cache = NegativeCache(ttl=0.05, max_size=2)
+        for key in ('a', 'b', 'c'):
+            cache.add(key)
+        assert 'a' not in cache and 'b' in cache and 'c' in cache and len(cache) == 2  # The oldest key is forgotten
+        cache.discard('b')
+        assert 'b' not in cache
+        time.sleep(0.06)
+        assert 'c' not in cache  # Expired
+
+
+class TestRoster:
+
+    def test_sync_roster(self, test_app, congressus_stub):
+        with test_app.app_context():
+            assert UserDB.roster_synchronized() is None
+            diff = UserDB.sync_roster(page_size=2)
+            assert len(diff.added) == 3 and diff.changed == [] and diff.removed == []
+            assert congressus_stub.count('members') == 3  # Two pages of members and an empty page
+
+            user = UserDB.get_by_s_number(TEST_USER['s_number'])
+            for (key, value) in TEST_USER.items():  # Make sure all fields are stored correctly
+                assert getattr(user, key) == value
+            assert UserDB.roster_synchronized() is not None
+
+            assert UserDB.login(TEST_USER['s_number']) is user
+            assert congressus_stub.count('members') == 3  # The login did not make a request
+
+    def test_sync_roster_failed(self, test_app, monkeypatch):
+        get_members = api.get_members
+
+        def fail_on_page_2(page=1, **kwargs):
+            if page == 2:
+                raise Timeout('Timed out')
+            return get_members(page=page, **kwargs)
+
+        monkeypatch.setattr(api, 'get_members', fail_on_page_2)
+        with test_app.app_context():
+            with pytest.raises(Timeout):
+                UserDB.sync_roster(page_size=2)
+            assert len(UserDB.list_all()) == 2  # The first page was stored
+            assert UserDB.roster_synchronized() is None  # But the roster was not synchronized completely
+            assert UserDB.schedule_roster_sync() is True  # So the next start synchronizes it again
+            background.join(('roster',))
+
+    def test_sync_roster_incremental(self, test_app):
+        with test_app.app_context():
+            UserDB.sync_roster(page_size=2)
+            UserDB.update(TEST_USER['id'], first_name='Old')
+
+            diff = UserDB.sync_roster(page_size=2)
+            assert diff.added == [] and diff.changed == [TEST_USER['id']] and diff.unchanged == 2
+            assert UserDB.get(TEST_USER['id']).first_name == TEST_USER['first_name']
+            assert api.client.cache.stats()['revalidated'] == 3  # All pages were answered with a 304
+
+    def test_sync_roster_removed(self, test_app):
+        with test_app.app_context():
+            UserDB.sync_roster()
+            UserDB.create(**dict(TEST_USER_UPDATED, id=1))  # Not a member according to the API
+            diff = UserDB.sync_roster(min_seen=0.5)  # One of the four stored users is missing
+            assert diff.removed == [1]
+            assert UserDB.get(1) is not None and UserDB.get(1).removed is not None  # Removed users are not deleted
+            with pytest.raises(api.UserNotFoundException):
+                UserDB.login(TEST_USER_UPDATED['s_number'])  # But they can no longer log in
+
+    def test_sync_roster_small_pages(self, test_app, monkeypatch):
+        get_members = api.get_members
+
+        def capped(page=1, page_size=250, **kwargs):
+            return get_members(page=page, page_size=min(page_size, 2), **kwargs)  # Like a server with a max page size
+
+        monkeypatch.setattr(api, 'get_members', capped)
+        with test_app.app_context():
+            diff = UserDB.sync_roster(page_size=250)
+            assert len(diff.added) == 3  # Not only the first page
+
+    def test_sync_roster_incomplete(self, test_app, monkeypatch):
+        with test_app.app_context():
+            UserDB.sync_roster()
+            monkeypatch.setattr(api, 'get_members', lambda page=1, **kwargs: [])  # Like an API which lost its members
+            diff = UserDB.sync_roster()
+            assert diff.removed == []
+            assert all(user.removed is None for user in UserDB.list_all())  # The members can still log in
+
+    def test_bulk_upsert(self, test_app):
+        with test_app.app_context():
+            diff = UserDB.bulk_upsert([TEST_USER_1, TEST_USER_2])
+            assert sorted(diff.added) == sorted([TEST_USER_1['id'], TEST_USER_2['id']])
+
+            diff = UserDB.bulk_upsert([dict(TEST_USER_1, has_sdd_mandate=False), TEST_USER_2])
+            assert diff.changed == [TEST_USER_1['id']] and diff.unchanged == 1
+            assert UserDB.get(TEST_USER_1['id']).has_sdd_mandate is False
+
 
 class TestUserAPI:
     """
@@ -1,12 +1,42 @@
+import os
+
+from sqlalchemy.pool import NullPool, QueuePool
+
 from streeplijst2 import create_app
+from streeplijst2.extensions import db
+import streeplijst2.background as background
 
 
 def test_config(test_app, db_uri_string):
     """Test create_app without passing test config."""
-    assert not create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + db_uri_string}).testing
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + db_uri_string})
+    assert not app.testing
     assert test_app.testing
 
+    app.extensions['sale_outbox'].stop(timeout=5)  # Stop the app again, so it does not use the database of other tests
+    background.join(('roster',), timeout=5)  # Wait for the roster synchronization which was started at startup
+    with app.app_context():
+        db.engine.dispose()
+
 
 def test_hello(client):
     response = client.get("/hello")
     assert response.data == b"Hello, World!"
+
+
+def test_sqlite_pragmas(test_app):
+    with test_app.app_context():
+        assert db.session.execute('PRAGMA journal_mode').scalar() == 'wal'
+        assert db.session.execute('PRAGMA synchronous').scalar() == 1  # NORMAL
+        assert db.session.execute('PRAGMA busy_timeout').scalar() == test_app.config['SQLITE_PRAGMAS']['busy_timeout']
+        assert isinstance(db.engine.pool, QueuePool)  # Connections are kept open and shared between threads
+
+
+def test_sqlite_pool_disabled(db_uri_string):
+    app = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + db_uri_string, 'SQLITE_POOL_SIZE': 0,
+                      'SQLITE_PRAGMAS': dict()})
+    with app.app_context():
+        assert isinstance(db.engine.pool, NullPool)  # Every session opens a new connection
+        assert db.session.execute('PRAGMA journal_mode').scalar() == 'delete'  # The SQLite default
+        db.session.remove()
+    os.remove(db_uri_string)
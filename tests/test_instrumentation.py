@@ -0,0 +1,60 @@
+import logging
+
+from streeplijst2.config import TEST_USER
+from streeplijst2.database import UserDB
+from streeplijst2.instrumentation import get_query_stats
+
+
+def test_request_stats(client, test_app, login):
+    login()
+    with test_app.app_context():
+        stats = get_query_stats().stats()
+    assert stats['requests'] == 1 and stats['queries'] >= 1 and stats['db_seconds'] > 0
+    assert stats['endpoints']['home.login']['queries'] == stats['queries']
+    assert stats['slowest'] and 'FROM users' in stats['slowest'][0]['statement']
+    assert stats['over_budget'] == 0
+
+    response = client.get('/api/queries/stats')
+    assert response.get_json()['requests'] == 1  # The request for the stats itself is only counted when it ends
+
+
+def test_over_budget(client, test_app, caplog, login):
+    with test_app.app_context():
+        get_query_stats().query_budget = 0
+    with caplog.at_level(logging.WARNING, logger='streeplijst2.instrumentation'):
+        login()
+    assert 'POST /login made' in caplog.text and 'FROM users' in caplog.text  # Logged with its statements
+    with test_app.app_context():
+        assert get_query_stats().stats()['over_budget'] == 1
+
+
+def test_slow_query(client, test_app, caplog, login):
+    with test_app.app_context():
+        get_query_stats().slow_query = 0  # Every query is slow
+    with caplog.at_level(logging.WARNING, logger='streeplijst2.instrumentation'):
+        login()
+    assert 'Slow query of' in caplog.text
+    with test_app.app_context():
+        assert get_query_stats().stats()['slow_queries'] >= 1
+
+
+def test_background_queries(test_app):
+    with test_app.app_context():
+        before = get_query_stats().stats()['background_queries']
+        UserDB.get(TEST_USER['id'])  # Outside of a request
+        stats = get_query_stats().stats()
+    assert stats['background_queries'] == before + 1 and stats['requests'] == 0
+
+
+def test_disabled(client, test_app):
+    test_app.extensions.pop('query_stats')
+    response = client.get('/api/queries/stats')
+    assert response.get_json() == dict()
+
+
+def test_unmatched_paths(client, test_app):
+    for path in ('/does-not-exist', '/neither/does/this'):
+        assert client.get(path).status_code == 404
+    with test_app.app_context():
+        endpoints = get_query_stats().stats()['endpoints']
+    assert list(endpoints.keys()) == ['<unmatched>'] and endpoints['<unmatched>']['requests'] == 2
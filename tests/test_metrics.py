@@ -0,0 +1,126 @@
+import threading
+from datetime import datetime
+
+import pytest
+import requests
+from requests.exceptions import HTTPError, Timeout
+
+from streeplijst2.config import TEST_ITEM, TEST_USER
+from streeplijst2.metrics import Metrics, sample
+from streeplijst2.streeplijst.database import SaleDB, Sale
+from streeplijst2.streeplijst.outbox import SaleOutbox
+import streeplijst2.api as api
+import streeplijst2.metrics as metrics
+
+TEST_SALE = dict({
+    'quantity': 1,
+    'total_price': 0,
+    'item_id': TEST_ITEM['id'],
+    'item_name': TEST_ITEM['name'],
+    'user_id': TEST_USER['id'],
+    'user_s_number': TEST_USER['s_number'],
+})
+
+
+@pytest.fixture(autouse=True)
+def reset_metrics():
+    metrics.registry.reset()  # The registry is shared by all tests
+
+
+def test_api_metrics():
+    api.get_product(TEST_ITEM['id'])
+    with pytest.raises(api.ItemNotFoundException):
+        api.get_product(0)
+    with pytest.raises(Timeout):
+        api.get_product(TEST_ITEM['id'], 0.001)
+
+    lines = metrics.registry.render()
+    assert 'streeplijst_api_responses_total{endpoint="product",code="200"} 1' in lines
+    assert 'streeplijst_api_responses_total{endpoint="product",code="404"} 1' in lines
+    assert 'streeplijst_api_errors_total{endpoint="product",error="timeout"} 1' in lines
+    assert 'streeplijst_api_request_duration_seconds_bucket{endpoint="product",le="+Inf"} 3' in lines
+    assert 'streeplijst_api_request_duration_seconds_count{endpoint="product"} 3' in lines
+    assert '# TYPE streeplijst_api_request_duration_seconds histogram' in lines
+
+
+def test_histogram_buckets():
+    registry = Metrics(buckets=[0.1, 1])
+    for seconds in (0.05, 0.1, 0.5, 2):
+        registry.observe_api_request('sales', seconds, status_code=201)
+
+    lines = registry.render()
+    assert 'streeplijst_api_request_duration_seconds_bucket{endpoint="sales",le="0.1"} 2' in lines  # Bounds included
+    assert 'streeplijst_api_request_duration_seconds_bucket{endpoint="sales",le="1"} 3' in lines
+    assert 'streeplijst_api_request_duration_seconds_bucket{endpoint="sales",le="+Inf"} 4' in lines
+    assert 'streeplijst_api_request_duration_seconds_sum{endpoint="sales"} 2.65' in lines
+
+
+def test_threads():
+    registry = Metrics()
+
+    def observe():
+        for _ in range(1000):
+            registry.observe_api_request('members', 0.01, status_code=200)
+
+    threads = [threading.Thread(target=observe) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert 'streeplijst_api_responses_total{endpoint="members",code="200"} 4000' in registry.render()
+
+
+def test_short_lived_threads():
+    registry = Metrics()
+    for _ in range(100):  # Like the threads of the background synchronizations
+        thread = threading.Thread(target=registry.observe_api_request, args=('products', 0.01),
+                                  kwargs=dict(error='timeout'))
+        thread.start()
+        thread.join()
+
+    assert 'streeplijst_api_errors_total{endpoint="products",error="timeout"} 100' in registry.render()
+    assert len(registry._shards) <= 1  # The shards of the threads which ended are merged into the base shard
+
+
+def test_sale_metrics(test_app):
+    with test_app.app_context():
+        sale = SaleDB.create(**TEST_SALE)
+        SaleDB.post_sale(sale.id)
+        failed_sale = SaleDB.create(**TEST_SALE)
+        SaleDB.update(id=failed_sale.id, user_id=0)  # Nonexistent user
+        with pytest.raises(HTTPError):
+            SaleDB.post_sale(failed_sale.id)
+
+        lines = metrics.registry.render()
+        assert sample('streeplijst_sales_total', dict(status=SaleDB.get(sale.id).status), 1) in lines
+        assert 'streeplijst_sales_total{status="http_error"} 1' in lines
+
+
+def test_sale_metrics_retried(test_app, monkeypatch, fake_post_sale_items):
+    monkeypatch.setattr(api, 'post_sale_items', fake_post_sale_items(error=requests.ConnectTimeout('Timed out')))
+    with test_app.app_context():
+        sale = SaleDB.create(**TEST_SALE)
+        SaleOutbox.enqueue(sale.id, batch_window=0)
+        for _ in range(2):
+            SaleDB.update(sale.id, next_attempt=datetime.now())  # Pretend the backoff has passed
+            SaleOutbox.claim(sale.id)
+            SaleOutbox.deliver([sale.id], max_attempts=2)
+
+        assert SaleDB.get(sale.id).status == Sale.STATUS_FAILED
+        counted = [line for line in metrics.registry.render() if line.startswith('streeplijst_sales_total')]
+        assert counted == ['streeplijst_sales_total{status="failed"} 1']  # Not the attempt which was retried
+
+
+def test_metrics_route(client):
+    client.get('/login')
+    response = client.get('/metrics')
+    assert response.status_code == 200 and response.mimetype == 'text/plain'
+    text = response.get_data(as_text=True)
+    assert '# TYPE streeplijst_api_responses_total counter' in text
+    assert 'streeplijst_http_requests_total{endpoint="home.login"} 1' in text
+    assert '# TYPE streeplijst_catalog_lookups_total counter' in text
+
+
+def test_sample_escaping():
+    assert sample('metric', dict(label='a "quoted"\\ value'), 1) == 'metric{label="a \\"quoted\\"\\\\ value"} 1'
+    assert sample('metric', dict(), 0.5) == 'metric 0.5'
@@ -0,0 +1,80 @@
+import os
+import sqlite3
+
+import pytest
+
+from streeplijst2 import create_app
+from streeplijst2.extensions import db
+from streeplijst2.migrations import LATEST_VERSION, get_version
+from streeplijst2.models import User
+from streeplijst2.streeplijst.database import SaleDB
+from streeplijst2.streeplijst.models import Item, Sale
+
+# Schema of a database created before the migrations existed, without the newer columns and without indexes
+OLD_SCHEMA = """
+CREATE TABLE users (id INTEGER NOT NULL, s_number VARCHAR, first_name VARCHAR, last_name_prefix VARCHAR,
+    last_name VARCHAR, date_of_birth DATETIME, has_sdd_mandate BOOLEAN, profile_picture VARCHAR, created DATETIME,
+    updated DATETIME, PRIMARY KEY (id), UNIQUE (s_number));
+CREATE TABLE folders (id INTEGER NOT NULL, name VARCHAR, media VARCHAR, synchronized DATETIME, created DATETIME,
+    updated DATETIME, PRIMARY KEY (id));
+CREATE TABLE items (id INTEGER NOT NULL, name VARCHAR, price INTEGER, published BOOLEAN, media VARCHAR,
+    folder_id INTEGER, folder_name VARCHAR, created DATETIME, updated DATETIME, PRIMARY KEY (id));
+CREATE TABLE sale (id INTEGER NOT NULL, quantity INTEGER, total_price INTEGER, item_id INTEGER, item_name VARCHAR,
+    user_id INTEGER, user_s_number VARCHAR, api_id INTEGER, api_reference VARCHAR, api_created DATETIME,
+    status VARCHAR, error_msg VARCHAR, created DATETIME, last_updated DATETIME, PRIMARY KEY (id));
+INSERT INTO sale (id, quantity, total_price, item_id, user_id, status) VALUES (1, 1, 50, 1, 1, 'ok');
+"""
+
+
+def explain(query) -> str:
+    """Return the query plan of an ORM query as a single string."""
+    statement = query.statement.compile(dialect=db.engine.dialect, compile_kwargs=dict(literal_binds=True))
+    rows = db.session.execute('EXPLAIN QUERY PLAN ' + str(statement))
+    return ' | '.join(row[-1] for row in rows)
+
+
+def test_migrate_old_database(db_uri_string):
+    connection = sqlite3.connect(db_uri_string)
+    connection.executescript(OLD_SCHEMA)
+    connection.close()
+
+    app = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + db_uri_string})
+    with app.app_context():
+        with db.engine.connect() as connection:
+            assert get_version(connection) == LATEST_VERSION
+        sale = Sale.query.get(1)
+        assert sale.attempts == 0 and sale.next_attempt is None  # Make sure the new columns can be used
+        indexes = [row[1] for row in db.session.execute('PRAGMA index_list(sale)')]
+        assert 'ix_sale_user_id_created' in indexes and 'ix_sale_status_created' in indexes
+        db.session.remove()
+        db.engine.dispose()
+    os.remove(db_uri_string)
+
+
+def test_migrate_new_database(test_app):
+    with test_app.app_context():
+        with db.engine.connect() as connection:
+            assert get_version(connection) == LATEST_VERSION  # A new database is created with the latest schema
+
+
+class TestQueryPlans:
+    """
+    Make sure the hot queries use an index instead of scanning the whole table.
+    """
+
+    @pytest.mark.parametrize('query, index', [
+        (lambda: Sale.query.filter_by(user_id=1).order_by(Sale.created, Sale.id), 'ix_sale_user_id_created'),
+        (lambda: Sale.query.filter_by(item_id=1).order_by(Sale.created, Sale.id), 'ix_sale_item_id_created'),
+        (lambda: Sale.query.filter_by(status=Sale.STATUS_FAILED).order_by(Sale.created), 'ix_sale_status_created'),
+        (lambda: db.session.query(Sale.id).filter(Sale.next_attempt <= db.func.now()).order_by(Sale.next_attempt),
+         'ix_sale_next_attempt'),
+        (lambda: Item.query.filter_by(folder_id=1), 'ix_items_folder_id'),
+        (lambda: SaleDB.listing(sort='created', descending=True, status=Sale.STATUS_FAILED).query(),
+         'ix_sale_status_created'),
+        (lambda: User.query.filter_by(s_number='s1'), 'sqlite_autoindex_users_1'),
+    ])
+    def test_query_uses_index(self, test_app, query, index):
+        with test_app.app_context():
+            plan = explain(query())
+            assert 'INDEX %s' % index in plan  # 'USING INDEX' or 'USING COVERING INDEX'
+            assert 'TEMP B-TREE' not in plan  # The index also provides the order, so no sorting is needed
@@ -1,5 +1,6 @@
 from flask import redirect, url_for
 
+from streeplijst2.config import TEST_USER
 from streeplijst2.routes import login_required
 
 
@@ -10,4 +11,16 @@ def test_hello(client):
 
 def test_login_required(client):
     response = client.get("/secret_hello")
-    assert 'http://localhost/login' == response.headers['Location']
\ No newline at end of file
+    assert 'http://localhost/login' == response.headers['Location']
+
+
+def test_login_returning_member(client, congressus_stub):
+    response = client.post('/login', data={'s-number': TEST_USER['s_number']})
+    assert response.status_code == 302  # Redirected to the streeplijst
+    client.get('/logout')
+    response = client.post('/login', data={'s-number': TEST_USER['s_number']})
+    assert response.status_code == 302
+    assert congressus_stub.count('members') == 1  # The second login did not wait for Congressus
+
+    response = client.post('/login', data={'s-number': 's0000000'})
+    assert b'not found' in response.data
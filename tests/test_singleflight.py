@@ -0,0 +1,83 @@
+import threading
+import time
+
+from streeplijst2.singleflight import SingleFlight, coalesce
+
+
+def wait_for_waiters(group: SingleFlight, key, waiters: int) -> None:
+    """Wait until a number of callers are waiting for the call with this key."""
+    deadline = time.time() + 5
+    while group._calls[key].shared < waiters and time.time() < deadline:
+        time.sleep(0.01)
+
+
+def test_do():
+    group = SingleFlight()
+    release = threading.Event()
+    calls = []
+    results = []
+
+    def func(value):
+        calls.append(value)
+        release.wait(5)
+        return [value]
+
+    threads = [threading.Thread(target=lambda: results.append(group.do('key', func, 1))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+        if not calls:  # Make sure the first thread is the one making the call
+            time.sleep(0.05)
+    wait_for_waiters(group, 'key', 4)
+    assert group.in_flight('key')
+
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert calls == [1]  # Only one call was made
+    assert len(results) == 5 and all(result is results[0] for result in results)  # All callers share the result
+    assert group.in_flight('key') is False
+
+    assert group.do('key', func, 2) == [2]  # A call after the first one finished is made again
+
+
+def test_do_error():
+    group = SingleFlight()
+    release = threading.Event()
+    errors = []
+
+    def func():
+        release.wait(5)
+        raise ValueError('Call failed')
+
+    def caller():
+        try:
+            group.do('key', func)
+        except ValueError as err:
+            errors.append(err)
+
+    threads = [threading.Thread(target=caller) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    wait_for_waiters(group, 'key', 2)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert len(errors) == 3 and all(err is errors[0] for err in errors)  # All callers receive the same exception
+
+
+def test_coalesce():
+    calls = []
+
+    @coalesce
+    def get(item_id, timeout=None):
+        calls.append((item_id, timeout))
+        time.sleep(0.3)
+        return item_id
+
+    threads = [threading.Thread(target=get, args=(1,), kwargs=dict(timeout=timeout)) for timeout in (1, 2, None)]
+    threads.append(threading.Thread(target=get, args=(2,)))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert sorted(item_id for (item_id, _) in calls) == [1, 2]  # The timeout is not part of the key